@@ -0,0 +1,322 @@
+import importlib.util
+import json
+import logging
+import os
+import platform
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+from impairment import ImpairmentProfile, ImpairmentRelay
+
+# === 本機 FEC 效能測試 ===
+#
+# 在 localhost 上啟動 fecudp 編碼端→解碼端，或 proxy→receiver，中間插入損傷中繼：
+#   產生器 → 編碼端 / proxy → 損傷中繼 → 解碼端 / receiver → 接收端
+# 每組 (目標, k, m, 封包大小) 各自啟動新的元件行程，量測有效吞吐量、FEC 後的殘餘遺失、
+# 延遲百分位數與每 Mbit 的 CPU 時間，結果逐行附加到 JSON Lines 檔案以追蹤效能變化。
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# === 設定 ===
+TARGETS = ['fecudp', 'proxy']
+FEC_GRID = [(4, 0), (2, 1), (4, 2), (8, 4), (10, 5)]  # (k, m)；m = 0 為不加 FEC 的對照組
+PACKET_SIZES = [200, 1000]   # fecudp：資料報大小；proxy：每則訊息大小（bytes）
+PACKET_RATE = 2000           # 每秒送出的封包 / 訊息數
+DURATION = 5.0               # 每組測試的送出時間（秒）
+DRAIN_TIME = 1.5             # 送完後等待尾端封包與逾時發送的時間（秒）
+STARTUP_TIMEOUT = 10.0       # 等待元件綁定埠號的時間上限
+SEED = 1
+OUTPUT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results.jsonl')
+
+# 損傷時間表：[(秒數, 設定), ...] 循環執行
+IMPAIRMENT_SCHEDULE = [
+    (2.0, ImpairmentProfile(loss=0.02, reorder=0.01, duplicate=0.005, delay=0.002, jitter=0.001)),
+    (1.0, ImpairmentProfile(loss=0.02, burst_start=0.01, burst_length=3, delay=0.002, jitter=0.001)),
+]
+
+LATENCY_PERCENTILES = [50, 90, 99, 99.9]
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+COMPONENTS = {
+    'fecudp-encoder': (os.path.join(ROOT, 'fecudp', 'fecudp-encoder.py'), 'run_worker', (0,)),
+    'fecudp-decoder': (os.path.join(ROOT, 'fecudp', 'fecudp-decoder.py'), 'run_worker', (0,)),
+    'proxy': (os.path.join(ROOT, 'tcptoudp', 'proxy.py'), 'start_proxy', ()),
+    'receiver': (os.path.join(ROOT, 'tcptoudp', 'receiver.py'), 'start_receiver', ()),
+}
+
+PROBE_HEADER = struct.Struct("!Q Q")   # 序號 | 送出時間（time.monotonic_ns）
+LENGTH_PREFIX = struct.Struct("!I")     # proxy 以長度前綴模式切割訊息
+
+# === 元件行程 ===
+def run_component(name, overrides):
+    """ 子行程入口：載入腳本（不執行 __main__ 區段）、套用設定後呼叫啟動函式 """
+    path, entry, args = COMPONENTS[name]
+    sys.path.insert(0, os.path.dirname(path))
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    for key, value in overrides.items():
+        setattr(module, key, value)
+    logging.getLogger().setLevel(logging.WARNING)
+    getattr(module, entry)(*args)
+
+def start_component(name, overrides):
+    command = [sys.executable, os.path.abspath(__file__), '--component', name, json.dumps(overrides)]
+    return subprocess.Popen(command, stdout=subprocess.DEVNULL)
+
+def process_cpu_seconds(pid):
+    """ 由 /proc 讀取行程的 user + system CPU 時間；非 Linux 時回傳 None """
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+def free_port(kind=socket.SOCK_DGRAM):
+    with socket.socket(socket.AF_INET, kind) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def wait_for_port(port, kind, processes):
+    """ 以嘗試綁定同一個埠的方式確認元件已開始監聽 """
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        for process in processes:
+            if process.poll() is not None:
+                raise RuntimeError(f"Component exited during startup with code {process.returncode}")
+        with socket.socket(socket.AF_INET, kind) as sock:
+            try:
+                sock.bind(('127.0.0.1', port))
+            except OSError:
+                return
+        time.sleep(0.05)
+    raise RuntimeError(f"Component did not bind port {port} within {STARTUP_TIMEOUT} seconds")
+
+# === 收送端 ===
+class Collector:
+    """ 記錄收到的序號與延遲 """
+
+    def __init__(self):
+        self.seen = set()
+        self.latencies = []  # 秒
+        self.duplicates = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def record(self, payload, now_ns):
+        if len(payload) < PROBE_HEADER.size:
+            return
+        seq, sent_ns = PROBE_HEADER.unpack_from(payload)
+        with self.lock:
+            if seq in self.seen:
+                self.duplicates += 1
+                return
+            self.seen.add(seq)
+            self.bytes += len(payload)
+            self.latencies.append((now_ns - sent_ns) / 1e9)
+
+def make_payload(seq, size):
+    return PROBE_HEADER.pack(seq, time.monotonic_ns()) + b'x' * max(0, size - PROBE_HEADER.size)
+
+def paced_send(send, size, stop_at):
+    """ 以固定速率送出，落後時立即補上（不累積 sleep 誤差）；回傳送出的數量 """
+    interval = 1.0 / PACKET_RATE
+    next_send = time.monotonic()
+    seq = 0
+    while next_send < stop_at:
+        delay = next_send - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        send(make_payload(seq, size))
+        seq += 1
+        next_send += interval
+    return seq
+
+def udp_sink(sock, collector, stop):
+    sock.settimeout(0.1)
+    while not stop.is_set():
+        try:
+            data, _ = sock.recvfrom(65535)
+        except socket.timeout:
+            continue
+        collector.record(data, time.monotonic_ns())
+
+def tcp_sink(server, collector, stop):
+    server.settimeout(0.1)
+    readers = []
+    while not stop.is_set():
+        try:
+            conn, _ = server.accept()
+        except socket.timeout:
+            continue
+        reader = threading.Thread(target=tcp_reader, args=(conn, collector, stop), daemon=True)
+        reader.start()
+        readers.append(reader)
+    for reader in readers:
+        reader.join()
+
+def tcp_reader(conn, collector, stop):
+    conn.settimeout(0.1)
+    buffer = bytearray()
+    while not stop.is_set():
+        try:
+            data = conn.recv(65536)
+        except socket.timeout:
+            continue
+        if not data:
+            break
+        now_ns = time.monotonic_ns()
+        buffer += data
+        while len(buffer) >= LENGTH_PREFIX.size:
+            length, = LENGTH_PREFIX.unpack_from(buffer)
+            if len(buffer) < LENGTH_PREFIX.size + length:
+                break
+            collector.record(bytes(buffer[LENGTH_PREFIX.size:LENGTH_PREFIX.size + length]), now_ns)
+            del buffer[:LENGTH_PREFIX.size + length]
+    conn.close()
+
+# === 單次測試 ===
+def run_case(target, k, m, size):
+    relay_port, downstream_port = free_port(), free_port()
+    collector = Collector()
+    stop = threading.Event()
+
+    if target == 'fecudp':
+        entry_port = free_port()
+        sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sink.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
+        sink.bind(('127.0.0.1', 0))
+        sink_thread = threading.Thread(target=udp_sink, args=(sink, collector, stop), daemon=True)
+        components = [
+            ('fecudp-decoder', {'UDP_LISTEN_IP': '127.0.0.1', 'UDP_LISTEN_PORT': downstream_port,
+                                'UDP_FORWARD_IP': '127.0.0.1', 'UDP_FORWARD_PORT': sink.getsockname()[1],
+                                'METRICS_PORT': None, 'WORKERS': 1}, downstream_port, socket.SOCK_DGRAM),
+            ('fecudp-encoder', {'UDP_LISTEN_IP': '127.0.0.1', 'UDP_LISTEN_PORT': entry_port,
+                                'UDP_FORWARD_IP': '127.0.0.1', 'UDP_FORWARD_PORT': relay_port,
+                                'FEC_ORIGINAL_PACKETS': k, 'FEC_REDUNDANT_PACKETS': m, 'ADAPTIVE_FEC': False,
+                                'METRICS_PORT': None, 'WORKERS': 1}, entry_port, socket.SOCK_DGRAM),
+        ]
+    else:
+        entry_port = free_port(socket.SOCK_STREAM)
+        sink = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sink.bind(('127.0.0.1', 0))
+        sink.listen(16)
+        sink_thread = threading.Thread(target=tcp_sink, args=(sink, collector, stop), daemon=True)
+        components = [
+            ('receiver', {'UDP_LISTEN_IP': '127.0.0.1', 'UDP_LISTEN_PORT': downstream_port,
+                          'TCP_DEST_HOST': '127.0.0.1', 'TCP_DEST_PORT': sink.getsockname()[1],
+                          'FRAMING_MODE': 'length', 'METRICS_PORT': None}, downstream_port, socket.SOCK_DGRAM),
+            ('proxy', {'TCP_HOST': '127.0.0.1', 'TCP_PORT': entry_port, 'UDP_HOST': '127.0.0.1',
+                       'UDP_PORT': relay_port, 'LOCAL_UDP_IP': '127.0.0.1', 'FRAMING_MODE': 'length',
+                       'FEC_ORIGINAL_PACKETS': k, 'FEC_BATCH_SIZE': k, 'FEC_REDUNDANT_PACKETS': m,
+                       'METRICS_PORT': None}, entry_port, socket.SOCK_STREAM),
+        ]
+
+    relay = ImpairmentRelay(('127.0.0.1', relay_port), ('127.0.0.1', downstream_port), IMPAIRMENT_SCHEDULE, SEED)
+    processes = []
+    try:
+        for name, overrides, port, kind in components:
+            processes.append(start_component(name, overrides))
+            wait_for_port(port, kind, processes)
+        sink_thread.start()
+        relay.start()
+        cpu_before = [process_cpu_seconds(process.pid) for process in processes]
+
+        start = time.monotonic()
+        stop_at = start + DURATION
+        if target == 'fecudp':
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sender:
+                sent = paced_send(lambda payload: sender.sendto(payload, ('127.0.0.1', entry_port)), size, stop_at)
+        else:
+            with socket.create_connection(('127.0.0.1', entry_port)) as sender:
+                sent = paced_send(lambda payload: sender.sendall(LENGTH_PREFIX.pack(len(payload)) + payload),
+                                  size, stop_at)
+        elapsed = time.monotonic() - start
+        time.sleep(DRAIN_TIME)
+
+        cpu_after = [process_cpu_seconds(process.pid) for process in processes]
+    finally:
+        stop.set()
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+        relay.stop()
+        if sink_thread.is_alive():
+            sink_thread.join()
+        sink.close()
+
+    return summarize(target, k, m, size, sent, elapsed, collector, relay.stats, cpu_before, cpu_after)
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(p / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+def summarize(target, k, m, size, sent, elapsed, collector, relay_stats, cpu_before, cpu_after):
+    delivered = len(collector.seen)
+    goodput_mbps = collector.bytes * 8 / elapsed / 1e6 if elapsed > 0 else 0.0
+    cpu_seconds = None
+    if None not in cpu_before and None not in cpu_after:
+        cpu_seconds = sum(after - before for before, after in zip(cpu_before, cpu_after))
+    delivered_mbit = collector.bytes * 8 / 1e6
+    latencies = sorted(collector.latencies)
+    offered = relay_stats['received']
+    return {
+        'target': target, 'k': k, 'm': m, 'packet_size': size, 'rate': PACKET_RATE, 'duration': elapsed,
+        'sent': sent, 'delivered': delivered, 'duplicates': collector.duplicates,
+        'residual_loss': 1 - delivered / sent if sent else None,
+        'channel_loss': (relay_stats['dropped'] + relay_stats['burst_dropped']) / offered if offered else None,
+        'goodput_mbps': goodput_mbps,
+        'latency_ms': {str(p): None if percentile(latencies, p) is None else percentile(latencies, p) * 1000
+                       for p in LATENCY_PERCENTILES},
+        'cpu_seconds': cpu_seconds,
+        'cpu_seconds_per_mbit': cpu_seconds / delivered_mbit if cpu_seconds is not None and delivered_mbit else None,
+        'relay': dict(relay_stats),
+    }
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    run_info = {
+        'run_id': time.strftime('%Y%m%dT%H%M%S'), 'revision': git_revision(), 'host': platform.node(),
+        'python': platform.python_version(),
+        'impairment': [(duration, profile.describe()) for duration, profile in IMPAIRMENT_SCHEDULE],
+    }
+    logging.info(f"Benchmark {run_info['run_id']} (revision {run_info['revision']}), writing to {OUTPUT_FILE}")
+    print(f"{'target':8} {'k':>3} {'m':>3} {'size':>5} {'goodput':>9} {'resid.loss':>10} "
+          f"{'p50 ms':>8} {'p99 ms':>8} {'cpu s/Mbit':>10}")
+    with open(OUTPUT_FILE, 'a') as output:
+        for target in TARGETS:
+            for k, m in FEC_GRID:
+                for size in PACKET_SIZES:
+                    try:
+                        result = run_case(target, k, m, size)
+                    except RuntimeError as e:
+                        logging.error(f"{target} k={k} m={m} size={size}: {e}")
+                        continue
+                    output.write(json.dumps({**run_info, **result}) + "\n")
+                    output.flush()
+                    latency = result['latency_ms']
+                    cpu = result['cpu_seconds_per_mbit']
+                    print(f"{target:8} {k:>3} {m:>3} {size:>5} {result['goodput_mbps']:>7.2f}Mb "
+                          f"{result['residual_loss']:>10.4%} "
+                          f"{latency['50'] if latency['50'] is not None else float('nan'):>8.2f} "
+                          f"{latency['99'] if latency['99'] is not None else float('nan'):>8.2f} "
+                          f"{cpu if cpu is not None else float('nan'):>10.4f}")
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == '--component':
+        run_component(sys.argv[2], json.loads(sys.argv[3]))
+    else:
+        main()
@@ -0,0 +1,158 @@
+import heapq
+import itertools
+import random
+import selectors
+import socket
+import threading
+import time
+
+# === 本機損傷中繼：在兩個元件之間模擬遺失、連續遺失、亂序、重複與延遲 ===
+#
+# 上游（例如編碼端）把封包送到中繼的監聽埠，中繼依目前的損傷設定轉發到下游（例如解碼端）；
+# 下游送回的封包（例如遺失回報）不加損傷，直接轉回最近一次的上游來源。
+# 損傷設定可以依時間表切換（例如 5 秒正常、2 秒嚴重連續遺失），時間表會循環執行。
+
+class ImpairmentProfile:
+    """ 單一時段的損傷設定；機率皆以單一封包計 """
+    __slots__ = ('loss', 'burst_start', 'burst_length', 'reorder', 'reorder_delay',
+                 'duplicate', 'delay', 'jitter')
+
+    def __init__(self, loss=0.0, burst_start=0.0, burst_length=1.0, reorder=0.0, reorder_delay=0.005,
+                 duplicate=0.0, delay=0.0, jitter=0.0):
+        self.loss = loss                    # 獨立隨機遺失機率
+        self.burst_start = burst_start      # 進入連續遺失狀態的機率（Gilbert-Elliott 模型）
+        self.burst_length = burst_length    # 連續遺失的平均長度（封包數）
+        self.reorder = reorder              # 封包被額外延後（因而亂序）的機率
+        self.reorder_delay = reorder_delay  # 亂序封包額外延後的秒數
+        self.duplicate = duplicate          # 封包被重複送出的機率
+        self.delay = delay                  # 固定單向延遲（秒）
+        self.jitter = jitter                # 延遲的均勻抖動上限（秒）
+
+    def describe(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+class ImpairmentRelay:
+    """ 在背景執行緒中轉發並損傷封包 """
+
+    def __init__(self, listen_addr, forward_addr, schedule, seed=1):
+        self.forward_addr = forward_addr
+        self.schedule = schedule  # [(秒數, ImpairmentProfile), ...]，依序循環
+        self.random = random.Random(seed)
+        self.upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.upstream.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
+        self.upstream.bind(listen_addr)
+        self.downstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.downstream.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
+        self.downstream.bind((listen_addr[0], 0))
+        self.upstream_source = None  # 最近一次上游的來源位址，下游的回傳封包送往此處
+        self.in_burst = False
+        self.pending = []  # (送出時間, 序號, 資料) 的最小堆積
+        self.tie_breaker = itertools.count()
+        self.stats = {'received': 0, 'forwarded': 0, 'dropped': 0, 'burst_dropped': 0,
+                      'reordered': 0, 'duplicated': 0, 'returned': 0}
+        self.running = False
+        self.thread = None
+        self.start_time = None
+
+    @property
+    def address(self):
+        return self.upstream.getsockname()
+
+    def start(self):
+        self.running = True
+        self.start_time = time.monotonic()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+        self.upstream.close()
+        self.downstream.close()
+
+    def profile(self, now):
+        """ 依時間表找出目前的損傷設定 """
+        cycle = sum(duration for duration, _ in self.schedule)
+        offset = (now - self.start_time) % cycle if cycle > 0 else 0.0
+        for duration, profile in self.schedule:
+            if offset < duration:
+                return profile
+            offset -= duration
+        return self.schedule[-1][1]
+
+    def run(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self.upstream, selectors.EVENT_READ, self.handle_upstream)
+        selector.register(self.downstream, selectors.EVENT_READ, self.handle_downstream)
+        while self.running:
+            now = time.monotonic()
+            timeout = 0.05
+            if self.pending:
+                timeout = min(timeout, max(0.0, self.pending[0][0] - now))
+            for key, _ in selector.select(timeout):
+                key.data()
+            self.release(time.monotonic())
+        selector.close()
+
+    def handle_upstream(self):
+        for _ in range(256):
+            try:
+                data, addr = self.upstream.recvfrom(65535, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                return
+            self.upstream_source = addr
+            self.stats['received'] += 1
+            self.impair(data, time.monotonic())
+
+    def handle_downstream(self):
+        for _ in range(256):
+            try:
+                data, _ = self.downstream.recvfrom(65535, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                return
+            if self.upstream_source is not None:
+                self.upstream.sendto(data, self.upstream_source)
+                self.stats['returned'] += 1
+
+    def impair(self, data, now):
+        profile = self.profile(now)
+        rand = self.random.random
+
+        # Gilbert-Elliott：正常狀態以 burst_start 進入連續遺失，連續遺失狀態以 1 / burst_length 離開
+        if self.in_burst:
+            if rand() < 1.0 / max(profile.burst_length, 1.0):
+                self.in_burst = False
+        elif profile.burst_start and rand() < profile.burst_start:
+            self.in_burst = True
+        if self.in_burst:
+            self.stats['burst_dropped'] += 1
+            return
+        if profile.loss and rand() < profile.loss:
+            self.stats['dropped'] += 1
+            return
+
+        copies = 2 if profile.duplicate and rand() < profile.duplicate else 1
+        if copies > 1:
+            self.stats['duplicated'] += 1
+        for _ in range(copies):
+            delay = profile.delay + (rand() * profile.jitter if profile.jitter else 0.0)
+            if profile.reorder and rand() < profile.reorder:
+                delay += profile.reorder_delay
+                self.stats['reordered'] += 1
+            if delay > 0:
+                heapq.heappush(self.pending, (now + delay, next(self.tie_breaker), data))
+            else:
+                self.send(data)
+
+    def release(self, now):
+        while self.pending and self.pending[0][0] <= now:
+            _, _, data = heapq.heappop(self.pending)
+            self.send(data)
+
+    def send(self, data):
+        try:
+            self.downstream.sendto(data, self.forward_addr)
+            self.stats['forwarded'] += 1
+        except OSError:
+            self.stats['dropped'] += 1
@@ -0,0 +1,326 @@
+import glob
+import hashlib
+import os
+import re
+import threading
+
+from common.manifest import merkle_root
+
+# === 直接寫入磁碟的 chunk 檔案 ===
+#
+# 收到 metadata 時預先配置目標檔案（<name>.part），每個 chunk 收到後直接以 pwrite 寫到自己的位置，
+# 記憶體中只保留每個 chunk 1 bit 的 bitmap，不論檔案多大、同時接收多少個檔案都不會把內容留在 RAM。
+# SHA-256 依 chunk 順序增量計算：按順序到達的 chunk 直接從封包內容計算，
+# 提早到達的 chunk 等前面的缺口補齊後再從檔案讀回（通常仍在 page cache 中），每個 chunk 只計算一次。
+#
+# 指定區塊大小（block_chunks）時改以區塊為單位驗證（common.manifest）：區塊雜湊隨資料陸續到達（add_leaves），
+# 區塊收齊且雜湊已知時比對，不符時清除整個區塊重新接收；雜湊已知但內容已在本機（其他檔案、中斷的傳送留下的
+# .part、同一個檔案內較早的區塊）時直接複製。通過的區塊登記到 BlockStore，並逐行附加到 .state，
+# 接收端重新啟動後 BlockStore.load 讀回，重新傳送時以內容複製的方式續傳。
+# 這時暫存檔以 tag（傳送編號）命名（<name>.<tag>.part），同名的兩次傳送各自寫入自己的檔案；
+# 完成時才刪除同名的其他未完成檔案（只刪除已關閉的，仍在接收中的傳送不受影響）。
+# 整個檔案的 SHA-256 只涵蓋已驗證的區塊，區塊驗證時直接使用讀回的內容計算。
+
+_NOT_ALL_RECEIVED = re.compile(rb'[^\xff]')  # 以 C 的速度跳過整 byte 都已收到 / 都未收到的區段
+_NOT_ALL_MISSING = re.compile(rb'[^\x00]')
+_open_parts = set()  # 仍在接收中的暫存檔路徑；多個工作執行緒共用
+_open_parts_lock = threading.Lock()
+
+class ChunkFile:
+    def __init__(self, path, total, chunk_size, block_chunks=None, store=None, tag=None):
+        self.path = path
+        self.part_path = path + ('.part' if tag is None else f'.{tag}.part')
+        self.state_path = self.part_path + '.state'
+        self.total = total
+        self.chunk_size = chunk_size
+        self.bitmap = bytearray((total + 7) // 8)
+        self.received = 0
+        self.highest = -1        # 目前收到的最大 chunk 編號
+        self.last_length = None  # 最後一個 chunk 的長度，決定檔案的實際大小
+        self.sha256 = hashlib.sha256()
+        self.hashed = 0          # 已計入雜湊的 chunk 數（前綴）
+
+        self.block_chunks = block_chunks
+        self.blocks = 0 if block_chunks is None else (total + block_chunks - 1) // block_chunks
+        self.verified = bytearray(self.blocks)  # 每個區塊是否已通過驗證
+        self.counts = [0] * self.blocks         # 每個區塊已收到的 chunk 數
+        self.leaves = [None] * self.blocks      # 已收到的區塊雜湊
+        self.known = 0                          # 已知雜湊的區塊數
+        self.store = store
+        self.sources = {}        # 雜湊 -> 這個檔案中負責取得該內容的第一個區塊
+        self.waiting = {}        # 區塊 -> 內容相同、等它驗證後直接複製的其他區塊
+        self.deferred = set()    # 正在等待複製的區塊
+        self.copied = 0          # 從本機內容複製的區塊數
+        self.resumed = 0         # 其中來自未完成檔案（中斷的傳送）的區塊數
+        self.rejected = 0        # 驗證失敗而重新接收的區塊數
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with _open_parts_lock:
+            _open_parts.add(self.part_path)  # 建立檔案之前登記，其他傳送完成時不會刪掉它
+        self.fd = os.open(self.part_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        size = total * chunk_size
+        if size:
+            try:
+                os.posix_fallocate(self.fd, 0, size)  # 預先配置空間，避免寫到一半磁碟已滿或檔案破碎
+            except (AttributeError, OSError):
+                os.ftruncate(self.fd, size)
+        self.state = None if block_chunks is None else open(self.state_path, 'w', buffering=1)
+
+    def has(self, seq):
+        return bool(self.bitmap[seq >> 3] & (1 << (seq & 7)))
+
+    @property
+    def complete(self):
+        return self.received == self.total
+
+    @property
+    def manifest_complete(self):
+        return self.known == self.blocks
+
+    def root(self):
+        """ 由收齊的區塊雜湊計算 Merkle 根雜湊 """
+        return merkle_root(self.leaves)
+
+    def block_span(self, block):
+        """ 區塊涵蓋的 chunk 範圍 (start, end) """
+        start = block * self.block_chunks
+        return start, min(start + self.block_chunks, self.total)
+
+    def _mark(self, start, end):
+        for seq in range(start, end):
+            self.bitmap[seq >> 3] |= 1 << (seq & 7)
+
+    def _clear(self, start, end):
+        for seq in range(start, end):
+            self.bitmap[seq >> 3] &= ~(1 << (seq & 7))
+
+    def add_leaves(self, first, digests):
+        """ 加入一段區塊雜湊：驗證已收齊的區塊，內容已在本機的區塊直接複製；
+            回傳這一段中已經有（已驗證或等待本機複製）的區塊 """
+        held = []
+        for block, digest in enumerate(digests[:max(0, self.blocks - first)], first):
+            if self.leaves[block] is None:
+                self.leaves[block] = digest
+                self.known += 1
+                self._resolve(block)
+            if self.verified[block] or block in self.deferred:
+                held.append(block)
+        return held
+
+    def _resolve(self, block):
+        digest = self.leaves[block]
+        start, end = self.block_span(block)
+        if self.counts[block] == end - start and self._verify(block):
+            return
+        first = self.sources.get(digest)
+        if first is not None:
+            if self.verified[first]:
+                start, end = self.block_span(first)
+                self._fill(block, os.pread(self.fd, self._length(start, end), start * self.chunk_size))
+            elif self.counts[block] == 0:
+                self._mark(start, end)  # 先標記為已有（不計入 received、不再回報缺少），來源區塊驗證後直接複製
+                self.deferred.add(block)
+                self.waiting.setdefault(first, []).append(block)
+            return
+        found = self.store.read(digest) if self.store is not None else None
+        if found is not None and self._fill(block, found[0]):
+            if found[1].endswith('.part'):
+                self.resumed += 1
+            return
+        self.sources[digest] = block
+
+    def reset_leaves(self):
+        """ 根雜湊與收到的區塊雜湊不符：丟棄全部區塊雜湊與驗證結果，重新取得清單後再驗證 """
+        for block in self.deferred:
+            self._clear(*self.block_span(block))
+        self.deferred.clear()
+        self.waiting.clear()
+        self.sources.clear()
+        self.leaves = [None] * self.blocks
+        self.known = 0
+        self.verified = bytearray(self.blocks)
+        self.state.seek(0)
+        self.state.truncate()
+
+    def _length(self, start, end):
+        """ 範圍內的 bytes 數；包含最後一個 chunk 時需要已知 last_length """
+        if end < self.total:
+            return (end - start) * self.chunk_size
+        return (end - 1 - start) * self.chunk_size + self.last_length
+
+    def _fill(self, block, data):
+        """ 以本機取得的內容填入整個區塊（內容已確認符合雜湊）；長度不合時回傳 False """
+        start, end = self.block_span(block)
+        last_length = len(data) - (end - 1 - start) * self.chunk_size
+        if not 0 < last_length <= self.chunk_size or (end < self.total and last_length != self.chunk_size):
+            return False
+        os.pwrite(self.fd, data, start * self.chunk_size)
+        if block in self.deferred:
+            self.deferred.discard(block)
+            self.received += end - start
+        else:
+            self.received += sum(1 for seq in range(start, end) if not self.has(seq))
+            self._mark(start, end)
+        self.counts[block] = end - start
+        self.highest = max(self.highest, end - 1)
+        if end == self.total:
+            self.last_length = last_length
+        self.copied += 1
+        self._accept(block, data)
+        return True
+
+    def _verify(self, block):
+        """ 比對收齊的區塊與清單中的雜湊；不符時清除整個區塊重新接收 """
+        start, end = self.block_span(block)
+        data = os.pread(self.fd, self._length(start, end), start * self.chunk_size)
+        if hashlib.sha256(data).digest() != self.leaves[block]:
+            self._clear(start, end)
+            self.received -= end - start
+            self.counts[block] = 0
+            self.rejected += 1
+            return False
+        self._accept(block, data)
+        return True
+
+    def _accept(self, block, data):
+        """ 區塊通過驗證：記錄進度、登記為可供複製的內容、補上等待它的重複區塊並推進檔案雜湊 """
+        self.verified[block] = 1
+        start, end = self.block_span(block)
+        digest = self.leaves[block]
+        self.state.write(f'{start * self.chunk_size} {len(data)} {digest.hex()}\n')  # 格式見 BlockStore.load
+        if self.store is not None:
+            self.store.add(digest, self.part_path, start * self.chunk_size, len(data))
+        self.sources.setdefault(digest, block)
+        if start == self.hashed:
+            self.sha256.update(data)
+            self.hashed = end
+        for duplicate in self.waiting.pop(block, ()):
+            self._fill(duplicate, data)
+        self._advance_hash()
+
+    def missing_ranges(self, limit=None, max_ranges=None):
+        """ 由小到大列出 limit 以前尚未收到的連續範圍 [(start, count), ...]，最多 max_ranges 個 """
+        limit = self.total if limit is None else min(limit, self.total)
+        ranges = []
+        seq = self.hashed  # 已雜湊的前綴必定全部收到
+        while max_ranges is None or len(ranges) < max_ranges:
+            start = self._find(seq, False, limit)
+            if start >= limit:
+                break
+            seq = self._find(start, True, limit)
+            ranges.append((start, seq - start))
+        return ranges
+
+    def _find(self, seq, received, limit):
+        """ 從 seq 開始找第一個收到狀態等於 received 的 chunk，找不到時回傳 limit """
+        skip = _NOT_ALL_MISSING if received else _NOT_ALL_RECEIVED
+        while seq < limit:
+            if seq & 7 == 0:
+                match = skip.search(self.bitmap, seq >> 3, (limit + 7) >> 3)
+                if match is None:
+                    return limit
+                seq = max(seq, match.start() * 8)
+                if seq >= limit:
+                    return limit
+            if self.has(seq) == received:
+                return seq
+            seq += 1
+        return limit
+
+    def write(self, seq, data):
+        """ 寫入一個 chunk；重複、超出範圍或長度不正確時回傳 False """
+        if seq >= self.total or self.has(seq):
+            return False
+        if len(data) > self.chunk_size or (len(data) < self.chunk_size and seq != self.total - 1):
+            return False
+        os.pwrite(self.fd, data, seq * self.chunk_size)
+        self.bitmap[seq >> 3] |= 1 << (seq & 7)
+        self.received += 1
+        self.highest = max(self.highest, seq)
+        if seq == self.total - 1:
+            self.last_length = len(data)
+
+        if self.block_chunks is not None:
+            block = seq // self.block_chunks
+            self.counts[block] += 1
+            if self.leaves[block] is not None and self.counts[block] == min(self.block_chunks, self.total - block * self.block_chunks):
+                self._verify(block)
+        elif seq == self.hashed:
+            self.sha256.update(data)
+            self.hashed += 1
+            self._advance_hash()
+        return True
+
+    def read(self, seq):
+        """ 讀回已寫入的 chunk；最後一個 chunk 以預先配置的零補滿 chunk_size（給 FEC 解碼使用） """
+        return os.pread(self.fd, self.chunk_size, seq * self.chunk_size).ljust(self.chunk_size, b'\x00')
+
+    def _advance_hash(self):
+        """ 把緊接在已雜湊前綴之後、提早到達（或已驗證）的部分從檔案讀回並計入雜湊 """
+        if self.block_chunks is not None:
+            while self.hashed < self.total and self.verified[self.hashed // self.block_chunks]:
+                start, end = self.block_span(self.hashed // self.block_chunks)
+                self.sha256.update(os.pread(self.fd, self._length(start, end), start * self.chunk_size))
+                self.hashed = end
+            return
+        while self.hashed < self.total and self.has(self.hashed):
+            seq = self.hashed
+            length = self.last_length if seq == self.total - 1 else self.chunk_size
+            self.sha256.update(os.pread(self.fd, length, seq * self.chunk_size))
+            self.hashed += 1
+
+    def finish(self):
+        """ 全部收齊後截掉預先配置的多餘空間、關閉並改為正式檔名；回傳 SHA-256（hex） """
+        self._advance_hash()
+        size = 0 if self.total == 0 else (self.total - 1) * self.chunk_size + self.last_length
+        os.ftruncate(self.fd, size)
+        os.close(self.fd)
+        self.fd = None
+        os.replace(self.part_path, self.path)
+        self._close_state()
+        self._release()
+        self._remove(self.state_path)
+        if self.block_chunks is not None:
+            # 同名較早的傳送留下、已關閉的未完成檔案：內容已被取代，需要的區塊也已複製過來；
+            # 仍在接收中的同名傳送（例如在其他工作執行緒較晚開始的那一份）保留
+            pattern = glob.escape(self.path) + '.*.part'
+            with _open_parts_lock:
+                for path in glob.glob(pattern) + glob.glob(pattern + '.state'):
+                    if path.removesuffix('.state') not in _open_parts:
+                        self._remove(path)
+        return self.sha256.hexdigest()
+
+    @property
+    def resumable(self):
+        """ 是否有已驗證的區塊可供之後續傳 """
+        return any(self.verified)
+
+    def close(self):
+        """ 暫停接收：關閉檔案但保留 .part 與 .state，之後的傳送可從中複製已驗證的區塊（續傳） """
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self._close_state()
+        self._release()
+
+    def abort(self):
+        """ 放棄接收：關閉並刪除未完成的檔案 """
+        self.close()
+        self._remove(self.part_path)
+        self._remove(self.state_path)
+
+    def _close_state(self):
+        if self.state is not None:
+            self.state.close()
+            self.state = None
+
+    def _release(self):
+        with _open_parts_lock:
+            _open_parts.discard(self.part_path)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
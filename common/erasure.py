@@ -0,0 +1,124 @@
+import functools
+import numpy as np
+
+# === 封包層級的系統性 (k, m) 抹除碼 ===
+#
+# k 個原始封包補零到相同長度後，每一欄（同一位元組位置）視為 GF(256) 上的一個符號向量，
+# 以 m×k 的 Cauchy 矩陣相乘得到 m 個冗餘封包。任意 k 個封包（原始或冗餘）都能還原全部原始封包，
+# 也就是最多可承受 m 個封包遺失。原始封包照原樣傳送（系統碼），沒有遺失時不需要解碼。
+
+GF_POLY = 0x11d  # x^8 + x^4 + x^3 + x^2 + 1
+MAX_SYMBOLS = 256  # k + m 上限（GF(256) 內相異元素的數量）
+
+def _build_tables():
+    exp = np.zeros(512, dtype=np.uint8)
+    log = np.zeros(256, dtype=np.int32)
+    x = 1
+    for i in range(255):
+        exp[i] = x
+        log[x] = i
+        x <<= 1
+        if x & 0x100:
+            x ^= GF_POLY
+    exp[255:510] = exp[:255]
+
+    # 乘法表：MUL[a][b] = a * b，用來把整個封包一次查表相乘
+    mul = exp[(log[:, None] + log[None, :]) % 255]
+    mul[0, :] = 0
+    mul[:, 0] = 0
+    return exp, log, mul
+
+GF_EXP, GF_LOG, GF_MUL = _build_tables()
+
+def gf_inverse(a):
+    return int(GF_EXP[255 - GF_LOG[a]])
+
+def gf_invert_matrix(matrix):
+    """ 以 Gauss-Jordan 消去法求 GF(256) 方陣的反矩陣 """
+    n = len(matrix)
+    rows = [list(row) + [1 if i == j else 0 for j in range(n)] for i, row in enumerate(matrix)]
+    for col in range(n):
+        pivot = next((r for r in range(col, n) if rows[r][col]), None)
+        if pivot is None:
+            raise ErasureDecodeError("Singular decoding matrix")
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        inv = gf_inverse(rows[col][col])
+        rows[col] = [int(GF_MUL[inv, v]) for v in rows[col]]
+        for r in range(n):
+            factor = rows[r][col]
+            if r != col and factor:
+                rows[r] = [v ^ int(GF_MUL[factor, p]) for v, p in zip(rows[r], rows[col])]
+    return np.array([row[n:] for row in rows], dtype=np.uint8)
+
+def gf_matmul(matrix, symbols):
+    """ (r×k 係數矩陣) × (k×S 封包矩陣)，回傳 r×S；每個係數對整列封包查表相乘後 XOR 累加 """
+    return np.bitwise_xor.reduce(GF_MUL[matrix[:, :, None], symbols[None, :, :]], axis=1)
+
+class ErasureDecodeError(ValueError):
+    """ 收到的封包不足 k 個，或資料不一致而無法解碼 """
+
+class ErasureCodec:
+    """ 系統性 (k, m) Cauchy 抹除碼，符號為 GF(256) 上的封包欄 """
+
+    def __init__(self, k, m):
+        if k < 1 or m < 0 or k + m > MAX_SYMBOLS:
+            raise ValueError(f"Invalid FEC parameters k={k}, m={m} (need k >= 1, m >= 0, k + m <= {MAX_SYMBOLS})")
+        self.k = k
+        self.m = m
+        # Cauchy 矩陣 C[i][j] = 1 / (x_i + y_j)，x_i = k + i、y_j = j 皆相異，任意 k×k 子矩陣可逆
+        self.matrix = np.array([[gf_inverse((k + i) ^ j) for j in range(k)] for i in range(m)], dtype=np.uint8)
+        self._decode_matrices = {}
+
+    def encode(self, packets):
+        """ 回傳 m 個冗餘封包（bytes），長度等於最長的原始封包 """
+        if len(packets) != self.k:
+            raise ValueError(f"Expected {self.k} packets, got {len(packets)}")
+        if not self.m:
+            return []
+        data = self._stack(packets, max(len(packet) for packet in packets))
+        return [row.tobytes() for row in gf_matmul(self.matrix, data)]
+
+    def decode(self, received, symbol_size):
+        """ received: {index: 封包}，index < k 為原始封包、其餘為冗餘封包；回傳補零到 symbol_size 的 k 個原始封包 """
+        recovered = self.recover(received, symbol_size)
+        return [recovered[i] if i in recovered else bytes(received[i]).ljust(symbol_size, b'\x00')
+                for i in range(self.k)]
+
+    def recover(self, received, symbol_size):
+        """ 只重建遺失的原始封包，回傳 {index: 封包}（補零到 symbol_size） """
+        missing = [i for i in range(self.k) if i not in received]
+        if not missing:
+            return {}
+        parity = [i for i in sorted(received) if self.k <= i < self.k + self.m]
+        if len(parity) < len(missing):
+            raise ErasureDecodeError(f"Need {self.k} packets to decode, got {self.k - len(missing) + len(parity)}")
+
+        # 使用所有收到的原始封包，再補上足夠的冗餘封包
+        used = [i for i in range(self.k) if i in received] + parity[:len(missing)]
+        inverse = self._decode_matrix(tuple(used))
+        symbols = self._stack([received[i] for i in used], symbol_size)
+        rows = gf_matmul(inverse[missing], symbols)
+        return {index: row.tobytes() for index, row in zip(missing, rows)}
+
+    def _decode_matrix(self, used):
+        inverse = self._decode_matrices.get(used)
+        if inverse is None:
+            rows = [[1 if i == j else 0 for j in range(self.k)] if i < self.k else self.matrix[i - self.k].tolist()
+                    for i in used]
+            inverse = gf_invert_matrix(rows)
+            if len(self._decode_matrices) >= 1024:
+                self._decode_matrices.clear()
+            self._decode_matrices[used] = inverse
+        return inverse
+
+    @staticmethod
+    def _stack(packets, symbol_size):
+        data = np.zeros((len(packets), symbol_size), dtype=np.uint8)
+        for row, packet in zip(data, packets):
+            row[:len(packet)] = np.frombuffer(packet, dtype=np.uint8, count=min(len(packet), symbol_size))
+        return data
+
+@functools.lru_cache(maxsize=64)
+def get_codec(k, m):
+    """ 依 (k, m) 取得共用的編碼器（Cauchy 矩陣與反矩陣快取都可重複使用） """
+    return ErasureCodec(k, m)
@@ -0,0 +1,156 @@
+import glob
+import hashlib
+import json
+import os
+import threading
+
+# === 區塊清單（Merkle manifest）與內容定址的區塊索引 ===
+#
+# 檔案每 block_chunks 個 chunk 為一個驗證區塊，每個區塊的 SHA-256 是 Merkle 樹的葉節點。
+# 發送端在背景依序計算區塊雜湊（ManifestStream），算好的部分隨資料一起送出，第一個封包不必等整個檔案讀完；
+# 根雜湊在第一輪傳送結束時隨整個檔案的雜湊送出，接收端以此確認收到的清單完整無誤。
+# 接收端每收齊一個區塊就與清單比對（common.chunkfile），通過的區塊同時是內容位址：
+# 之後任何傳送（中斷後重新傳送、其他檔案、同一個檔案內重複的內容）遇到相同雜湊的區塊都直接從本機複製，
+# 並回報發送端略過。未完成檔案的已驗證區塊也寫在 .state 中，接收端重新啟動後仍可續傳。
+
+class ManifestStream:
+    """ 發送端的區塊清單：背景執行緒依序計算區塊雜湊與整個檔案的 SHA-256，傳送迴圈隨時取出新算好的部分送出；
+        接收端回報已經有的區塊記在 have，傳送時略過 """
+
+    def __init__(self, view, block_size):
+        self.view = view
+        self.block_size = block_size
+        self.count = (len(view) + block_size - 1) // block_size
+        self.leaves = []  # 依序算好的區塊雜湊（只由背景執行緒 append）
+        self.sha256 = hashlib.sha256()
+        self.sent = 0     # 已送出的區塊雜湊數
+        self.have = bytearray(self.count)
+        self.stopping = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def _run(self):
+        for start in range(0, len(self.view), self.block_size):
+            if self.stopping:
+                return
+            block = self.view[start:start + self.block_size]  # hashlib 計算時會釋放 GIL，與傳送同時進行
+            self.leaves.append(hashlib.sha256(block).digest())
+            self.sha256.update(block)
+
+    def join(self):
+        """ 等背景執行緒算完 """
+        self.thread.join()
+
+    def stop(self):
+        """ 傳送中止：停止計算並等背景執行緒結束（它持有 mmap 的切片，關閉檔案前必須先結束） """
+        self.stopping = True
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def root(self):
+        self.join()
+        return merkle_root(self.leaves)
+
+    def next_batch(self, batch_size):
+        """ 取出下一批已算好、尚未送出的區塊雜湊 (first, digests)，最多 batch_size 個；沒有時回傳 None """
+        if len(self.leaves) == self.sent:
+            return None
+        first = self.sent
+        digests = self.leaves[first:first + batch_size]
+        self.sent += len(digests)
+        return first, digests
+
+    def mark_have(self, ranges):
+        """ 接收端回報已經有的區塊範圍 [(start, count), ...] """
+        for start, count in ranges:
+            end = min(start + count, self.count)
+            if start < end:
+                self.have[start:end] = b"\x01" * (end - start)
+
+def merkle_root(leaves):
+    """ 葉節點兩兩相接往上計算根雜湊（內部節點加上 0x01 前綴，與葉節點區分）；奇數個時最後一個直接升到上一層 """
+    level = list(leaves) or [hashlib.sha256(b"").digest()]
+    while len(level) > 1:
+        level = [hashlib.sha256(b"\x01" + level[i] + level[i + 1]).digest() if i + 1 < len(level) else level[i]
+                 for i in range(0, len(level), 2)]
+    return level[0]
+
+class BlockStore:
+    """ 已驗證區塊的內容索引：區塊雜湊 -> (檔案路徑, 位移, 長度)；讀出時重新驗證，來源已改變的項目自動移除 """
+
+    def __init__(self, index_dir=None):
+        self.index_dir = index_dir  # 已完成檔案的區塊清單存放處；None 表示不保存（重新啟動後索引為空）
+        self.blocks = {}
+        self.lock = threading.Lock()
+
+    def add(self, digest, path, offset, length):
+        with self.lock:
+            self.blocks[digest] = (path, offset, length)
+
+    def add_file(self, path, leaves, block_size):
+        """ 登記已完成的檔案，並保存它的區塊清單供重新啟動後使用 """
+        size = os.path.getsize(path)
+        for i, digest in enumerate(leaves):
+            self.add(digest, path, i * block_size, min(block_size, size - i * block_size))
+        if self.index_dir is None:
+            return
+        os.makedirs(self.index_dir, exist_ok=True)
+        record = {'path': path, 'size': size, 'block_size': block_size, 'leaves': [leaf.hex() for leaf in leaves]}
+        index_path = os.path.join(self.index_dir, os.path.basename(path) + '.json')
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump(record, f)
+        os.replace(index_path + '.tmp', index_path)
+
+    def load(self, partial_dir=None):
+        """ 讀回先前保存的區塊清單，以及 partial_dir 中未完成檔案已驗證的區塊（*.part.state），回傳登記的區塊數 """
+        count = 0
+        if self.index_dir is not None and os.path.isdir(self.index_dir):
+            for name in os.listdir(self.index_dir):
+                if not name.endswith('.json'):
+                    continue
+                try:
+                    with open(os.path.join(self.index_dir, name)) as f:
+                        record = json.load(f)
+                    if os.path.getsize(record['path']) != record['size']:
+                        continue
+                except (OSError, ValueError, KeyError):
+                    continue
+                block_size, size = record['block_size'], record['size']
+                for i, leaf in enumerate(record['leaves']):
+                    self.add(bytes.fromhex(leaf), record['path'], i * block_size, min(block_size, size - i * block_size))
+                    count += 1
+        if partial_dir is not None:
+            for state_path in glob.glob(os.path.join(glob.escape(partial_dir), '*.part.state')):
+                part_path = state_path[:-len('.state')]
+                if not os.path.exists(part_path):
+                    continue
+                with open(state_path) as f:
+                    for line in f:  # 每行：位移 長度 區塊雜湊（hex）；中斷時最後一行可能不完整
+                        try:
+                            offset, length, leaf = line.split()
+                            self.add(bytes.fromhex(leaf), part_path, int(offset), int(length))
+                            count += 1
+                        except ValueError:
+                            continue
+        return count
+
+    def read(self, digest):
+        """ 讀出內容符合雜湊的區塊，回傳 (內容, 來源路徑)；沒有登記或來源已改變時回傳 None """
+        with self.lock:
+            entry = self.blocks.get(digest)
+        if entry is None:
+            return None
+        path, offset, length = entry
+        try:
+            with open(path, 'rb') as f:
+                data = os.pread(f.fileno(), length, offset)
+        except OSError:
+            data = b""
+        if len(data) != length or hashlib.sha256(data).digest() != digest:
+            with self.lock:
+                if self.blocks.get(digest) == entry:
+                    del self.blocks[digest]
+            return None
+        return data, path
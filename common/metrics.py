@@ -0,0 +1,214 @@
+import bisect
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# === 共用的計數器、量表與延遲分佈 ===
+#
+# 封包路徑上只做整數加法與一次 bisect，取代逐封包的 f-string 日誌；
+# 統計值由本機 HTTP 端點提供：/metrics 為 Prometheus 文字格式，/metrics.json 為 JSON。
+
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)  # 秒
+
+class Counter:
+    """ 只增不減的計數器，可依標籤值分開計數（例如 flush 原因） """
+    kind = 'counter'
+
+    def __init__(self, name, help_text, label=None):
+        self.name = name
+        self.help = help_text
+        self.label = label  # 標籤名稱；None 表示沒有標籤
+        self.values = {}    # 標籤值 -> 計數
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, label_value=None):
+        with self.lock:
+            self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values) if self.values or self.label else {None: 0}
+        for label_value, value in values.items():
+            yield self.name, self._labels(label_value), value
+
+    def _labels(self, label_value):
+        return {self.label: label_value} if self.label else {}
+
+class Gauge(Counter):
+    """ 目前的數值（例如佇列深度）；可給定回呼函式，在輸出時才讀取 """
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, function=None):
+        super().__init__(name, help_text)
+        self.function = function
+
+    def set(self, value):
+        with self.lock:
+            self.values[None] = value
+
+    def samples(self):
+        if self.function is not None:
+            yield self.name, {}, self.function()
+        else:
+            yield from super().samples()
+
+class Histogram:
+    """ 固定區間的分佈（例如編碼／解碼時間），輸出累計的 bucket、總和與次數 """
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # 最後一格為 +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        """ with histogram.time(): ... 記錄區塊內的執行時間 """
+        return _Timer(self)
+
+    def samples(self):
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += bucket_count
+            yield self.name + '_bucket', {'le': _format_value(bound)}, cumulative
+        yield self.name + '_sum', {}, total
+        yield self.name + '_count', {}, count
+
+class _Timer:
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _register(self, metric):
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError(f"Duplicate metric name: {metric.name}")
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help_text, label=None):
+        return self._register(Counter(name, help_text, label))
+
+    def gauge(self, name, help_text, function=None):
+        return self._register(Gauge(name, help_text, function))
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help_text, buckets))
+
+    def render_prometheus(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                if labels:
+                    label_text = ",".join(f'{key}="{value}"' for key, value in labels.items())
+                    name = f"{name}{{{label_text}}}"
+                lines.append(f"{name} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def render_json(self):
+        result = {}
+        for metric in list(self.metrics.values()):
+            if isinstance(metric, Histogram):
+                samples = list(metric.samples())
+                result[metric.name] = {
+                    'buckets': {labels['le']: value for name, labels, value in samples[:-2]},
+                    'sum': samples[-2][2],
+                    'count': samples[-1][2],
+                }
+            elif metric.label:
+                result[metric.name] = {labels[metric.label]: value for _, labels, value in metric.samples()}
+            else:
+                result[metric.name] = next(metric.samples())[2]
+        return json.dumps(result)
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+REGISTRY = Registry()  # 同一個行程內共用
+
+def start_metrics_server(port, host='127.0.0.1', registry=REGISTRY):
+    """ 在背景執行緒提供 /metrics（Prometheus）與 /metrics.json；port 為 None 時不啟動 """
+    if port is None:
+        return None
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                body, content_type = registry.render_prometheus(), 'text/plain; version=0.0.4'
+            elif self.path == '/metrics.json':
+                body, content_type = registry.render_json(), 'application/json'
+            else:
+                self.send_error(404)
+                return
+            body = body.encode()
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # 不把每次抓取寫進日誌
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"Metrics available at http://{host}:{port}/metrics")
+    return server
+
+class LogRateLimiter:
+    """ 限制逐封包日誌的頻率：每個 key 每 interval 秒最多放行一次
+
+        suppressed = limiter.allow('recv')
+        if suppressed is not None:
+            logging.debug("... (%d similar messages suppressed)", suppressed)
+    """
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.next_allowed = {}  # key -> 下次放行的時間
+        self.suppressed = {}    # key -> 上次放行後略過的次數
+        self.lock = threading.Lock()
+
+    def allow(self, key):
+        """ 放行時回傳期間略過的次數，否則回傳 None（呼叫端不需要格式化訊息） """
+        now = time.monotonic()
+        with self.lock:
+            if now < self.next_allowed.get(key, 0.0):
+                self.suppressed[key] = self.suppressed.get(key, 0) + 1
+                return None
+            self.next_allowed[key] = now + self.interval
+            return self.suppressed.pop(key, 0)
@@ -0,0 +1,117 @@
+import time
+
+# === 發送速率控制 ===
+#
+# token bucket 依目前速率放行封包，取代固定的 sleep 間隔；每個封包依送出順序取得一個編號（packet number，
+# 重送與冗餘封包也各自編號）。接收端定期回報收到的最大編號與累計封包數，兩次回報之間
+# 「最大編號的增量 − 封包數的增量」就是這段期間遺失的封包數，與路徑上仍在傳送中的封包無關。
+#
+# feedback 模式以 AIMD 調整速率：開始時每個沒有遺失的回報把速率乘以 SLOW_START_GAIN，
+# 第一次遺失後改為每個回報加上 ADDITIVE_INCREASE_MBPS；遺失比例超過容忍值時乘以 DECREASE_FACTOR，
+# 且在降速前送出的封包都回報完之前不再降速（同一次壅塞只降一次）。目標速率是上限。
+# 遺失比例以至少 LOSS_WINDOW_PACKETS 個封包計算，低速時一個回報只涵蓋幾十個封包，單一次零星遺失不會造成降速。
+
+PACKET_NUMBER_MODULO = 1 << 32
+START_RATE_MBPS = 8.0         # feedback 模式的起始速率
+MIN_RATE_MBPS = 1.0
+SLOW_START_GAIN = 1.25
+ADDITIVE_INCREASE_MBPS = 2.0
+DECREASE_FACTOR = 0.7
+LOSS_TOLERANCE = 0.01         # 遺失比例不超過此值時不視為壅塞
+LOSS_WINDOW_PACKETS = 256
+BURST_TIME = 0.002            # token bucket 深度（秒）
+SPIN_THRESHOLD = 0.0002       # 距離下次發送小於此時間時改為忙等，避免 sleep 的計時誤差拉低速率
+MIN_BURST_BYTES = 2048        # 額度上限至少能放行一個完整的封包
+
+def pace_wait(deadline):
+    """ 先 sleep 到接近期限，剩下的時間忙等 """
+    remaining = deadline - time.perf_counter()
+    if remaining > SPIN_THRESHOLD:
+        time.sleep(remaining - SPIN_THRESHOLD)
+    while time.perf_counter() < deadline:
+        pass
+
+def _after(a, b):
+    """ 編號 a 是否在 b 之後（考慮 32-bit 迴繞） """
+    return 0 < (a - b) % PACKET_NUMBER_MODULO < PACKET_NUMBER_MODULO // 2
+
+class RateController:
+    """ 單一傳送的速率控制：pace() 依速率放行封包並給予編號，on_progress() 依接收端回報調整速率 """
+
+    def __init__(self, target_mbps, feedback=False, loss_tolerance=LOSS_TOLERANCE):
+        if target_mbps <= 0:
+            raise ValueError("Target rate must be positive")
+        self.max_rate = target_mbps * 1_000_000 / 8  # bytes/s
+        self.min_rate = min(MIN_RATE_MBPS * 1_000_000 / 8, self.max_rate)
+        self.feedback = feedback
+        self.loss_tolerance = loss_tolerance
+        self.rate = min(START_RATE_MBPS * 1_000_000 / 8, self.max_rate) if feedback else self.max_rate
+        self.slow_start = True
+        self.tokens = 0.0
+        self.updated = time.perf_counter()
+        self.throttled = False      # 上次回報後是否曾因額度不足而等待；沒有時表示速率不是瓶頸，不加速
+        self.next_number = 0
+        self.report_highest = None  # 上一次回報的最大編號與封包數
+        self.report_received = 0
+        self.recovery_point = None  # 上次降速時的下一個編號
+        self.window_sent = 0        # 目前遺失統計區間的封包數與遺失數
+        self.window_lost = 0
+        self.lost = 0
+
+    @property
+    def capacity(self):
+        return max(self.rate * BURST_TIME, MIN_BURST_BYTES)
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def pace(self, size):
+        """ 等到額度足以送出 size bytes 後扣除額度，回傳這個封包的編號 """
+        self._refill(time.perf_counter())
+        deficit = size - self.tokens
+        if deficit > 0:
+            self.throttled = True
+            pace_wait(self.updated + deficit / self.rate)
+            self._refill(time.perf_counter())
+        self.tokens -= size
+        number = self.next_number
+        self.next_number = (number + 1) % PACKET_NUMBER_MODULO
+        return number
+
+    def on_progress(self, highest, received):
+        """ 接收端回報：目前收到的最大編號與累計收到的封包數 """
+        if self.report_highest is None:
+            self.report_highest, self.report_received = highest, received
+            return
+        if not _after(highest, self.report_highest):
+            return  # 沒有新封包，或順序顛倒的舊回報
+        sent = (highest - self.report_highest) % PACKET_NUMBER_MODULO
+        arrived = (received - self.report_received) % PACKET_NUMBER_MODULO
+        self.report_highest, self.report_received = highest, received
+        lost = max(0, sent - arrived)  # 亂序到達的封包會讓這次偏高、下次偏低
+        self.lost += lost
+        if not self.feedback:
+            return
+
+        self.window_sent += sent
+        self.window_lost += lost
+        if self.window_lost > max(self.window_sent, LOSS_WINDOW_PACKETS) * self.loss_tolerance:
+            if self.recovery_point is None or _after(highest, self.recovery_point):
+                self.rate = max(self.min_rate, self.rate * DECREASE_FACTOR)
+                self.tokens = min(self.tokens, self.capacity)
+                self.recovery_point = self.next_number
+                self.slow_start = False
+            self.window_sent = self.window_lost = 0
+        elif lost == 0 and self.throttled:
+            if self.slow_start:
+                self.rate *= SLOW_START_GAIN
+            else:
+                self.rate += ADDITIVE_INCREASE_MBPS * 1_000_000 / 8
+            self.rate = min(self.rate, self.max_rate)
+        if self.window_sent >= LOSS_WINDOW_PACKETS:
+            self.window_sent = self.window_lost = 0
+        self.throttled = False
+
+    def describe(self):
+        return f"{self.rate * 8 / 1_000_000:.1f} Mbit/s"
@@ -0,0 +1,203 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import socket
+import struct
+import sys
+import threading
+
+# === 批次 UDP 收發 ===
+#
+# 一次系統呼叫收發多個資料報：Linux 上以 ctypes 呼叫 sendmmsg / recvmmsg，
+# 一個 FEC 區塊（k + m 個封包）只需要一次 sendmmsg；其他平台或非 IPv4 socket 退回逐一 sendto / recvfrom。
+# 兩種實作的介面相同，呼叫端不需要知道實際使用哪一種。
+# send_batch 可由多個執行緒同時呼叫；recv_batch 只能由單一執行緒呼叫。
+
+UDP_IO_AUTO = 'auto'      # 可用時使用 mmsg，否則使用 socket
+UDP_IO_MMSG = 'mmsg'      # sendmmsg / recvmmsg（僅 Linux、IPv4）
+UDP_IO_SOCKET = 'socket'  # 逐一 sendto / recvfrom
+
+MAX_DATAGRAM_SIZE = 65535
+DEFAULT_BATCH = 64
+
+MSG_DONTWAIT = 0x40
+MSG_WAITFORONE = 0x10000
+SOCKADDR_IN = struct.Struct("=H 2s 4s 8x")  # sin_family（主機位元組順序）| sin_port | sin_addr | 補零
+
+class SocketBatchIO:
+    """ 逐一 sendto / recvfrom 的通用實作 """
+    name = UDP_IO_SOCKET
+
+    def __init__(self, sock, max_batch=DEFAULT_BATCH, bufsize=MAX_DATAGRAM_SIZE):
+        self.sock = sock
+        self.max_batch = max_batch
+        self.bufsize = bufsize
+
+    def send_batch(self, packets, addr):
+        """ 把所有封包送往同一個地址，回傳送出的封包數 """
+        for packet in packets:
+            self.sock.sendto(packet, addr)
+        return len(packets)
+
+    def recv_batch(self):
+        """ 依 socket 的逾時設定等待第一個資料報，再取出已在佇列中的資料報（最多 max_batch 個）；
+            回傳 [(data, addr), ...]，沒有資料時與 recvfrom 一樣丟出 socket.timeout / BlockingIOError """
+        batch = [self.sock.recvfrom(self.bufsize)]
+        if not hasattr(socket, 'MSG_DONTWAIT'):
+            return batch
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self.sock.recvfrom(self.bufsize, socket.MSG_DONTWAIT))
+            except BlockingIOError:
+                break
+        return batch
+
+class iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+class msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p), ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(iovec)), ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p), ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", msghdr), ("msg_len", ctypes.c_uint)]
+
+def _load_libc():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        for name in ('sendmmsg', 'recvmmsg'):
+            func = getattr(libc, name)
+            func.restype = ctypes.c_int
+        libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int]
+        libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+_libc = _load_libc()
+
+class MmsgBatchIO(SocketBatchIO):
+    """ 以 sendmmsg / recvmmsg 一次收發整批資料報（Linux、IPv4） """
+    name = UDP_IO_MMSG
+
+    def __init__(self, sock, max_batch=DEFAULT_BATCH, bufsize=MAX_DATAGRAM_SIZE):
+        super().__init__(sock, max_batch, bufsize)
+        self._addresses = {}  # (host, port) -> sockaddr_in
+
+        # 接收緩衝區只配置一次，每個訊息使用固定的一段
+        self._recv_buffer = (ctypes.c_char * (bufsize * max_batch))()
+        self._recv_names = (ctypes.c_char * (SOCKADDR_IN.size * max_batch))()
+        self._recv_iov = (iovec * max_batch)()
+        self._recv_msgs = (mmsghdr * max_batch)()
+        buffer_base = ctypes.addressof(self._recv_buffer)
+        names_base = ctypes.addressof(self._recv_names)
+        for i in range(max_batch):
+            self._recv_iov[i].iov_base = buffer_base + i * bufsize
+            self._recv_iov[i].iov_len = bufsize
+            hdr = self._recv_msgs[i].msg_hdr
+            hdr.msg_name = names_base + i * SOCKADDR_IN.size
+            hdr.msg_iov = ctypes.pointer(self._recv_iov[i])
+            hdr.msg_iovlen = 1
+
+        self._send_lock = threading.Lock()  # 送出用的 iovec / mmsghdr 陣列為共用
+        self._send_iov = (iovec * max_batch)()
+        self._send_msgs = (mmsghdr * max_batch)()
+        for i in range(max_batch):
+            hdr = self._send_msgs[i].msg_hdr
+            hdr.msg_namelen = SOCKADDR_IN.size
+            hdr.msg_iov = ctypes.pointer(self._send_iov[i])
+            hdr.msg_iovlen = 1
+
+    def _sockaddr(self, addr):
+        name = self._addresses.get(addr)
+        if name is None:
+            host, port = addr
+            packed = SOCKADDR_IN.pack(socket.AF_INET, port.to_bytes(2, 'big'),
+                                      socket.inet_aton(socket.gethostbyname(host)))
+            name = ctypes.create_string_buffer(packed, SOCKADDR_IN.size)
+            self._addresses[addr] = name
+        return name
+
+    def _wait(self, for_write):
+        """ socket 有逾時設定時 fd 為非阻塞，先以 select 等待就緒；回傳 False 表示不等待（非阻塞 socket） """
+        timeout = self.sock.gettimeout()
+        if timeout == 0:
+            return False
+        if for_write:
+            ready = select.select([], [self.sock], [], timeout)[1]
+        else:
+            ready = select.select([self.sock], [], [], timeout)[0]
+        if not ready:
+            raise socket.timeout("timed out")
+        return True
+
+    def send_batch(self, packets, addr):
+        with self._send_lock:
+            return self._send_locked(packets, ctypes.addressof(self._sockaddr(addr)))
+
+    def _send_locked(self, packets, name):
+        fd = self.sock.fileno()
+        sent = 0
+        while sent < len(packets):
+            chunk = packets[sent:sent + self.max_batch]
+            keep = []  # 送出前保留 bytes 物件的參考
+            for i, packet in enumerate(chunk):
+                data = packet if isinstance(packet, bytes) else bytes(packet)
+                keep.append(data)
+                self._send_iov[i].iov_base = ctypes.cast(ctypes.c_char_p(data), ctypes.c_void_p)
+                self._send_iov[i].iov_len = len(data)
+                self._send_msgs[i].msg_hdr.msg_name = name
+            count = _libc.sendmmsg(fd, self._send_msgs, len(chunk), 0)
+            if count < 0:
+                err = ctypes.get_errno()
+                if err == errno.EINTR:
+                    continue
+                if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    if not self._wait(for_write=True):
+                        raise BlockingIOError(err, os.strerror(err))
+                    continue
+                raise OSError(err, os.strerror(err))
+            sent += count
+        return sent
+
+    def recv_batch(self):
+        fd = self.sock.fileno()
+        blocking = self.sock.gettimeout() is None
+        while True:
+            for i in range(self.max_batch):
+                self._recv_msgs[i].msg_hdr.msg_namelen = SOCKADDR_IN.size  # 核心會覆寫，每次呼叫前重設
+            count = _libc.recvmmsg(fd, self._recv_msgs, self.max_batch,
+                                   MSG_WAITFORONE if blocking else MSG_DONTWAIT, None)
+            if count >= 0:
+                break
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK) and not blocking:
+                if not self._wait(for_write=False):
+                    raise BlockingIOError(err, os.strerror(err))
+                continue
+            raise OSError(err, os.strerror(err))
+
+        batch = []
+        buffer_base = ctypes.addressof(self._recv_buffer)
+        for i in range(count):
+            name = self._recv_names[i * SOCKADDR_IN.size:(i + 1) * SOCKADDR_IN.size]
+            _, port, host = SOCKADDR_IN.unpack(name)
+            data = ctypes.string_at(buffer_base + i * self.bufsize, self._recv_msgs[i].msg_len)
+            batch.append((data, (socket.inet_ntoa(host), int.from_bytes(port, 'big'))))
+        return batch
+
+def open_batch_io(sock, backend=UDP_IO_AUTO, max_batch=DEFAULT_BATCH, bufsize=MAX_DATAGRAM_SIZE):
+    """ 依設定與平台選擇批次收發的實作；mmsg 不可用時（非 Linux 或非 IPv4）退回 socket """
+    if backend not in (UDP_IO_AUTO, UDP_IO_MMSG, UDP_IO_SOCKET):
+        raise ValueError(f"Unknown UDP I/O backend: {backend}")
+    if backend != UDP_IO_SOCKET and _libc is not None and sock.family == socket.AF_INET:
+        return MmsgBatchIO(sock, max_batch, bufsize)
+    return SocketBatchIO(sock, max_batch, bufsize)
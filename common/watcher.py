@@ -0,0 +1,178 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+# === 上傳資料夾監控 ===
+#
+# Linux 上以 ctypes 呼叫 inotify，檔案寫入後關閉（IN_CLOSE_WRITE）或被移入資料夾（IN_MOVED_TO）時立刻回報，
+# 不需要定期列出資料夾，也不需要逐一等待檔案大小穩定。其他平台或 inotify 無法使用時退回輪詢：
+# 每 POLL_INTERVAL 秒掃描一次，最後修改時間已超過 SETTLE_TIME 秒的檔案視為寫入完成。
+# 啟動時已經在資料夾中的檔案（以及 inotify 事件佇列溢位時）也以同樣的規則判斷。
+# 兩種實作的介面相同：wait() 回傳新就緒的檔案路徑，同一個檔案（大小與修改時間不變）只回報一次。
+# 以 . 開頭的檔案視為寫入中的暫存檔（例如 rsync、先寫暫存檔再改名的程式），不回報。
+
+WATCH_AUTO = 'auto'        # 可用時使用 inotify，否則輪詢
+WATCH_INOTIFY = 'inotify'
+WATCH_POLL = 'poll'
+
+POLL_INTERVAL = 1.0
+SETTLE_TIME = 1.0
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+INOTIFY_EVENT = struct.Struct("=iIII")  # wd | mask | cookie | len，後接 len bytes 的檔名（補零）
+
+def _load_libc():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_init1.restype = ctypes.c_int
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_add_watch.restype = ctypes.c_int
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+_libc = _load_libc()
+
+class PollWatcher:
+    """ 定期掃描資料夾，修改時間已超過 settle_time 秒的檔案視為寫入完成 """
+    name = WATCH_POLL
+
+    def __init__(self, path, poll_interval=POLL_INTERVAL, settle_time=SETTLE_TIME):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+        self.reported = {}  # 檔名 -> 回報時的 (大小, 修改時間)
+        self.settling = 0   # 上次掃描時修改時間仍太新、尚未回報的檔案數
+        self.next_scan = 0.0
+
+    def wait(self):
+        """ 等到下一次掃描，回傳新就緒的檔案路徑 """
+        delay = self.next_scan - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        self.next_scan = time.monotonic() + self.poll_interval
+        return self.scan()
+
+    def scan(self):
+        ready = []
+        present = set()
+        self.settling = 0
+        now = time.time()
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                try:
+                    if not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                present.add(entry.name)
+                state = (stat.st_size, stat.st_mtime_ns)
+                if self.reported.get(entry.name) == state:
+                    continue
+                if now - stat.st_mtime < self.settle_time:
+                    self.settling += 1
+                    continue
+                self.reported[entry.name] = state
+                ready.append(entry.path)
+        for name in set(self.reported) - present:
+            del self.reported[name]  # 已移走的檔案，之後同名的新檔案會再回報
+        return ready
+
+    def close(self):
+        pass
+
+class InotifyWatcher(PollWatcher):
+    """ 以 inotify 接收寫入完成與移入事件；啟動時已存在的檔案沿用輪詢的規則，直到全部就緒 """
+    name = WATCH_INOTIFY
+
+    def __init__(self, path, poll_interval=POLL_INTERVAL, settle_time=SETTLE_TIME):
+        super().__init__(path, poll_interval, settle_time)
+        self.fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        if _libc.inotify_add_watch(self.fd, os.fsencode(path), IN_CLOSE_WRITE | IN_MOVED_TO | IN_ONLYDIR) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, os.strerror(err), path)
+        self.rescan = True  # 需要以輪詢規則檢查資料夾（啟動時、事件佇列溢位後、仍有檔案尚未穩定時）
+
+    def wait(self):
+        """ 等待事件（仍需檢查既有檔案時最多等 poll_interval 秒），回傳新就緒的檔案路徑 """
+        ready = []
+        if self.rescan:
+            ready = self.scan()
+            if ready:
+                return ready
+        timeout = self.poll_interval if self.rescan else None
+        if select.select([self.fd], [], [], timeout)[0]:
+            ready = self.read_events()
+        return ready
+
+    def scan(self):
+        ready = super().scan()
+        self.rescan = self.settling > 0  # 還有修改時間太新的檔案時之後繼續掃描（寫入完成時通常也會收到事件）
+        return ready
+
+    def read_events(self):
+        ready = []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return ready
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            _, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                self.rescan = True  # 事件遺失，改以掃描補上
+            elif mask & IN_IGNORED:
+                raise OSError(f"Watched folder was removed: {self.path}")
+            elif name and not name.startswith('.'):
+                path = os.path.join(self.path, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                state = (stat.st_size, stat.st_mtime_ns)
+                if self.reported.get(name) != state and path not in ready:
+                    self.reported[name] = state
+                    ready.append(path)
+        if self.rescan:
+            ready.extend(path for path in self.scan() if path not in ready)
+        return ready
+
+    def close(self):
+        os.close(self.fd)
+
+def open_watcher(path, backend=WATCH_AUTO, poll_interval=POLL_INTERVAL, settle_time=SETTLE_TIME):
+    """ 依設定與平台選擇監控方式；inotify 不可用時退回輪詢 """
+    if backend not in (WATCH_AUTO, WATCH_INOTIFY, WATCH_POLL):
+        raise ValueError(f"Unknown watcher backend: {backend}")
+    if backend != WATCH_POLL and _libc is not None:
+        try:
+            return InotifyWatcher(path, poll_interval, settle_time)
+        except OSError:
+            if backend == WATCH_INOTIFY:
+                raise
+    elif backend == WATCH_INOTIFY:
+        raise OSError("inotify is not available on this platform")
+    return PollWatcher(path, poll_interval, settle_time)
@@ -0,0 +1,86 @@
+import logging
+import multiprocessing
+import socket
+import time
+
+# === SO_REUSEPORT 多行程工作模式 ===
+#
+# 每個工作行程各自以 SO_REUSEPORT 綁定同一個埠，核心依來源位址（4-tuple）把封包分配到固定的行程，
+# 同一個來源的封包（也就是同一個 FEC 區塊的所有封包）都由同一個行程處理，行程之間不需要共用狀態。
+# 監督行程只負責啟動工作行程，並在工作行程結束時重新啟動。
+
+SUPERVISOR_INTERVAL = 0.5  # 檢查工作行程是否存活的間隔
+MIN_UPTIME = 5.0           # 存活時間短於此值就結束的行程視為持續崩潰，延後重新啟動
+MAX_RESTART_DELAY = 30.0
+
+def bind_reuseport(sock, address):
+    """ 以 SO_REUSEPORT 綁定，讓多個工作行程共用同一個埠 """
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise OSError("SO_REUSEPORT is not supported on this platform")
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(address)
+
+class Supervisor:
+    """ 啟動 count 個執行 target(worker_index) 的工作行程，結束的行程會被重新啟動 """
+
+    def __init__(self, target, count):
+        self.target = target
+        self.count = count
+        self.context = multiprocessing.get_context('fork')  # 工作行程沿用已載入的設定與模組
+        self.processes = {}      # worker_index -> Process
+        self.started = {}        # worker_index -> 啟動時間
+        self.restart_at = {}     # worker_index -> 延後重新啟動的時間
+        self.restart_delay = {}  # worker_index -> 目前的延後秒數（持續崩潰時加倍）
+
+    def start(self, index):
+        process = self.context.Process(target=self.target, args=(index,), name=f"worker-{index}")
+        process.start()
+        self.processes[index] = process
+        self.started[index] = time.monotonic()
+        logging.info(f"工作行程 {index} 已啟動 (pid {process.pid})")
+
+    def run(self):
+        for index in range(self.count):
+            self.start(index)
+        try:
+            while True:
+                time.sleep(SUPERVISOR_INTERVAL)
+                self.check(time.monotonic())
+        except KeyboardInterrupt:
+            logging.info("正在停止工作行程...")
+        finally:
+            self.stop()
+
+    def check(self, now):
+        for index in range(self.count):
+            process = self.processes.get(index)
+            if process is not None and process.is_alive():
+                continue
+            if process is not None:
+                process.join()
+                uptime = now - self.started[index]
+                delay = 0.0
+                if uptime < MIN_UPTIME:
+                    delay = min(max(self.restart_delay.get(index, 0.0) * 2, SUPERVISOR_INTERVAL), MAX_RESTART_DELAY)
+                self.restart_delay[index] = delay
+                self.restart_at[index] = now + delay
+                self.processes[index] = None
+                logging.warning(f"工作行程 {index} (pid {process.pid}) 結束，代碼 {process.exitcode}，"
+                                f"{delay:.1f} 秒後重新啟動")
+            if now >= self.restart_at.get(index, 0.0):
+                self.start(index)
+
+    def stop(self):
+        for process in self.processes.values():
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self.processes.values():
+            if process is not None:
+                process.join(timeout=5)
+
+def run_workers(target, count):
+    """ count <= 1 時直接在目前行程執行 target(0)，否則啟動監督行程 """
+    if count <= 1:
+        target(0)
+    else:
+        Supervisor(target, count).run()
@@ -0,0 +1,113 @@
+import threading
+import time
+from math import comb
+from protocol import BLOCK_ID_MODULO, MAX_BLOCK_PACKETS
+
+# === 依解碼端回報的遺失狀況調整 (k, m) ===
+
+class LossMonitor:
+    """ 解碼端：統計每個區塊實際收到哪些封包，整理成遺失率與連續遺失（burst）長度 """
+
+    def __init__(self):
+        self.next_block = None  # 預期下一個結算的 block_id，用來找出整個遺失的區塊
+        self.reset()
+
+    def reset(self):
+        self.expected = 0   # 本期應收到的封包數
+        self.lost = 0       # 本期遺失的封包數
+        self.bursts = 0     # 本期連續遺失的次數
+        self.max_burst = 0  # 本期最長的連續遺失
+
+    def block_settled(self, block_id, k, m, received_mask):
+        """ 區塊已過等待期限，不會再有封包到達時呼叫；received_mask 的第 i 位代表 index i 已收到 """
+        n = k + m
+        if self.next_block is not None:
+            gap = (block_id - self.next_block) % BLOCK_ID_MODULO
+            if 0 < gap < BLOCK_ID_MODULO // 2:
+                # 中間的區塊一個封包都沒收到，以目前區塊的大小估算
+                self._add_burst(gap * n)
+                self.expected += gap * n
+                self.lost += gap * n
+            if gap >= BLOCK_ID_MODULO // 2:
+                block_id = self.next_block - 1  # 遲到的舊區塊，不回退結算位置
+        self.next_block = (block_id + 1) % BLOCK_ID_MODULO
+
+        run = 0
+        for index in range(n):
+            if received_mask >> index & 1:
+                if run:
+                    self._add_burst(run)
+                run = 0
+            else:
+                run += 1
+                self.lost += 1
+        if run:
+            self._add_burst(run)
+        self.expected += n
+
+    def _add_burst(self, length):
+        self.bursts += 1
+        self.max_burst = max(self.max_burst, length)
+
+    def take_report(self):
+        """ 回傳 (expected, lost, bursts, max_burst) 並開始新一期統計 """
+        report = (self.expected, self.lost, self.bursts, self.max_burst)
+        self.reset()
+        return report
+
+def block_failure_probability(k, m, loss_rate):
+    """ 每個封包獨立以 loss_rate 遺失時，k + m 個封包中遺失超過 m 個（區塊無法還原）的機率 """
+    n = k + m
+    return sum(comb(n, i) * loss_rate ** i * (1 - loss_rate) ** (n - i) for i in range(m + 1, n + 1))
+
+class FecController:
+    """ 編碼端：依回報的遺失率與 burst 長度，在設定範圍內為每個新區塊選擇 (k, m) """
+
+    def __init__(self, k, m, k_min, k_max, m_min, m_max, target_failure, feedback_timeout, smoothing=0.3):
+        self.default = (k, m)
+        self.k_min, self.k_max = k_min, k_max
+        self.m_min, self.m_max = m_min, m_max
+        self.target_failure = target_failure      # 區塊無法還原的目標機率
+        self.feedback_timeout = feedback_timeout  # 太久沒有回報時回到預設值
+        self.smoothing = smoothing                # 遺失率的指數移動平均權重
+        self.loss_rate = None
+        self.max_burst = 0
+        self.params = (k, m)
+        self.last_report = None
+        self.lock = threading.Lock()
+
+    def current(self):
+        """ 新區塊使用的 (k, m) """
+        with self.lock:
+            if self.last_report is not None and time.monotonic() - self.last_report > self.feedback_timeout:
+                self.params = self.default
+                self.loss_rate = None
+                self.last_report = None
+            return self.params
+
+    def update(self, expected, lost, bursts, max_burst):
+        """ 收到解碼端的回報 """
+        if not expected:
+            return self.params
+        with self.lock:
+            rate = lost / expected
+            if self.loss_rate is None:
+                self.loss_rate = rate
+            else:
+                self.loss_rate = self.smoothing * rate + (1 - self.smoothing) * self.loss_rate
+            self.max_burst = max_burst
+            self.last_report = time.monotonic()
+            self.params = self._choose(self.loss_rate, max_burst)
+            return self.params
+
+    def _choose(self, loss_rate, max_burst):
+        # 盡量維持最大的 k（冗餘比例最低），冗餘不夠時才縮小區塊
+        for k in range(self.k_max, self.k_min - 1, -1):
+            for m in range(self.m_min, self.m_max + 1):
+                if k + m > MAX_BLOCK_PACKETS:
+                    break
+                if m < min(max_burst, self.m_max):
+                    continue  # 至少能補回一次觀察到的連續遺失
+                if block_failure_probability(k, m, loss_rate) <= self.target_failure:
+                    return k, m
+        return self.k_min, min(self.m_max, MAX_BLOCK_PACKETS - self.k_min)
@@ -1,117 +1,316 @@
+import os
+import sys
 import socket
 import logging
-import reedsolo
-import struct
+import time
+from collections import OrderedDict, deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.erasure import get_codec, ErasureDecodeError  # 封包層級 (k, m) 抹除碼
+from protocol import FEC_HEADER, FEEDBACK_MAGIC, FEEDBACK_REPORT, is_fragment, unpack_fragment, unpack_symbol
+from adaptive import LossMonitor
+from common.udpio import open_batch_io, UDP_IO_AUTO
+from common.workers import bind_reuseport, run_workers
+from common.metrics import REGISTRY, LogRateLimiter, start_metrics_server
 
 # === 設定 ===
 UDP_LISTEN_IP = '0.0.0.0'
 UDP_LISTEN_PORT = 7000
-FEC_ORIGINAL_PACKETS = 2
-FEC_REDUNDANT_PACKETS = 1
+# FEC 參數 (k, m) 由每個區塊的標頭帶入
+
+# 解碼窗口
+MAX_OPEN_BLOCKS = 32          # 同時組裝中的區塊上限
+BLOCK_TIMEOUT = 0.5           # 區塊從收到第一個封包起最多等待的秒數
+FINISHED_BLOCK_HISTORY = 1024 # 記住最近完成的區塊，丟棄遲到的冗餘封包
+CUT_THROUGH = True            # 原始封包收到就立即轉發，冗餘封包只用來重建遺失的原始封包（須與編碼端相同）
+UDP_IO_BACKEND = UDP_IO_AUTO  # UDP_IO_AUTO：Linux 上以 recvmmsg / sendmmsg 批次收發；UDP_IO_SOCKET：逐一 recvfrom / sendto
+METRICS_PORT = 9101           # 本機統計端點 /metrics、/metrics.json（多行程時為 METRICS_PORT + 行程編號）；None 表示不啟動
+LOG_INTERVAL = 1.0            # 逐封包／逐區塊的日誌每秒最多一筆
+WORKERS = 1                   # > 1 時以 SO_REUSEPORT 啟動多個工作行程，核心依來源分配封包
+
+# 遺失回報（讓編碼端調整 (k, m)），送回各來源的發送位址
+ADAPTIVE_FEEDBACK = True
+REPORT_INTERVAL = 1.0         # 回報間隔（秒）
 
 # 轉發目標設定
 UDP_FORWARD_IP = '192.168.1.94'
 UDP_FORWARD_PORT = 5000
 
-# 初始化 Reed-Solomon 編碼器
-fec = reedsolo.RSCodec(FEC_REDUNDANT_PACKETS)
-
 # 設定日誌
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+udp_socket = udp_io = None          # 監聽 socket，於工作行程內建立
+forward_socket = forward_io = None  # 用於轉發的 socket（也用來送出遺失回報）
+
+def open_sockets(reuse_port):
+    global udp_socket, udp_io, forward_socket, forward_io
+    # 建立 socket 並綁定到監聽地址
+    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if reuse_port:
+        bind_reuseport(udp_socket, (UDP_LISTEN_IP, UDP_LISTEN_PORT))
+    else:
+        udp_socket.bind((UDP_LISTEN_IP, UDP_LISTEN_PORT))
+    forward_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp_io = open_batch_io(udp_socket, UDP_IO_BACKEND)
+    forward_io = open_batch_io(forward_socket, UDP_IO_BACKEND)
+
+# === 解碼窗口：同時保留多個尚未完成的區塊 ===
+class DecodeBlock:
+    """ 單一 FEC 區塊的接收狀態 """
+    __slots__ = ('k', 'm', 'packets', 'packet_size', 'forwarded', 'fragments', 'received_mask', 'created')
+
+    def __init__(self, k, m, now):
+        self.k = k
+        self.m = m
+        self.packets = {}  # index -> payload（未補零）
+        self.packet_size = 0  # 區塊內最長的封包 = 編碼時補齊的長度（冗餘封包一定是這個長度）
+        self.forwarded = set()  # 直通模式下已轉發的原始封包 index，避免還原後重複轉發
+        self.fragments = {}  # index -> (分段序號, 是否還有後續分段, 內容)，等待同一個資料報的其他分段
+        self.received_mask = 0  # 第 i 位代表 index i 已收到（含解碼後才到的封包），供遺失統計
+        self.created = now
+
+# 區塊以 (來源位址, block_id) 區分：多個編碼端（或編碼端的多個工作行程）的區塊編號各自獨立
+open_blocks = OrderedDict()      # (來源, block_id) -> DecodeBlock，依第一次收到的順序
+finished_blocks = OrderedDict()  # 最近完成或放棄的 (來源, block_id) -> DecodeBlock，用來丟棄遲到的封包
+unsettled_blocks = deque()       # ((來源, block_id), DecodeBlock)，等待期限過後結算遺失統計
+loss_monitors = {}               # 來源 -> LossMonitor
+forward_queue = []               # 本批收到的封包還原出的資料報，處理完整批後一次轉發
+feedback_state = {'seq': 0, 'next_report': time.monotonic() + REPORT_INTERVAL}
+
+# === 統計 ===
+packets_in = REGISTRY.counter('fecudp_decoder_packets_in_total', 'FEC packets received from the encoder')
+packets_dropped = REGISTRY.counter('fecudp_decoder_packets_dropped_total', 'FEC packets dropped, by reason', label='reason')
+datagrams_out = REGISTRY.counter('fecudp_decoder_datagrams_out_total', 'Datagrams forwarded to the application')
+blocks_decoded = REGISTRY.counter('fecudp_decoder_blocks_decoded_total', 'FEC blocks completed with k packets')
+blocks_recovered = REGISTRY.counter('fecudp_decoder_blocks_recovered_total', 'FEC blocks that needed parity to rebuild data')
+packets_recovered = REGISTRY.counter('fecudp_decoder_packets_recovered_total', 'Data packets rebuilt from parity')
+blocks_failed = REGISTRY.counter('fecudp_decoder_blocks_failed_total', 'FEC blocks given up with data still missing')
+decode_seconds = REGISTRY.histogram('fecudp_decoder_decode_seconds', 'Time spent decoding one block')
+REGISTRY.gauge('fecudp_decoder_open_blocks', 'Blocks waiting for more packets', lambda: len(open_blocks))
+log_limiter = LogRateLimiter(LOG_INTERVAL)
+
+def forward_block(block_id, block):
+    """ 解碼並轉發一個已收到 k 個封包的區塊 """
+    try:
+        # 任意 k 個封包即可還原所有原始封包（index < k 為原始封包，其餘為冗餘封包）
+        with decode_seconds.time():
+            symbols = get_codec(block.k, block.m).decode(block.packets, block.packet_size)
+        missing = sum(1 for index in range(block.k) if index not in block.packets)
+        if missing:
+            blocks_recovered.inc()
+            packets_recovered.inc(missing)
+
+        # === 依長度資訊還原並轉發原本的資料報 ===
+        for index, symbol in enumerate(symbols):
+            forward_symbol(block, index, symbol)
+
+    except ErasureDecodeError as e:
+        blocks_failed.inc()
+        logging.error(f"❌ 區塊 {block_id} FEC 解碼失敗: {e}")
+
+def forward_symbol(block, index, symbol):
+    """ 取出符號內的資料報並逐一轉發，補零的部分會被丟棄；分段符號等所有分段到齊後組回再轉發 """
+    try:
+        if is_fragment(symbol):
+            collect_fragment(block, index, *unpack_fragment(symbol))
+            return
+        datagrams = unpack_symbol(symbol)
+    except ValueError as e:
+        packets_dropped.inc(label_value='malformed')
+        suppressed = log_limiter.allow('malformed')
+        if suppressed is not None:
+            logging.error(f"❌ 符號格式錯誤，丟棄: {e}（略過 {suppressed} 筆相同記錄）")
+        return
+    forward_queue.extend(datagrams)
+
+def collect_fragment(block, index, part, more, piece):
+    """ 分段位於同一個區塊連續的 index（第 0 段在 index - part）；全部到齊時組回資料報 """
+    block.fragments[index] = (part, more, piece)
+    first = index - part
+    pieces = []
+    while True:
+        fragment = block.fragments.get(first + len(pieces))
+        if fragment is None or fragment[0] != len(pieces):
+            return  # 還有分段沒到（遺失的會在區塊還原時補上）
+        pieces.append(fragment[2])
+        if not fragment[1]:
+            break
+    for i in range(first, first + len(pieces)):
+        del block.fragments[i]
+    forward_queue.append(b"".join(pieces))
 
-# 建立 socket 並綁定到監聽地址
-udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-udp_socket.bind((UDP_LISTEN_IP, UDP_LISTEN_PORT))
+def flush_forward():
+    """ 以一次批次呼叫轉發佇列中的資料報 """
+    if not forward_queue:
+        return
+    try:
+        datagrams_out.inc(forward_io.send_batch(forward_queue, (UDP_FORWARD_IP, UDP_FORWARD_PORT)))
+    finally:
+        forward_queue.clear()
 
-# 建立用於轉發的 socket
-forward_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+def recover_missing(block_id, block):
+    """ 直通模式：只重建並轉發尚未轉發的原始封包 """
+    try:
+        with decode_seconds.time():
+            recovered = get_codec(block.k, block.m).recover(block.packets, block.packet_size)
+    except ErasureDecodeError as e:
+        blocks_failed.inc()
+        logging.error(f"❌ 區塊 {block_id} FEC 解碼失敗: {e}")
+        return
+    for index in sorted(recovered):
+        if index not in block.forwarded:
+            block.forwarded.add(index)
+            forward_symbol(block, index, recovered[index])
+    if recovered:
+        blocks_recovered.inc()
+        packets_recovered.inc(len(recovered))
+        suppressed = log_limiter.allow('recovered')
+        if suppressed is not None:
+            logging.info(f"🩹 區塊 {block_id} 以冗餘封包還原 {len(recovered)} 個遺失的封包（略過 {suppressed} 筆相同記錄）")
 
-# === 儲存封包的緩存 ===
-packets = {}
-packet_size = None
+def finish_block(key):
+    block = open_blocks.pop(key)
+    block.packets = {}  # 已完成的區塊只保留統計用的資訊
+    block.fragments = {}
+    finished_blocks[key] = block
+    if len(finished_blocks) > FINISHED_BLOCK_HISTORY:
+        finished_blocks.popitem(last=False)
+
+def evict_expired_blocks(now):
+    """ 逾時或超出窗口的區塊直接放棄，不影響後續區塊 """
+    while open_blocks:
+        key, block = next(iter(open_blocks.items()))
+        if now - block.created < BLOCK_TIMEOUT and len(open_blocks) <= MAX_OPEN_BLOCKS:
+            break
+        block_id = key[1]
+        blocks_failed.inc()
+        suppressed = log_limiter.allow('expired')
+        if suppressed is not None:
+            logging.warning(f"⌛ 區塊 {block_id} 逾時，只收到 {len(block.packets)}/{block.k} 個所需封包，放棄"
+                            f"（略過 {suppressed} 筆相同記錄）")
+        finish_block(key)
+
+def settle_blocks(now):
+    """ 等待期限已過的區塊不會再有封包到達，將實際收到的封包計入遺失統計 """
+    while unsettled_blocks and now - unsettled_blocks[0][1].created >= BLOCK_TIMEOUT:
+        (addr, block_id), block = unsettled_blocks.popleft()
+        monitor = loss_monitors.get(addr)
+        if monitor is None:
+            monitor = loss_monitors[addr] = LossMonitor()
+        monitor.block_settled(block_id, block.k, block.m, block.received_mask)
+
+def send_feedback(now):
+    """ 定期把本期的遺失率與連續遺失長度回報給各來源（編碼端的發送 socket） """
+    if now < feedback_state['next_report']:
+        return
+    feedback_state['next_report'] = now + REPORT_INTERVAL
+    for addr, monitor in list(loss_monitors.items()):
+        expected, lost, bursts, max_burst = monitor.take_report()
+        if not expected:
+            del loss_monitors[addr]  # 本期沒有資料的來源不再追蹤
+            continue
+        feedback_state['seq'] += 1
+        report = FEEDBACK_REPORT.pack(FEEDBACK_MAGIC, feedback_state['seq'], expected, lost, bursts, min(max_burst, 0xFFFF))
+        forward_socket.sendto(report, addr)
+        logging.info(f"📊 回報 {addr}: {lost}/{expected} 封包遺失，{bursts} 次連續遺失，最長 {max_burst}")
+
+def housekeeping(now):
+    evict_expired_blocks(now)
+    settle_blocks(now)
+    if ADAPTIVE_FEEDBACK:
+        send_feedback(now)
+
+def handle_datagram(data, addr, now):
+    if len(data) < FEC_HEADER.size:
+        packets_dropped.inc(label_value='short')
+        return
+
+    # 解析區塊編號、區塊內序號與此區塊的 (k, m)
+    block_id, index, k, m = FEC_HEADER.unpack_from(data)
+    payload = data[FEC_HEADER.size:]
+
+    if k == 0 or index >= k + m:
+        packets_dropped.inc(label_value='invalid')
+        suppressed = log_limiter.allow('invalid')
+        if suppressed is not None:
+            logging.warning(f"來自 {addr} 的封包序號 {index} 超出範圍 (k={k}, m={m})，丟棄（略過 {suppressed} 筆相同記錄）")
+        return
+    key = (addr, block_id)
+
+    finished = finished_blocks.get(key)
+    if finished is not None:
+        finished.received_mask |= 1 << index
+        packets_dropped.inc(label_value='late')
+        return
+
+    block = open_blocks.get(key)
+    if block is None:
+        block = DecodeBlock(k, m, now)
+        open_blocks[key] = block
+        unsettled_blocks.append((key, block))
+    if index in block.packets:
+        packets_dropped.inc(label_value='duplicate')
+        return
+
+    # 儲存封包 (使用區塊內序號來存取)；解碼時再補零到區塊內最長的封包
+    block.received_mask |= 1 << index
+    block.packets[index] = payload
+    block.packet_size = max(block.packet_size, len(payload))
+
+    # === 直通模式：原始封包立即轉發（補充用的空符號沒有資料報） ===
+    if CUT_THROUGH and index < block.k:
+        block.forwarded.add(index)
+        forward_symbol(block, index, payload)
+
+    # === 任意 k 個封包到齊就立即解碼，不必等全部冗餘封包 ===
+    if len(block.packets) >= block.k:
+        blocks_decoded.inc()
+        if CUT_THROUGH:
+            recover_missing(block_id, block)
+        else:
+            forward_block(block_id, block)
+        finish_block(key)
 
 # === 解碼處理 ===
 def handle_udp_packet():
-    global packet_size
-    logging.info("等待封包中...")
-    
+    logging.info(f"等待封包中（{udp_io.name} 批次收發）...")
+    udp_socket.settimeout(min(BLOCK_TIMEOUT, REPORT_INTERVAL) / 2)  # 沒有封包時也定期清理逾時區塊與回報
+
     while True:
         try:
-            data, addr = udp_socket.recvfrom(4096)
-            logging.info(f"✔️ 收到來自 {addr} 的封包，大小: {len(data)} bytes")
-
-            if len(data) < 4:
-                logging.warning("封包長度過短，丟棄該封包")
-                continue
-
-            # 解析序號 (使用前 4 個 bytes 作為序號)
-            seq_num = struct.unpack('!I', data[:4])[0]
-            payload = data[4:]
-
-            # === 新一輪開始時設定封包長度 ===
-            if packet_size is None:
-                packet_size = len(payload)
-                logging.debug(f"設定封包大小為: {packet_size} bytes")
-
-            # === 調整封包長度（補齊或截斷） ===
-            if len(payload) < packet_size:
-                padding = packet_size - len(payload)
-                payload += b'\x00' * padding
-                logging.debug(f"封包長度不足，補齊 {padding} bytes")
-            elif len(payload) > packet_size:
-                payload = payload[:packet_size]
-                logging.debug(f"封包長度超出，截斷至 {packet_size} bytes")
-
-            # 儲存封包 (使用序號來存取)
-            packets[seq_num] = payload
-            logging.debug(f"封包序號: {seq_num}, 當前緩存封包數量: {len(packets)}")
-
-            # === 當封包數量達到 FEC 原始封包 + 冗餘封包時觸發解碼 ===
-            if len(packets) >= FEC_ORIGINAL_PACKETS + FEC_REDUNDANT_PACKETS:
-                try:
-                    logging.info("🔎 收集到足夠封包，開始進行 FEC 解碼...")
-
-                    # 根據序號排序，僅提取 payload
-                    sorted_packets = [packets[i] for i in sorted(packets.keys())]
-                    encoded_data = b"".join(sorted_packets)
-
-                    # 嘗試進行 Reed-Solomon 解碼
-                    decoded_result = fec.decode(encoded_data)
-                    decoded_data = decoded_result[0] if isinstance(decoded_result, tuple) else decoded_result
-
-                    # === 修正重點：解碼後自動截斷至原始封包長度 ===
-                    decoded_data = decoded_data[:FEC_ORIGINAL_PACKETS * packet_size]
-
-                    logging.info(f"✅ 解碼成功，原始數據大小: {len(decoded_data)} bytes")
-
-                    # === 轉發解碼後的封包 ===
-                    if len(decoded_data) > 1472:
-                        for i in range(0, len(decoded_data), 1472):
-                            forward_socket.sendto(decoded_data[i:i + 1472], (UDP_FORWARD_IP, UDP_FORWARD_PORT))
-                            logging.debug(f"已轉發封包切片: {i}-{i + 1472} bytes")
-                    else:
-                        forward_socket.sendto(decoded_data, (UDP_FORWARD_IP, UDP_FORWARD_PORT))
-                        logging.debug(f"已轉發完整封包，大小: {len(decoded_data)} bytes")
-
-                    logging.info(f"✅ 成功轉發封包至 {UDP_FORWARD_IP}:{UDP_FORWARD_PORT}")
-
-                    # === ✅ 清空快取並重置封包長度 ===
-                    packets.clear()
-                    packet_size = None  # 清空封包大小，準備新的 FEC 批次
-
-                except reedsolo.ReedSolomonError as e:
-                    logging.error(f"❌ FEC 解碼失敗: {e}")
-                    packets.clear()
-                    packet_size = None  # 清空封包大小，準備新的 FEC 批次
+            received = udp_io.recv_batch()  # 一次取出所有已到達的資料報
+            packets_in.inc(len(received))
+        except socket.timeout:
+            housekeeping(time.monotonic())
+            continue
+        except Exception as e:
+            logging.error(f"❗ 收包時發生錯誤: {e}")
+            continue
 
+        now = time.monotonic()
+        for data, addr in received:
+            try:
+                handle_datagram(data, addr, now)
+            except Exception as e:
+                logging.error(f"❗ 收包或解碼過程中發生錯誤: {e}")
+        try:
+            flush_forward()  # 本批還原出的資料報一次轉發
+            housekeeping(now)
         except Exception as e:
-            logging.error(f"❗ 收包或解碼過程中發生錯誤: {e}")
+            logging.error(f"❗ 轉發時發生錯誤: {e}")
+
+def run_worker(worker_index):
+    """ 單一解碼行程；多行程模式下每個工作行程各自建立 socket 與解碼窗口 """
+    open_sockets(reuse_port=WORKERS > 1)
+    start_metrics_server(None if METRICS_PORT is None else METRICS_PORT + worker_index)
+    logging.info(f"🚀 工作行程 {worker_index} 正在監聽 {UDP_LISTEN_IP}:{UDP_LISTEN_PORT}...")
+    try:
+        handle_udp_packet()
+    except KeyboardInterrupt:
+        logging.info("🛑 關閉解碼器...")
+        udp_socket.close()
+        forward_socket.close()
 
 # 啟動解碼器
-logging.info(f"🚀 正在監聽 {UDP_LISTEN_IP}:{UDP_LISTEN_PORT}...")
-try:
-    handle_udp_packet()
-except KeyboardInterrupt:
-    logging.info("🛑 關閉解碼器...")
-    udp_socket.close()
-    forward_socket.close()
+if __name__ == '__main__':
+    run_workers(run_worker, WORKERS)
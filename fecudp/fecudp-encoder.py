@@ -1,13 +1,22 @@
+import os
+import sys
 import socket
 import threading
 import time
 import logging
-import reedsolo
-import struct
-import copy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.erasure import get_codec  # 封包層級 (k, m) 抹除碼
+from common.udpio import open_batch_io, UDP_IO_AUTO
+from common.workers import bind_reuseport, run_workers
+from common.metrics import REGISTRY, LogRateLimiter, start_metrics_server
+from protocol import (FEC_HEADER, SYMBOL_COUNT, DATAGRAM_LENGTH, BLOCK_ID_MODULO, MAX_BLOCK_PACKETS, MAX_SYMBOL_SIZE,
+                      MAX_FRAGMENT_SIZE, MAX_DATAGRAMS_PER_SYMBOL, FEEDBACK_MAGIC, FEEDBACK_REPORT, pack_fragments,
+                      pack_symbol)
+from adaptive import FecController
 
 # 設定日誌輸出
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 # === 設定 ===
 UDP_LISTEN_IP = '0.0.0.0'
@@ -15,130 +24,285 @@ UDP_LISTEN_PORT = 5000
 UDP_FORWARD_IP = '172.16.1.92'
 UDP_FORWARD_PORT = 7000
 
-# FEC 參數
+# FEC 參數（開啟自適應時為初始值，沒有回報時也回到這組）
 FEC_ORIGINAL_PACKETS = 2
 FEC_REDUNDANT_PACKETS = 1
-FEC_BATCH_SIZE = FEC_ORIGINAL_PACKETS
 FEC_TIMEOUT = 0.1
+CUT_THROUGH = True  # 原始封包收到就立即送出，區塊結束時只補送冗餘封包（不再等整個區塊）
+PACK_DATAGRAMS = False  # 將多個小資料報打包進同一個 FEC 符號（最多 MAX_SYMBOL_SIZE），減少補零與標頭浪費
+UDP_IO_BACKEND = UDP_IO_AUTO  # UDP_IO_AUTO：Linux 上以 recvmmsg / sendmmsg 批次收發；UDP_IO_SOCKET：逐一 recvfrom / sendto
+METRICS_PORT = 9100  # 本機統計端點 /metrics、/metrics.json（多行程時為 METRICS_PORT + 行程編號）；None 表示不啟動
+LOG_INTERVAL = 1.0  # 逐封包／逐區塊的日誌每秒最多一筆
+WORKERS = 1  # > 1 時以 SO_REUSEPORT 啟動多個工作行程，核心依來源分配封包；每個行程各自編號區塊並由自己的 socket 送出
+
+# 自適應 FEC：依解碼端回報的遺失率與連續遺失長度，為每個新區塊選擇 (k, m)
+# 解碼端把回報送回 FEC 封包的來源，也就是各行程的轉發 socket
+ADAPTIVE_FEC = True
+FEC_K_MIN, FEC_K_MAX = 2, 16
+FEC_M_MIN, FEC_M_MAX = 1, 8
+TARGET_BLOCK_FAILURE = 1e-3   # 區塊無法還原的目標機率
+FEEDBACK_TIMEOUT = 5.0        # 超過此時間沒有回報就回到初始 (k, m)
+
+controller = None  # FecController，於工作行程啟動時依上面的設定建立
+
+# === 統計 ===
+packets_in = REGISTRY.counter('fecudp_encoder_packets_in_total', 'Datagrams received from the application')
+packets_out = REGISTRY.counter('fecudp_encoder_packets_out_total', 'FEC packets sent to the decoder')
+datagrams_split = REGISTRY.counter('fecudp_encoder_datagrams_split_total', 'Datagrams sent as several fragment symbols')
+blocks_encoded = REGISTRY.counter('fecudp_encoder_blocks_encoded_total', 'FEC blocks encoded')
+block_flushes = REGISTRY.counter('fecudp_encoder_block_flushes_total', 'FEC blocks closed, by reason', label='reason')
+filler_symbols = REGISTRY.counter('fecudp_encoder_filler_symbols_total', 'Empty symbols added to short blocks')
+encode_errors = REGISTRY.counter('fecudp_encoder_errors_total', 'Errors while encoding or sending')
+feedback_reports = REGISTRY.counter('fecudp_encoder_feedback_reports_total', 'Loss reports received from the decoder')
+encode_seconds = REGISTRY.histogram('fecudp_encoder_encode_seconds', 'Time spent computing parity for one block')
+REGISTRY.gauge('fecudp_encoder_queue_depth', 'Symbols waiting in the open block', lambda: len(packets))
+REGISTRY.gauge('fecudp_encoder_fec_k', 'Data packets per block for new blocks', lambda: controller.params[0])
+REGISTRY.gauge('fecudp_encoder_fec_m', 'Parity packets per block for new blocks', lambda: controller.params[1])
+log_limiter = LogRateLimiter(LOG_INTERVAL)
 
-fec = reedsolo.RSCodec(FEC_REDUNDANT_PACKETS)
+udp_socket = udp_io = None          # 監聽 socket，於工作行程內建立
+forward_socket = forward_io = None  # 送出 FEC 封包並接收回報的 socket
 
-# 建立 socket
-udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-udp_socket.bind((UDP_LISTEN_IP, UDP_LISTEN_PORT))
+def open_sockets(reuse_port):
+    global udp_socket, udp_io, forward_socket, forward_io
+    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if reuse_port:
+        bind_reuseport(udp_socket, (UDP_LISTEN_IP, UDP_LISTEN_PORT))
+    else:
+        udp_socket.bind((UDP_LISTEN_IP, UDP_LISTEN_PORT))
+    forward_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp_io = open_batch_io(udp_socket, UDP_IO_BACKEND)
+    forward_io = open_batch_io(forward_socket, UDP_IO_BACKEND)
 
 packets = []
 packets_lock = threading.Lock()
-last_send_time = [time.time()]
-packet_counter = 0
+flush_condition = threading.Condition(packets_lock)  # 區塊開啟時喚醒計時器重新計算期限
+block_deadline = None  # 目前開啟區塊的發送期限（time.monotonic），None 表示沒有開啟的區塊
+pending_datagrams = []  # 打包模式下尚未組成符號的資料報
+pending_size = SYMBOL_COUNT.size
+block_counter = 0  # 每個 FEC 區塊的編號，讓解碼端分辨不同區塊
+block_k, block_m = FEC_ORIGINAL_PACKETS, FEC_REDUNDANT_PACKETS  # 目前開啟區塊的 (k, m)，區塊開啟時決定
+outgoing = []  # 直通模式下已加上標頭、等待在鎖外批次送出的原始封包
 
 # === FEC 計時器 ===
 def fec_timer_trigger():
+    """ 只睡到目前區塊的期限；沒有開啟的區塊時無限期等待，閒置時不耗 CPU """
     while True:
-        time.sleep(0.01)
-        elapsed_time = time.time() - last_send_time[0]
-
-        if elapsed_time > FEC_TIMEOUT:
-            with packets_lock:
-                if len(packets) > 0:
-                    logging.debug(f"FEC 超時觸發，封包數量: {len(packets)}")
-                    try:
-                        temp_packets = copy.deepcopy(packets)
-                        fec_encode_and_send(temp_packets)
-                        packets.clear()
-                        last_send_time[0] = time.time()
-                    except Exception as e:
-                        logging.error(f"FEC 編碼或發送過程中出現錯誤: {e}")
+        with flush_condition:
+            while block_deadline is None or time.monotonic() < block_deadline:
+                flush_condition.wait(None if block_deadline is None else block_deadline - time.monotonic())
+            batches = close_pending_symbol()
+            batch = take_block('timeout')
+            if batch:
+                batches.append(batch)
+            datagrams = take_outgoing()
+        send_datagrams(datagrams)
+        for batch in batches:
+            fec_encode_and_send(*batch)
 
 # === FEC 編碼與傳輸 ===
-def fec_encode_and_send(temp_packets):
-    # 取得最大封包大小
-    max_size = max(len(packet) for packet in temp_packets)
-    
-    # 將封包補齊到相同長度
-    for i in range(len(temp_packets)):
-        if len(temp_packets[i]) < max_size:
-            padding = max_size - len(temp_packets[i])
-            temp_packets[i] += b'\x00' * padding
-
-    # 若封包不足 X 個，補充空封包
-    if len(temp_packets) < FEC_BATCH_SIZE:
-        missing = FEC_BATCH_SIZE - len(temp_packets)
-        temp_packets.extend([b'\x00' * max_size] * missing)
-        logging.debug(f"補充 {missing} 個封包，大小: {max_size}")
+def fec_encode_and_send(block_id, temp_packets, k, m):
+    """ 在 packets_lock 之外編碼並發送一個已交接的區塊 """
+    # 若封包不足 k 個，補充空符號（編碼與解碼時都視為全零，不含任何資料報）
+    originals = len(temp_packets)
+    if len(temp_packets) < k:
+        missing = k - len(temp_packets)
+        temp_packets.extend([b""] * missing)
+        filler_symbols.inc(missing)
 
     try:
-        logging.debug("開始 FEC 編碼")
-        encoded_packets = fec.encode(b"".join(temp_packets))
-        packet_size = max_size
-
-        # 分割成每個封包大小
-        encoded_packets = [
-            encoded_packets[i:i + packet_size] for i in range(0, len(encoded_packets), packet_size)
-        ]
+        with encode_seconds.time():
+            encoded_packets = get_codec(k, m).encode(temp_packets)  # 冗餘封包長度 = 區塊內最長的符號
+        blocks_encoded.inc()
 
         # 合併原始封包 + 冗餘封包
-        udp_packets = temp_packets[:FEC_ORIGINAL_PACKETS] + encoded_packets[:FEC_REDUNDANT_PACKETS]
+        udp_packets = list(enumerate(temp_packets + encoded_packets))
+        if CUT_THROUGH:
+            # 原始符號已在產生時送出，只需補送空符號與冗餘封包
+            udp_packets = udp_packets[originals:]
 
-        # 發送封包
-        sent_count = 0
-        for i, packet in enumerate(udp_packets):
-            seq_num = struct.pack('!I', i)
-            packet = seq_num + packet
-
-            udp_socket.sendto(packet, (UDP_FORWARD_IP, UDP_FORWARD_PORT))
-            sent_count += 1
-            logging.debug(f"發送封包序號 {i}，大小: {len(packet)}")
-
-        logging.info(f"✅ 成功發送 {sent_count} 個封包 (應為 {FEC_ORIGINAL_PACKETS + FEC_REDUNDANT_PACKETS})")
+        # 整個區塊一次送出
+        sent_count = send_datagrams([FEC_HEADER.pack(block_id, i, k, m) + packet for i, packet in udp_packets])
+        suppressed = log_limiter.allow('block')
+        if suppressed is not None:
+            logging.info(f"✅ 區塊 {block_id} (k={k}, m={m}) 成功發送 {sent_count} 個封包（略過 {suppressed} 筆相同記錄）")
 
     except Exception as e:
+        encode_errors.inc()
         logging.error(f"FEC 編碼或發送時發生錯誤: {e}")
 
+def send_datagrams(datagrams):
+    """ 以一次批次呼叫送出已加上標頭的封包 """
+    if not datagrams:
+        return 0
+    sent_count = forward_io.send_batch(datagrams, (UDP_FORWARD_IP, UDP_FORWARD_PORT))
+    packets_out.inc(sent_count)
+    return sent_count
+
+# === 符號組裝（以下函式呼叫端皆須持有 packets_lock） ===
+def arm_deadline():
+    """ 第一筆資料進入空的區塊時設定期限，並喚醒計時器 """
+    global block_deadline
+    if block_deadline is None:
+        block_deadline = time.monotonic() + FEC_TIMEOUT
+        flush_condition.notify()
+
+def take_block(reason):
+    """ 交換緩衝區交出目前區塊（不複製），回傳 (block_id, 符號列表, k, m)；沒有資料時回傳 None """
+    global packets, block_counter, block_deadline
+    if not packets:
+        return None
+    block_flushes.inc(label_value=reason)
+    batch = (block_counter, packets, block_k, block_m)
+    packets = []
+    block_counter = (block_counter + 1) % BLOCK_ID_MODULO
+    block_deadline = None
+    if pending_datagrams:
+        arm_deadline()  # 打包中的資料報屬於下一個區塊
+    return batch
+
+def add_symbol(symbol, min_k=1):
+    """ 將符號放入目前區塊；湊滿批次時回傳待發送的區塊。min_k：新開的區塊至少要容納的符號數 """
+    global block_k, block_m
+    if not packets:
+        # 區塊內所有封包使用同一組 (k, m)
+        block_k, block_m = controller.current() if ADAPTIVE_FEC else (FEC_ORIGINAL_PACKETS, FEC_REDUNDANT_PACKETS)
+        if min_k > block_k:
+            # 放大 k 時依比例增加 m，維持原本的冗餘比例
+            block_m = min(-(-block_m * min_k // block_k), MAX_BLOCK_PACKETS - min_k)
+            block_k = min_k
+
+    if CUT_THROUGH:
+        # 以目前區塊編號送出原始符號，不補零（與同一批收到的其他封包一起在鎖外送出）
+        outgoing.append(FEC_HEADER.pack(block_counter, len(packets), block_k, block_m) + symbol)
+
+    packets.append(symbol)
+
+    # 收集到 k 個封包時觸發 FEC 編碼
+    if len(packets) >= block_k:
+        return take_block('full')
+    return None
+
+def take_outgoing():
+    """ 交換緩衝區交出待送出的直通封包 """
+    global outgoing
+    datagrams, outgoing = outgoing, []
+    return datagrams
+
+def add_fragments(data):
+    """ 超過 MAX_FRAGMENT_SIZE 的資料報切成分段，全部放在同一個區塊的連續 index；回傳待發送的區塊列表 """
+    symbols = pack_fragments(data)
+    datagrams_split.inc()
+    batches = []
+    if packets and len(packets) + len(symbols) > block_k:
+        batches.append(take_block('split'))  # 目前區塊放不下所有分段，先送出
+    for symbol in symbols:
+        batch = add_symbol(symbol, min_k=len(symbols))  # 分段數超過 k 時這個區塊的 k 放大到分段數
+        if batch:
+            batches.append(batch)
+    return batches
+
+def close_pending_symbol():
+    """ 打包模式：把累積中的資料報組成一個符號，回傳待發送的區塊列表 """
+    global pending_size
+    if not pending_datagrams:
+        return []
+    symbol = pack_symbol(pending_datagrams)
+    pending_datagrams.clear()
+    pending_size = SYMBOL_COUNT.size
+    batch = add_symbol(symbol)
+    return [batch] if batch else []
+
 # === 封包處理 ===
 def handle_udp_packet():
-    global packet_counter
-    logging.info("開始接收 UDP 封包...")
+    global pending_size
+    logging.info(f"開始接收 UDP 封包（{udp_io.name} 批次收發）...")
     while True:
         try:
-            data, addr = udp_socket.recvfrom(4096)
-            logging.debug(f"收到來自 {addr} 的封包，大小: {len(data)}")
+            received = udp_io.recv_batch()  # 一次取出所有已到達的資料報
+            packets_in.inc(len(received))
 
+            batches = []
             with packets_lock:
-                if packets and len(data) != len(packets[0]):
-                    logging.warning(f"封包大小不同，將其補齊 (收到: {len(data)}, 預期: {len(packets[0])})")
-                    data += b'\x00' * (len(packets[0]) - len(data))
-
-                # 加入序號
-                seq_num = struct.pack('!I', packet_counter)
-                packet_counter += 1
-
-                packets.append(data)
-                logging.debug(f"封包緩存數量: {len(packets)}")
-
-                # 收集到 X 個封包時觸發 FEC 編碼
-                if len(packets) >= FEC_BATCH_SIZE:
-                    logging.debug(f"FEC 觸發 (封包數量: {len(packets)})")
-                    try:
-                        temp_packets = copy.deepcopy(packets)
-                        fec_encode_and_send(temp_packets)
-                        packets.clear()
-                        last_send_time[0] = time.time()
-                    except Exception as e:
-                        logging.error(f"封包處理與發送時發生錯誤: {e}")
+                for data, addr in received:
+                    if len(data) > MAX_FRAGMENT_SIZE:
+                        # 整個放進一個符號會超過 MTU 而在 IP 層分段，改為切成多個符號，由解碼端組回
+                        batches += close_pending_symbol()  # 保持資料報的順序
+                        batches += add_fragments(data)
+                    elif not PACK_DATAGRAMS:
+                        batch = add_symbol(pack_symbol([data]))  # 每個資料報一個符號，附上原始長度
+                        if batch:
+                            batches.append(batch)
+                    else:
+                        # 打包模式：放不下或數量已滿時先結束目前的符號
+                        record_size = DATAGRAM_LENGTH.size + len(data)
+                        if pending_datagrams and (pending_size + record_size > MAX_SYMBOL_SIZE
+                                                  or len(pending_datagrams) >= MAX_DATAGRAMS_PER_SYMBOL):
+                            batches += close_pending_symbol()
+                        pending_datagrams.append(data)
+                        pending_size += record_size
+                        if pending_size >= MAX_SYMBOL_SIZE:
+                            batches += close_pending_symbol()
+                if packets or pending_datagrams:
+                    arm_deadline()
+                datagrams = take_outgoing()
+
+            # 編碼與發送在鎖外進行，不阻塞接收；同一批的原始封包先送出
+            send_datagrams(datagrams)
+            for batch in batches:
+                fec_encode_and_send(*batch)
 
         except Exception as e:
             logging.error(f"接收封包時發生錯誤: {e}")
 
-# === 啟動執行緒 ===
-threading.Thread(target=fec_timer_trigger, daemon=True).start()
-threading.Thread(target=handle_udp_packet, daemon=True).start()
-
-# === 保持程式運行 ===
-logging.info(f"正在監聽 {UDP_LISTEN_IP}:{UDP_LISTEN_PORT}，並轉發到 {UDP_FORWARD_IP}:{UDP_FORWARD_PORT}")
-try:
+# === 遺失回報 ===
+def handle_feedback():
+    """ 接收解碼端的遺失回報並更新之後區塊的 (k, m) """
+    last_seq = None
     while True:
-        time.sleep(1)
-except KeyboardInterrupt:
-    logging.info("正在關閉fec encoder...")
-    udp_socket.close()
+        try:
+            data, addr = forward_socket.recvfrom(65535)
+            if len(data) != FEEDBACK_REPORT.size:
+                logging.warning(f"來自 {addr} 的回報長度錯誤，丟棄")
+                continue
+            magic, report_seq, expected, lost, bursts, max_burst = FEEDBACK_REPORT.unpack(data)
+            if magic != FEEDBACK_MAGIC:
+                logging.warning(f"來自 {addr} 的回報格式錯誤，丟棄")
+                continue
+            if last_seq is not None and report_seq <= last_seq and last_seq - report_seq < 1024:
+                logging.debug(f"回報 {report_seq} 過期，丟棄")
+                continue
+            last_seq = report_seq
+            feedback_reports.inc()
+            k, m = controller.update(expected, lost, bursts, max_burst)
+            logging.info(f"📊 回報 {report_seq}: 遺失 {lost}/{expected}，最長連續遺失 {max_burst}，調整為 k={k}, m={m}")
+        except Exception as e:
+            logging.error(f"處理回報時發生錯誤: {e}")
+
+def run_worker(worker_index):
+    """ 單一編碼行程；多行程模式下每個工作行程各自建立 socket 與區塊狀態 """
+    global controller, block_k, block_m
+    controller = FecController(FEC_ORIGINAL_PACKETS, FEC_REDUNDANT_PACKETS, FEC_K_MIN, FEC_K_MAX,
+                               FEC_M_MIN, FEC_M_MAX, TARGET_BLOCK_FAILURE, FEEDBACK_TIMEOUT)
+    block_k, block_m = controller.current()
+    open_sockets(reuse_port=WORKERS > 1)
+    start_metrics_server(None if METRICS_PORT is None else METRICS_PORT + worker_index)
+
+    # === 啟動執行緒 ===
+    threading.Thread(target=fec_timer_trigger, daemon=True).start()
+    threading.Thread(target=handle_udp_packet, daemon=True).start()
+    if ADAPTIVE_FEC:
+        threading.Thread(target=handle_feedback, daemon=True).start()
+
+    # === 保持程式運行 ===
+    logging.info(f"工作行程 {worker_index} 正在監聽 {UDP_LISTEN_IP}:{UDP_LISTEN_PORT}，並轉發到 {UDP_FORWARD_IP}:{UDP_FORWARD_PORT}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        logging.info("正在關閉fec encoder...")
+        udp_socket.close()
+        forward_socket.close()
+
+if __name__ == '__main__':
+    run_workers(run_worker, WORKERS)
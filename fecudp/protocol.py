@@ -0,0 +1,92 @@
+import struct
+
+# === fecudp 編碼端與解碼端之間的封包格式 ===
+#
+# 每個 UDP 封包 = FEC 標頭 + 內容
+#   FEC 標頭：block_id (4) | index (1) | k (1) | m (1)
+#   index <  k：原始封包（FEC 符號），解碼時補零到區塊內最長的封包
+#   index >= k：第 index - k 個冗餘封包
+#
+# block_id 讓解碼端能同時組裝多個區塊，遺失或亂序的封包不會把下一個區塊錯位；
+# 每個區塊各自帶著 (k, m)，編碼端可以依回報隨時調整冗餘比例。
+#
+# FEC 符號 = 資料報數量 (2) + 每個資料報的 [長度 (2) | 內容]
+#   解碼端依長度還原出原本的資料報邊界，補零的部分不會被轉發；
+#   數量為 0（或空內容）的符號是補滿區塊用的空封包。
+#   開啟打包模式時，多個小資料報可以放進同一個不超過 MAX_SYMBOL_SIZE 的符號。
+#
+# 分段符號 = FRAGMENT_FLAG | [FRAGMENT_MORE] | 分段序號 (2) + 長度 (2) + 分段內容
+#   超過 MAX_FRAGMENT_SIZE 的資料報放不進一個不分段的 FEC 封包，編碼端把它切成多個分段，
+#   依序放在同一個區塊中連續的 index；FRAGMENT_MORE 表示下一個 index 還有後續分段。
+#   解碼端收齊（或還原出）所有分段後才組回原本的資料報轉發，分段不會跨區塊。
+
+FEC_HEADER = struct.Struct("!I B B B")
+SYMBOL_COUNT = struct.Struct("!H")
+DATAGRAM_LENGTH = struct.Struct("!H")
+
+BLOCK_ID_MODULO = 1 << 32
+MAX_BLOCK_PACKETS = 256  # k + m 上限（index 為 1 byte）
+MAX_SYMBOL_SIZE = 1472 - FEC_HEADER.size  # 1500 MTU - IP 20 - UDP 8 - FEC 標頭
+MAX_DATAGRAMS_PER_SYMBOL = 0x3FFF
+MAX_FRAGMENT_SIZE = MAX_SYMBOL_SIZE - SYMBOL_COUNT.size - DATAGRAM_LENGTH.size  # 單一符號可容納的資料報長度
+FRAGMENT_FLAG = 0x8000  # 符號開頭的數量欄位：此符號是某個資料報的一個分段
+FRAGMENT_MORE = 0x4000  # 下一個 index 還有同一個資料報的分段
+FRAGMENT_PART_MASK = 0x3FFF
+
+def pack_symbol(datagrams):
+    """ 將一或多個資料報包成一個 FEC 符號 """
+    parts = [SYMBOL_COUNT.pack(len(datagrams))]
+    for datagram in datagrams:
+        parts.append(DATAGRAM_LENGTH.pack(len(datagram)))
+        parts.append(datagram)
+    return b"".join(parts)
+
+def pack_fragments(datagram):
+    """ 將超過 MAX_FRAGMENT_SIZE 的資料報切成多個分段符號，須依序放在同一個區塊中連續的 index """
+    pieces = [datagram[i:i + MAX_FRAGMENT_SIZE] for i in range(0, len(datagram), MAX_FRAGMENT_SIZE)]
+    return [SYMBOL_COUNT.pack(FRAGMENT_FLAG | (FRAGMENT_MORE if part + 1 < len(pieces) else 0) | part)
+            + DATAGRAM_LENGTH.pack(len(piece)) + piece
+            for part, piece in enumerate(pieces)]
+
+def is_fragment(symbol):
+    return len(symbol) >= SYMBOL_COUNT.size and SYMBOL_COUNT.unpack_from(symbol)[0] & FRAGMENT_FLAG
+
+def unpack_fragment(symbol):
+    """ 回傳分段符號的 (分段序號, 是否還有後續分段, 內容)；格式錯誤時丟出 ValueError """
+    if len(symbol) < SYMBOL_COUNT.size + DATAGRAM_LENGTH.size:
+        raise ValueError("Truncated fragment")
+    header, = SYMBOL_COUNT.unpack_from(symbol)
+    length, = DATAGRAM_LENGTH.unpack_from(symbol, SYMBOL_COUNT.size)
+    start = SYMBOL_COUNT.size + DATAGRAM_LENGTH.size
+    if start + length > len(symbol):
+        raise ValueError("Truncated fragment")
+    return header & FRAGMENT_PART_MASK, bool(header & FRAGMENT_MORE), symbol[start:start + length]
+
+def unpack_symbol(symbol):
+    """ 從 FEC 符號（可能帶有補零）取出原本的資料報；格式錯誤時丟出 ValueError """
+    if not symbol:
+        return []
+    if len(symbol) < SYMBOL_COUNT.size:
+        raise ValueError("Truncated symbol")
+    count, = SYMBOL_COUNT.unpack_from(symbol)
+    if count & FRAGMENT_FLAG:
+        raise ValueError("Fragment symbol")
+    offset = SYMBOL_COUNT.size
+    datagrams = []
+    for _ in range(count):
+        if offset + DATAGRAM_LENGTH.size > len(symbol):
+            raise ValueError("Truncated datagram length")
+        length, = DATAGRAM_LENGTH.unpack_from(symbol, offset)
+        offset += DATAGRAM_LENGTH.size
+        if offset + length > len(symbol):
+            raise ValueError("Truncated datagram")
+        datagrams.append(symbol[offset:offset + length])
+        offset += length
+    return datagrams
+
+# === 解碼端 → 編碼端的遺失回報（控制通道，獨立的 UDP 埠） ===
+#   magic (4) | report_seq (4) | expected (4) | lost (4) | bursts (4) | max_burst (2)
+#   expected/lost：本期應收到與遺失的封包數；bursts/max_burst：連續遺失的次數與最長長度
+
+FEEDBACK_MAGIC = b"FBK1"
+FEEDBACK_REPORT = struct.Struct("!4s I I I I H")
@@ -1,76 +1,375 @@
 # === RECEIVER ===
 import os
 import socket
-import hashlib
+import sys
 import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.chunkfile import ChunkFile
+from common.erasure import MAX_SYMBOLS, ErasureDecodeError, get_codec
+from common.manifest import BlockStore
+from common.metrics import REGISTRY, LogRateLimiter, start_metrics_server
+from common.pacing import PACKET_NUMBER_MODULO
+from protocol import (CHUNK_HEADER, HASH_HEADER, MANIFEST_HEADER, MAX_NACK_RANGES, MAX_PACKET_SIZE, METADATA_HEADER,
+                      NACK_HAVE, NACK_NEED_HASH, NACK_NEED_MANIFEST, NACK_NEED_METADATA, PACKET_CHUNK, PACKET_HASH,
+                      PACKET_MANIFEST, PACKET_METADATA, PACKET_PARITY, PARITY_HEADER, pack_done, pack_nack,
+                      pack_progress, unpack_hash, unpack_manifest, unpack_metadata)
 
 RECEIVE_DIR = "/home/tony/code/file-transfer/received"
 CHUNK_SIZE = 1024
 LISTEN_IP = "0.0.0.0"
 LISTEN_PORT = 5005
+METRICS_PORT = 9104  # 本機統計端點 /metrics、/metrics.json；None 表示不啟動
+PROGRESS_INTERVAL = 1.0  # 接收進度每秒最多顯示一次（取代每個 chunk 一行）
+NACK_INTERVAL = 0.2  # 每隔多久向發送端回報一次尚未收到的 chunk 範圍
+FEEDBACK_INTERVAL = 0.05  # 每隔多久回報一次接收統計（最大封包編號、封包數），發送端據此調整速率
+TRANSFER_TIMEOUT = 30.0  # 超過此時間沒有收到任何封包的傳送視為中斷；已驗證的區塊保留在 .part 供之後的傳送複製（續傳）
+FINISHED_HISTORY = 30.0  # 記住已完成的傳送多久，發送端沒收到完成確認而重送時可以再回覆
+MANIFEST_INDEX = ".manifests"  # RECEIVE_DIR 下保存已完成檔案區塊清單的資料夾，重新啟動後仍可依內容去重
 
+# transfer_id -> {'name': 檔名, 'file': ChunkFile, 'hash': 預期的 SHA-256, 'addr': 發送端地址, 'last_seen': 時間,
+#                 'fec': (k, m), 'last_length': 最後一個 chunk 的長度, 'parity': {區塊: {index: 冗餘封包}},
+#                 'packets': 收到的封包數, 'highest_packet': 最大封包編號, 'reported_packets': 上次回報時的封包數,
+#                 'root': 第一輪結束時收到的 Merkle 根雜湊, 'confirmed': 區塊清單已收齊並與根雜湊相符}
 file_buffers = {}
+finished = {}  # transfer_id -> (是否驗證成功, 完成時間)
+replied = {}  # transfer_id -> 下次可以再回覆未知傳送的時間（避免每個封包都回覆）
+store = BlockStore()  # 已驗證區塊的內容索引；start_receiver 時讀回保存的清單
+# 各類封包至少需要的長度，較短的封包（雜訊、截斷）直接丟棄
+MIN_PACKET_LENGTH = {
+    PACKET_METADATA: METADATA_HEADER.size,
+    PACKET_CHUNK: CHUNK_HEADER.size,
+    PACKET_HASH: HASH_HEADER.size,
+    PACKET_PARITY: PARITY_HEADER.size,
+    PACKET_MANIFEST: MANIFEST_HEADER.size
+}
 
+chunks_received = REGISTRY.counter('file_receiver_chunks_received_total', 'Data chunks stored')
+chunks_dropped = REGISTRY.counter('file_receiver_chunks_dropped_total', 'Data chunks with no matching transfer')
+chunks_duplicate = REGISTRY.counter('file_receiver_chunks_duplicate_total', 'Duplicate or out-of-range data chunks')
+chunks_recovered = REGISTRY.counter('file_receiver_chunks_recovered_total', 'Data chunks rebuilt from parity packets')
+nacks_sent = REGISTRY.counter('file_receiver_nacks_sent_total', 'Missing-range reports sent to senders')
+files_completed = REGISTRY.counter('file_receiver_files_total', 'Files written, by hash check result', label='result')
+blocks_local = REGISTRY.counter('file_receiver_blocks_local_total', 'Verified blocks not received over the network',
+                                label='source')
+blocks_rejected = REGISTRY.counter('file_receiver_blocks_rejected_total', 'Blocks that failed verification')
+progress_limiter = LogRateLimiter(PROGRESS_INTERVAL)
 
-def save_file(filename, chunks, expected_hash):
-    os.makedirs(RECEIVE_DIR, exist_ok=True)
-    path = os.path.join(RECEIVE_DIR, filename)
 
-    ordered_chunks = [chunks[i] for i in sorted(chunks)]
-    with open(path, 'wb') as f:
-        for chunk in ordered_chunks:
-            f.write(chunk)
-
-    with open(path, 'rb') as f:
-        actual_hash = hashlib.sha256(f.read()).hexdigest()
+def save_file(info):
+    # 內容已直接寫入磁碟，雜湊也已邊收邊算，這裡只需要收尾
+    filename = info['name']
+    actual_hash = info['file'].finish()
+    expected_hash = info['hash']
 
+    chunk_file = info['file']
+    if chunk_file.copied:
+        print(f"♻️  '{filename}': {chunk_file.copied} blocks copied from local content "
+              f"({chunk_file.resumed} from interrupted transfers)")
     if actual_hash == expected_hash:
+        store.add_file(chunk_file.path, chunk_file.leaves, chunk_file.block_chunks * CHUNK_SIZE)  # 之後的傳送可直接複製
+        files_completed.inc(label_value='verified')
         print(f"✅ File '{filename}' saved and verified.")
+        return True
     else:
+        files_completed.inc(label_value='mismatch')
         print(f"❌ File '{filename}' hash mismatch! Expected {expected_hash}, got {actual_hash}")
+        return False
+
+
+def ready(info):
+    """ 所有 chunk 已收齊並通過區塊驗證，區塊清單與根雜湊相符，也已收到雜湊 """
+    return info['file'].complete and info['confirmed'] and info['hash'] is not None
+
+
+def block_ranges(blocks):
+    """ 把由小到大的區塊編號合併成連續範圍 [(start, count), ...] """
+    ranges = []
+    for block in blocks:
+        if ranges and ranges[-1][0] + ranges[-1][1] == block:
+            ranges[-1] = (ranges[-1][0], ranges[-1][1] + 1)
+        else:
+            ranges.append((block, 1))
+    return ranges
+
+
+def complete_transfer(transfer_id, info, sock):
+    verified = save_file(info)
+    del file_buffers[transfer_id]
+    finished[transfer_id] = (verified, time.monotonic())
+    sock.sendto(pack_done(transfer_id, verified), info['addr'])
+
+
+def reply_unknown(transfer_id, addr, sock, now):
+    """ 收到不在接收中的傳送的封包：已完成的再回覆一次完成確認，否則要求重送 metadata """
+    if now < replied.get(transfer_id, 0.0):
+        return
+    replied[transfer_id] = now + NACK_INTERVAL
+    if transfer_id in finished:
+        sock.sendto(pack_done(transfer_id, finished[transfer_id][0]), addr)
+    else:
+        sock.sendto(pack_nack(transfer_id, NACK_NEED_METADATA, []), addr)
+
+
+def confirm_manifest(transfer_id, info, sock):
+    """ 區塊清單收齊且已收到根雜湊時確認兩者相符；不符時丟棄清單與驗證結果，要求發送端重送清單 """
+    chunk_file = info['file']
+    if info['confirmed'] or info['root'] is None or not chunk_file.manifest_complete:
+        return
+    if chunk_file.root() == info['root']:
+        info['confirmed'] = True
+    else:
+        chunk_file.reset_leaves()
+        sock.sendto(pack_nack(transfer_id, NACK_NEED_MANIFEST, []), info['addr'])
+
+
+def recover_block(info, block):
+    """ 區塊內收到的 chunk 與冗餘封包合計達到區塊大小時，從冗餘封包還原遺失的 chunk 並寫入檔案 """
+    parity = info['parity'].get(block)
+    if not parity:
+        return
+    chunk_file = info['file']
+    fec_k, fec_m = info['fec']
+    first = block * fec_k
+    count = min(fec_k, chunk_file.total - first)
+    present = [i for i in range(count) if chunk_file.has(first + i)]
+    if len(present) == count:
+        del info['parity'][block]  # 區塊已收齊，冗餘封包用不到了
+        return
+    if len(present) + len(parity) < count:
+        return
+
+    # 已收到的 chunk 已寫入磁碟，解碼時從檔案讀回
+    received = {i: chunk_file.read(first + i) for i in present}
+    received.update({count + index: data for index, data in parity.items()})
+    try:
+        recovered = get_codec(count, fec_m).recover(received, CHUNK_SIZE)
+    except ErasureDecodeError:
+        del info['parity'][block]  # 冗餘封包不一致，改由重送補齊
+        return
+    for i, data in recovered.items():
+        seq = first + i
+        if seq == chunk_file.total - 1:
+            data = data[:info['last_length']]
+        rejected = chunk_file.rejected
+        if chunk_file.write(seq, data):
+            chunks_recovered.inc()
+        note_rejected(info, seq, rejected)
+    del info['parity'][block]
 
 
-def handle_packet(packet):
-    global file_buffers
+def note_rejected(info, seq, rejected):
+    """ 寫入後若有區塊驗證失敗（整個區塊會重新要求）則記錄 """
+    chunk_file = info['file']
+    if chunk_file.rejected != rejected:
+        blocks_rejected.inc()
+        print(f"⚠️  '{info['name']}': block {seq // chunk_file.block_chunks} failed verification, requesting again")
+
+
+def note_packet(info, number):
+    """ 記錄收到的封包編號，供接收統計回報使用 """
+    info['packets'] += 1
+    highest = info['highest_packet']
+    if highest is None or 0 < (number - highest) % PACKET_NUMBER_MODULO < PACKET_NUMBER_MODULO // 2:
+        info['highest_packet'] = number
+
+
+def handle_packet(packet, addr, sock):
+    if not packet or len(packet) < MIN_PACKET_LENGTH.get(packet[0], 0):
+        return
     packet_type = packet[0]
+    now = time.monotonic()
 
-    if packet_type == 0x00:
-        total = int.from_bytes(packet[1:5], 'big')
-        name_len = packet[5]
-        filename = packet[6:6 + name_len].decode()
-        sha256 = packet[6 + name_len:].decode()
+    if packet_type == PACKET_METADATA:
+        transfer_id, total, last_length, fec_k, fec_m, block_chunks, filename, sha256 = unpack_metadata(packet)
 
-        file_buffers[filename] = {
-            'chunks': {},
-            'total': total,
-            'hash': sha256
+        if transfer_id in file_buffers or transfer_id in finished:
+            return  # 重複的 metadata
+        if fec_k < 1 or fec_k + fec_m > MAX_SYMBOLS or block_chunks < 1:
+            if progress_limiter.allow('invalid') is not None:
+                print(f"⚠️  Ignoring metadata for '{filename}' with invalid FEC {fec_k}+{fec_m}")
+            return
+        for other_id, other in list(file_buffers.items()):
+            if other['name'] == filename:
+                # 同名檔案重新傳送，放棄尚未完成的那一份；已驗證的區塊保留，新的傳送遇到相同內容時直接複製（續傳）
+                if other['file'].resumable:
+                    other['file'].close()
+                else:
+                    other['file'].abort()
+                del file_buffers[other_id]
+        # 暫存檔以 transfer_id 命名，新舊兩次傳送不會寫到同一個檔案
+        chunk_file = ChunkFile(os.path.join(RECEIVE_DIR, filename), total, CHUNK_SIZE, block_chunks, store,
+                               tag=f'{transfer_id:08x}')
+        info = file_buffers[transfer_id] = {
+            'name': filename,
+            'file': chunk_file,
+            'hash': sha256,
+            'addr': addr,
+            'last_seen': now,
+            'fec': (fec_k, fec_m),
+            'last_length': last_length,
+            'parity': {},
+            'packets': 0,
+            'highest_packet': None,
+            'reported_packets': 0,
+            'root': None,
+            'confirmed': False
         }
-        print(f"📥 Metadata received: {filename} ({total} chunks)")
+        print(f"📥 Metadata received: {filename} ({total} chunks, FEC {fec_k}+{fec_m}, transfer {transfer_id:08x})")
+
+    elif packet_type == PACKET_MANIFEST:
+        transfer_id, first, digests = unpack_manifest(packet)
+
+        info = file_buffers.get(transfer_id)
+        if info is None:
+            reply_unknown(transfer_id, addr, sock, now)
+            return
+        info['addr'], info['last_seen'] = addr, now
+        chunk_file = info['file']
+        copied, resumed = chunk_file.copied, chunk_file.resumed
+        held = chunk_file.add_leaves(first, digests)
+        if chunk_file.resumed != resumed:
+            blocks_local.inc(chunk_file.resumed - resumed, label_value='resumed')
+        if chunk_file.copied - copied != chunk_file.resumed - resumed:
+            blocks_local.inc(chunk_file.copied - copied - (chunk_file.resumed - resumed), label_value='deduplicated')
+        if held:  # 發送端傳送到這些區塊時略過
+            sock.sendto(pack_nack(transfer_id, NACK_HAVE, block_ranges(held)), addr)
+        confirm_manifest(transfer_id, info, sock)
+        if ready(info):
+            complete_transfer(transfer_id, info, sock)
+
+    elif packet_type == PACKET_CHUNK:
+        _, transfer_id, seq, number = CHUNK_HEADER.unpack_from(packet)
+        data = packet[CHUNK_HEADER.size:]
+
+        info = file_buffers.get(transfer_id)
+        if info is None:
+            chunks_dropped.inc()
+            reply_unknown(transfer_id, addr, sock, now)
+            return
+        info['addr'], info['last_seen'] = addr, now
+        note_packet(info, number)
+        chunk_file = info['file']
+        rejected = chunk_file.rejected
+        if not chunk_file.write(seq, data):
+            chunks_duplicate.inc()
+            return
+        chunks_received.inc()
+        note_rejected(info, seq, rejected)
+        recover_block(info, seq // info['fec'][0])
+        if progress_limiter.allow(transfer_id) is not None:
+            print(f"📦 '{info['name']}': {chunk_file.received}/{chunk_file.total} chunks received")
+        if ready(info):
+            complete_transfer(transfer_id, info, sock)
+
+    elif packet_type == PACKET_PARITY:
+        _, transfer_id, block, index, number = PARITY_HEADER.unpack_from(packet)
+
+        info = file_buffers.get(transfer_id)
+        if info is None:
+            reply_unknown(transfer_id, addr, sock, now)
+            return
+        info['addr'], info['last_seen'] = addr, now
+        note_packet(info, number)
+        fec_k, fec_m = info['fec']
+        if block * fec_k >= info['file'].total or index >= fec_m:
+            return
+        info['parity'].setdefault(block, {})[index] = packet[PARITY_HEADER.size:]
+        recover_block(info, block)
+        if ready(info):
+            complete_transfer(transfer_id, info, sock)
+
+    elif packet_type == PACKET_HASH:
+        transfer_id, root, sha256 = unpack_hash(packet)
+
+        info = file_buffers.get(transfer_id)
+        if info is None:
+            reply_unknown(transfer_id, addr, sock, now)
+            return
+        info['hash'], info['root'] = sha256, root
+        info['addr'], info['last_seen'] = addr, now
+        confirm_manifest(transfer_id, info, sock)
+        if ready(info):
+            complete_transfer(transfer_id, info, sock)
+
+
+def send_reports(sock, now):
+    """ 向每個進行中的傳送回報尚未收到的範圍，並清除中斷的傳送與過期的記錄 """
+    for transfer_id, info in list(file_buffers.items()):
+        chunk_file = info['file']
+        if now - info['last_seen'] > TRANSFER_TIMEOUT:
+            if chunk_file.resumable:
+                chunk_file.close()  # 保留已驗證的區塊，重新傳送時複製相同內容的區塊（續傳）
+            else:
+                chunk_file.abort()
+            del file_buffers[transfer_id]
+            files_completed.inc(label_value='timeout')
+            print(f"⌛ Transfer of '{info['name']}' timed out ({chunk_file.received}/{chunk_file.total} chunks)")
+            continue
+
+        # 已收到根雜湊表示第一輪已結束，區塊清單仍不完整時要求重送
+        flags = NACK_NEED_MANIFEST if info['root'] is not None and not info['confirmed'] else 0
+        if chunk_file.complete:
+            flags, ranges = flags or NACK_NEED_HASH, []
+        elif info['hash'] is None:
+            # 第一輪交錯傳送時編號較大的 chunk 會提早送達，雜湊（第一輪結束）之前的缺口多半還在路上
+            # 或之後可由冗餘封包還原，因此不回報
+            continue
+        else:
+            ranges = chunk_file.missing_ranges(None, MAX_NACK_RANGES)
+            if not ranges and not flags:
+                continue
+        sock.sendto(pack_nack(transfer_id, flags, ranges), info['addr'])
+        nacks_sent.inc()
+
+    for transfer_id, (_, finished_at) in list(finished.items()):
+        if now - finished_at > FINISHED_HISTORY:
+            del finished[transfer_id]
+    for transfer_id, until in list(replied.items()):
+        if until < now:
+            del replied[transfer_id]
 
-    elif packet_type == 0x01:
-        seq = int.from_bytes(packet[1:5], 'big')
-        data = packet[5:]
 
-        for fname, info in file_buffers.items():
-            if seq not in info['chunks'] and len(info['chunks']) < info['total']:
-                info['chunks'][seq] = data
-                print(f"📦 Chunk {seq} received for '{fname}'")
-                if len(info['chunks']) == info['total']:
-                    save_file(fname, info['chunks'], info['hash'])
-                    del file_buffers[fname]
-                break
+def send_progress(sock):
+    """ 向有新封包的傳送回報收到的最大封包編號與累計封包數 """
+    for transfer_id, info in file_buffers.items():
+        if info['packets'] == info['reported_packets'] or info['highest_packet'] is None:
+            continue
+        info['reported_packets'] = info['packets']
+        packets = info['packets'] % PACKET_NUMBER_MODULO
+        sock.sendto(pack_progress(transfer_id, info['highest_packet'], packets), info['addr'])
 
 
 def start_receiver():
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
     sock.bind((LISTEN_IP, LISTEN_PORT))
+    sock.settimeout(FEEDBACK_INTERVAL)
 
     print(f"🟢 Listening on UDP {LISTEN_PORT}...")
+    store.index_dir = os.path.join(RECEIVE_DIR, MANIFEST_INDEX)
+    print(f"🗂️  {store.load(RECEIVE_DIR)} blocks of earlier and interrupted files available for deduplication")
+    start_metrics_server(METRICS_PORT)
 
+    next_progress = time.monotonic() + FEEDBACK_INTERVAL
+    next_report = time.monotonic() + NACK_INTERVAL
     while True:
-        packet, addr = sock.recvfrom(CHUNK_SIZE + 100)
-        handle_packet(packet)
+        try:
+            packet, addr = sock.recvfrom(max(CHUNK_SIZE + 100, MAX_PACKET_SIZE))
+        except socket.timeout:
+            pass
+        else:
+            try:
+                handle_packet(packet, addr, sock)
+            except Exception as e:
+                if progress_limiter.allow('error') is not None:
+                    print(f"⚠️  Failed to handle packet: {e}")
+        now = time.monotonic()
+        if now >= next_progress:
+            send_progress(sock)
+            next_progress = now + FEEDBACK_INTERVAL
+        if now >= next_report:
+            send_reports(sock, now)
+            next_report = now + NACK_INTERVAL
 
 
 if __name__ == "__main__":
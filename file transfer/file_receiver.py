@@ -1,73 +1,356 @@
 import os
+import queue
 import socket
 import threading
-import hashlib
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.chunkfile import ChunkFile
+from common.manifest import BlockStore
+from common.metrics import REGISTRY, LogRateLimiter, start_metrics_server
+from common.pacing import PACKET_NUMBER_MODULO
+from protocol import (CHUNK_HEADER, MAX_NACK_RANGES, MAX_PACKET_SIZE, NACK_HAVE, NACK_NEED_HASH, NACK_NEED_MANIFEST,
+                      NACK_NEED_METADATA, PACKET_CHUNK, PACKET_HASH, PACKET_MANIFEST, PACKET_METADATA, PACKET_PREFIX,
+                      pack_done, pack_nack, pack_progress, unpack_hash, unpack_manifest, unpack_metadata)
 
 RECEIVE_DIR = "/home/tony/code/file-transfer/received"
 CHUNK_SIZE = 1024
 LISTEN_IP = "0.0.0.0"
 LISTEN_PORT = 5005
+METRICS_PORT = 9104  # 本機統計端點 /metrics、/metrics.json；None 表示不啟動
+PROGRESS_INTERVAL = 1.0  # 接收進度每秒最多顯示一次（取代每個 chunk 一行）
+NACK_INTERVAL = 0.2  # 每隔多久向發送端回報一次尚未收到的 chunk 範圍
+FEEDBACK_INTERVAL = 0.05  # 每隔多久回報一次接收統計（最大封包編號、封包數），發送端據此調整速率
+TRANSFER_TIMEOUT = 30.0  # 超過此時間沒有收到任何封包的傳送視為中斷；已驗證的區塊保留在 .part 供之後的傳送複製（續傳）
+FINISHED_HISTORY = 30.0  # 記住已完成的傳送多久，發送端沒收到完成確認而重送時可以再回覆
+WORKER_COUNT = 4  # 寫入磁碟與計算雜湊的工作執行緒數；同一個傳送固定由同一個執行緒處理
+BUFFER_COUNT = 4096  # 預先配置的接收緩衝區數；全部在排隊時接收迴圈暫停，封包暫存在核心的接收緩衝區
+SOCKET_RCVBUF = 4 * 1024 * 1024
+MANIFEST_INDEX = ".manifests"  # RECEIVE_DIR 下保存已完成檔案區塊清單的資料夾，重新啟動後仍可依內容去重
 
-file_buffers = {}
-lock = threading.Lock()
+# 接收迴圈只做 recvfrom_into（寫入預先配置的緩衝區）並依 transfer_id 分派給工作執行緒，
+# 每個傳送的狀態只由負責它的工作執行緒存取，不需要全域鎖；寫入磁碟與雜湊不會擋住收封包。
+# 跨執行緒共用的只有檔名對照（同名檔案重新傳送時放棄舊的那一份），只在 metadata 與傳送結束時使用，
+# 以及已驗證區塊的內容索引（common.manifest.BlockStore，自己有鎖）。
+names = {}  # 檔名 -> 最近一次開始接收的 transfer_id
+names_lock = threading.Lock()
+workers = []
+free_buffers = queue.Queue()
+store = BlockStore()
 
-def save_file(filename, chunks, expected_hash):
-    os.makedirs(RECEIVE_DIR, exist_ok=True)
-    path = os.path.join(RECEIVE_DIR, filename)
+chunks_received = REGISTRY.counter('file_receiver_chunks_received_total', 'Data chunks stored')
+chunks_dropped = REGISTRY.counter('file_receiver_chunks_dropped_total', 'Data chunks with no matching transfer')
+chunks_duplicate = REGISTRY.counter('file_receiver_chunks_duplicate_total', 'Duplicate or out-of-range data chunks')
+nacks_sent = REGISTRY.counter('file_receiver_nacks_sent_total', 'Missing-range reports sent to senders')
+files_completed = REGISTRY.counter('file_receiver_files_total', 'Files written, by hash check result', label='result')
+blocks_local = REGISTRY.counter('file_receiver_blocks_local_total', 'Verified blocks not received over the network',
+                                label='source')
+blocks_rejected = REGISTRY.counter('file_receiver_blocks_rejected_total', 'Blocks that failed verification')
+REGISTRY.gauge('file_receiver_free_buffers', 'Receive buffers not waiting in a worker queue',
+               lambda: free_buffers.qsize())
+progress_limiter = LogRateLimiter(PROGRESS_INTERVAL)
 
-    with open(path, 'wb') as f:
-        for i in range(len(chunks)):
-            f.write(chunks[i])
-
-    with open(path, 'rb') as f:
-        actual_hash = hashlib.sha256(f.read()).hexdigest()
+def save_file(info):
+    # 內容已直接寫入磁碟，雜湊也已邊收邊算，這裡只需要收尾
+    filename = info['name']
+    actual_hash = info['file'].finish()
+    expected_hash = info['hash']
 
+    chunk_file = info['file']
+    if chunk_file.copied:
+        print(f"♻️  '{filename}': {chunk_file.copied} blocks copied from local content "
+              f"({chunk_file.resumed} from interrupted transfers)")
     if actual_hash == expected_hash:
+        store.add_file(chunk_file.path, chunk_file.leaves, chunk_file.block_chunks * CHUNK_SIZE)  # 之後的傳送可直接複製
+        files_completed.inc(label_value='verified')
         print(f"✅ File '{filename}' saved and verified.")
+        return True
     else:
+        files_completed.inc(label_value='mismatch')
         print(f"❌ File '{filename}' hash mismatch! Expected {expected_hash}, got {actual_hash}")
+        return False
+
+def ready(info):
+    """ 所有 chunk 已收齊並通過區塊驗證，區塊清單與根雜湊相符，也已收到雜湊 """
+    return info['file'].complete and info['confirmed'] and info['hash'] is not None
+
+def block_ranges(blocks):
+    """ 把由小到大的區塊編號合併成連續範圍 [(start, count), ...] """
+    ranges = []
+    for block in blocks:
+        if ranges and ranges[-1][0] + ranges[-1][1] == block:
+            ranges[-1] = (ranges[-1][0], ranges[-1][1] + 1)
+        else:
+            ranges.append((block, 1))
+    return ranges
+
+def worker_for(transfer_id):
+    return workers[transfer_id % len(workers)]
+
+def claim_name(filename, transfer_id):
+    """ 記錄檔名由哪個傳送接收，回傳先前接收同名檔案的 transfer_id（沒有時為 None） """
+    with names_lock:
+        previous = names.get(filename)
+        names[filename] = transfer_id
+    return previous if previous != transfer_id else None
+
+def release_name(filename, transfer_id):
+    with names_lock:
+        if names.get(filename) == transfer_id:
+            del names[filename]
+
+def note_packet(info, number):
+    """ 記錄收到的封包編號，供接收統計回報使用 """
+    info['packets'] += 1
+    highest = info['highest_packet']
+    if highest is None or 0 < (number - highest) % PACKET_NUMBER_MODULO < PACKET_NUMBER_MODULO // 2:
+        info['highest_packet'] = number
+
+class Worker:
+    """ 工作執行緒：依序執行分派給它的封包與定期工作，負責的傳送狀態只由這個執行緒存取 """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.tasks = queue.SimpleQueue()
+        # transfer_id -> {'name': 檔名, 'file': ChunkFile, 'hash': 預期的 SHA-256, 'addr': 發送端地址,
+        #                 'last_seen': 時間, 'packets': 收到的封包數, 'highest_packet': 最大封包編號,
+        #                 'reported_packets': 上次回報時的封包數, 'root': 第一輪結束時收到的 Merkle 根雜湊,
+        #                 'confirmed': 區塊清單已收齊並與根雜湊相符}
+        self.file_buffers = {}
+        self.finished = {}  # transfer_id -> (是否驗證成功, 完成時間)
+        self.replied = {}  # transfer_id -> 下次可以再回覆未知傳送的時間（避免每個封包都回覆）
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def submit(self, function, *args):
+        self.tasks.put((function, args))
+
+    def run(self):
+        while True:
+            function, args = self.tasks.get()
+            try:
+                function(*args)
+            except Exception as e:
+                if progress_limiter.allow('error') is not None:
+                    print(f"⚠️  Failed to handle packet: {e}")
+
+    def handle_datagram(self, buffer, length, addr):
+        try:
+            self.handle_packet(memoryview(buffer)[:length], addr)
+        finally:
+            free_buffers.put(buffer)  # 處理完畢（資料已寫入磁碟）後緩衝區才能重複使用
+
+    def complete_transfer(self, transfer_id, info):
+        verified = save_file(info)
+        del self.file_buffers[transfer_id]
+        release_name(info['name'], transfer_id)
+        self.finished[transfer_id] = (verified, time.monotonic())
+        self.sock.sendto(pack_done(transfer_id, verified), info['addr'])
+
+    def abort_transfer(self, transfer_id):
+        """ 同名檔案重新傳送，放棄尚未完成的那一份；已驗證的區塊保留，新的傳送遇到相同內容時直接複製（續傳） """
+        info = self.file_buffers.pop(transfer_id, None)
+        if info is None:
+            return
+        if info['file'].resumable:
+            info['file'].close()  # 暫存檔以 transfer_id 命名，新的傳送不會寫到同一個檔案；新的傳送完成時才刪除
+        else:
+            info['file'].abort()
+
+    def confirm_manifest(self, transfer_id, info):
+        """ 區塊清單收齊且已收到根雜湊時確認兩者相符；不符時丟棄清單與驗證結果，要求發送端重送清單 """
+        chunk_file = info['file']
+        if info['confirmed'] or info['root'] is None or not chunk_file.manifest_complete:
+            return
+        if chunk_file.root() == info['root']:
+            info['confirmed'] = True
+        else:
+            chunk_file.reset_leaves()
+            self.sock.sendto(pack_nack(transfer_id, NACK_NEED_MANIFEST, []), info['addr'])
 
-def handle_packet(packet):
-    global file_buffers
-    packet_type = packet[0]
-
-    if packet_type == 0x00:
-        total = int.from_bytes(packet[1:5], 'big')
-        name_len = packet[5]
-        filename = packet[6:6 + name_len].decode()
-        sha256 = packet[6 + name_len:].decode()
-
-        with lock:
-            file_buffers[filename] = {
-                'chunks': {},
-                'total': total,
-                'hash': sha256
+    def reply_unknown(self, transfer_id, addr, now):
+        """ 收到不在接收中的傳送的封包：已完成的再回覆一次完成確認，否則要求重送 metadata """
+        if now < self.replied.get(transfer_id, 0.0):
+            return
+        self.replied[transfer_id] = now + NACK_INTERVAL
+        if transfer_id in self.finished:
+            self.sock.sendto(pack_done(transfer_id, self.finished[transfer_id][0]), addr)
+        else:
+            self.sock.sendto(pack_nack(transfer_id, NACK_NEED_METADATA, []), addr)
+
+    def handle_packet(self, packet, addr):
+        packet_type = packet[0]
+        now = time.monotonic()
+
+        if packet_type == PACKET_METADATA:
+            transfer_id, total, block_chunks, filename, sha256 = unpack_metadata(packet)
+
+            if transfer_id in self.file_buffers or transfer_id in self.finished:
+                return  # 重複的 metadata
+            previous = claim_name(filename, transfer_id)
+            if previous is not None:
+                owner = worker_for(previous)
+                owner.submit(owner.abort_transfer, previous)
+            chunk_file = ChunkFile(os.path.join(RECEIVE_DIR, filename), total, CHUNK_SIZE, block_chunks, store,
+                                   tag=f'{transfer_id:08x}')
+            info = self.file_buffers[transfer_id] = {
+                'name': filename,
+                'file': chunk_file,
+                'hash': sha256,
+                'addr': addr,
+                'last_seen': now,
+                'packets': 0,
+                'highest_packet': None,
+                'reported_packets': 0,
+                'root': None,
+                'confirmed': False
             }
-        print(f"📥 Metadata received: {filename} ({total} chunks)")
-
-    elif packet_type == 0x01:
-        seq = int.from_bytes(packet[1:5], 'big')
-        data = packet[5:]
-
-        with lock:
-            for fname, info in file_buffers.items():
-                if seq not in info['chunks'] and len(info['chunks']) < info['total']:
-                    info['chunks'][seq] = data
-                    print(f"📦 Chunk {seq} received for '{fname}'")
-                    if len(info['chunks']) == info['total']:
-                        save_file(fname, info['chunks'], info['hash'])
-                        del file_buffers[fname]
-                    break
+            print(f"📥 Metadata received: {filename} ({total} chunks, transfer {transfer_id:08x})")
+
+        elif packet_type == PACKET_MANIFEST:
+            transfer_id, first, digests = unpack_manifest(packet)
+
+            info = self.file_buffers.get(transfer_id)
+            if info is None:
+                self.reply_unknown(transfer_id, addr, now)
+                return
+            info['addr'], info['last_seen'] = addr, now
+            chunk_file = info['file']
+            copied, resumed = chunk_file.copied, chunk_file.resumed
+            held = chunk_file.add_leaves(first, digests)
+            if chunk_file.resumed != resumed:
+                blocks_local.inc(chunk_file.resumed - resumed, label_value='resumed')
+            if chunk_file.copied - copied != chunk_file.resumed - resumed:
+                blocks_local.inc(chunk_file.copied - copied - (chunk_file.resumed - resumed), label_value='deduplicated')
+            if held:  # 發送端傳送到這些區塊時略過
+                self.sock.sendto(pack_nack(transfer_id, NACK_HAVE, block_ranges(held)), addr)
+            self.confirm_manifest(transfer_id, info)
+            if ready(info):
+                self.complete_transfer(transfer_id, info)
+
+        elif packet_type == PACKET_CHUNK:
+            _, transfer_id, seq, number = CHUNK_HEADER.unpack_from(packet)
+            data = packet[CHUNK_HEADER.size:]
+
+            info = self.file_buffers.get(transfer_id)
+            if info is None:
+                chunks_dropped.inc()
+                self.reply_unknown(transfer_id, addr, now)
+                return
+            info['addr'], info['last_seen'] = addr, now
+            note_packet(info, number)
+            chunk_file = info['file']
+            rejected = chunk_file.rejected
+            if not chunk_file.write(seq, data):
+                chunks_duplicate.inc()
+                return
+            chunks_received.inc()
+            if chunk_file.rejected != rejected:
+                blocks_rejected.inc()
+                print(f"⚠️  '{info['name']}': block {seq // chunk_file.block_chunks} failed verification, requesting again")
+            if progress_limiter.allow(transfer_id) is not None:
+                print(f"📦 '{info['name']}': {chunk_file.received}/{chunk_file.total} chunks received")
+            if ready(info):
+                self.complete_transfer(transfer_id, info)
+
+        elif packet_type == PACKET_HASH:
+            transfer_id, root, sha256 = unpack_hash(packet)
+
+            info = self.file_buffers.get(transfer_id)
+            if info is None:
+                self.reply_unknown(transfer_id, addr, now)
+                return
+            info['hash'], info['root'] = sha256, root
+            info['addr'], info['last_seen'] = addr, now
+            self.confirm_manifest(transfer_id, info)
+            if ready(info):
+                self.complete_transfer(transfer_id, info)
+
+    def send_reports(self, now):
+        """ 向每個進行中的傳送回報尚未收到的範圍，並清除中斷的傳送與過期的記錄 """
+        for transfer_id, info in list(self.file_buffers.items()):
+            chunk_file = info['file']
+            if now - info['last_seen'] > TRANSFER_TIMEOUT:
+                if chunk_file.resumable:
+                    chunk_file.close()  # 保留已驗證的區塊，重新傳送時複製相同內容的區塊（續傳）
+                else:
+                    chunk_file.abort()
+                del self.file_buffers[transfer_id]
+                release_name(info['name'], transfer_id)
+                files_completed.inc(label_value='timeout')
+                print(f"⌛ Transfer of '{info['name']}' timed out ({chunk_file.received}/{chunk_file.total} chunks)")
+                continue
+
+            # 已收到根雜湊表示第一輪已結束，區塊清單仍不完整時要求重送
+            flags = NACK_NEED_MANIFEST if info['root'] is not None and not info['confirmed'] else 0
+            if chunk_file.complete:
+                flags, ranges = flags or NACK_NEED_HASH, []
+            else:
+                # 還沒收到雜湊表示發送端可能仍在第一輪傳送，只回報目前最大編號之前的缺口
+                limit = None if info['hash'] is not None else chunk_file.highest
+                ranges = chunk_file.missing_ranges(limit, MAX_NACK_RANGES)
+                if not ranges and not flags:
+                    continue
+            self.sock.sendto(pack_nack(transfer_id, flags, ranges), info['addr'])
+            nacks_sent.inc()
+
+        for transfer_id, (_, finished_at) in list(self.finished.items()):
+            if now - finished_at > FINISHED_HISTORY:
+                del self.finished[transfer_id]
+        for transfer_id, until in list(self.replied.items()):
+            if until < now:
+                del self.replied[transfer_id]
+
+    def send_progress(self):
+        """ 向有新封包的傳送回報收到的最大封包編號與累計封包數 """
+        for transfer_id, info in self.file_buffers.items():
+            if info['packets'] == info['reported_packets'] or info['highest_packet'] is None:
+                continue
+            info['reported_packets'] = info['packets']
+            packets = info['packets'] % PACKET_NUMBER_MODULO
+            self.sock.sendto(pack_progress(transfer_id, info['highest_packet'], packets), info['addr'])
 
 def start_receiver():
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_RCVBUF)
     sock.bind((LISTEN_IP, LISTEN_PORT))
+    sock.settimeout(FEEDBACK_INTERVAL)
 
     print(f"🟢 Listening on UDP {LISTEN_PORT}...")
+    store.index_dir = os.path.join(RECEIVE_DIR, MANIFEST_INDEX)
+    print(f"🗂️  {store.load(RECEIVE_DIR)} blocks of earlier and interrupted files available for deduplication")
+    start_metrics_server(METRICS_PORT)
+
+    for _ in range(BUFFER_COUNT):
+        free_buffers.put(bytearray(max(CHUNK_SIZE + 100, MAX_PACKET_SIZE)))
+    workers[:] = [Worker(sock) for _ in range(WORKER_COUNT)]
+    for worker in workers:
+        worker.thread.start()
 
+    next_progress = time.monotonic() + FEEDBACK_INTERVAL
+    next_report = time.monotonic() + NACK_INTERVAL
     while True:
-        packet, addr = sock.recvfrom(CHUNK_SIZE + 100)
-        threading.Thread(target=handle_packet, args=(packet,), daemon=True).start()
+        buffer = free_buffers.get()  # 所有緩衝區都在排隊時在此等待工作執行緒
+        try:
+            length, addr = sock.recvfrom_into(buffer)
+        except socket.timeout:
+            free_buffers.put(buffer)
+        else:
+            if length >= PACKET_PREFIX.size:
+                _, transfer_id = PACKET_PREFIX.unpack_from(buffer)
+                worker = worker_for(transfer_id)
+                worker.submit(worker.handle_datagram, buffer, length, addr)
+            else:
+                free_buffers.put(buffer)
+
+        now = time.monotonic()
+        if now >= next_progress:
+            for worker in workers:
+                worker.submit(worker.send_progress)
+            next_progress = now + FEEDBACK_INTERVAL
+        if now >= next_report:
+            for worker in workers:
+                worker.submit(worker.send_reports, now)
+            next_report = now + NACK_INTERVAL
 
 if __name__ == "__main__":
     start_receiver()
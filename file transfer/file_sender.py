@@ -1,7 +1,20 @@
 import os
 import time
 import socket
-import hashlib
+import mmap
+import random
+import threading
+import queue
+import select
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.manifest import ManifestStream
+from common.pacing import RateController
+from common.watcher import WATCH_AUTO, open_watcher
+from protocol import (CHUNK_HEADER, DONE_HEADER, MAX_MANIFEST_DIGESTS, NACK_HAVE, NACK_HEADER, NACK_NEED_HASH,
+                      NACK_NEED_MANIFEST, NACK_NEED_METADATA, PACKET_CHUNK, PACKET_DONE, PACKET_NACK, PACKET_PROGRESS,
+                      PROGRESS_HEADER, TRANSFER_ID_MODULO, pack_hash, pack_manifest, pack_metadata, unpack_done,
+                      unpack_nack, unpack_progress)
 
 # 設定參數
 UPLOAD_DIR = "/home/tony/code/file-transfer/upload"
@@ -9,90 +22,212 @@ SENT_DIR = "/home/tony/code/file-transfer/sent"
 CHUNK_SIZE = 1024
 DEST_IP = "192.168.1.91"
 DEST_PORT = 5005
-PACKET_INTERVAL = 0.001  # 每個封包傳送間隔 (秒)
-
-# 檢查檔案是否在一定時間內保持大小穩定
-def wait_until_stable(filepath, wait_time=1, retries=5):
-    for i in range(retries):
-        size1 = os.path.getsize(filepath)
-        time.sleep(wait_time)
-        if not os.path.exists(filepath):
-            print(f"⚠️  檔案在等待過程中消失：{filepath}")
-            return False
-        size2 = os.path.getsize(filepath)
-        if size1 == size2:
-            return True
-        else:
-            print(f"⏳ 嘗試第 {i+1}/{retries} 次：檔案大小仍在變動")
-    return False
+TARGET_RATE_MBPS = 100  # 目標速率 (Mbit/s)；RATE_FEEDBACK 開啟時為速率上限
+RATE_FEEDBACK = True  # 依接收端的接收統計以 AIMD 找出路徑可承受的速率；False 時固定以目標速率傳送
+LOSS_TOLERANCE = 0.01  # 一次回報內的遺失比例超過此值才視為壅塞而降速
+FEEDBACK_POLL = 32  # 傳送途中每隔幾個封包取出一次接收端的回報
+MANIFEST_BLOCK_CHUNKS = 1024  # 每個驗證區塊的 chunk 數；接收端以區塊為單位驗證、續傳與去重
+REPORT_WAIT = 0.5  # 等待接收端回報的時間；沒有回報時重送雜湊封包促使接收端回報
+FEEDBACK_TIMEOUT = 10.0  # 超過此時間沒有任何回報就視為傳送失敗（檔案留在 upload 之後再試）
+SEND_WORKERS = 4  # 同時傳送的檔案數；每個傳送使用自己的 socket 與 transfer_id
+RETRY_DELAY = 5.0  # 傳送失敗的檔案留在 upload，隔多久再排入傳送
+WATCH_BACKEND = WATCH_AUTO  # 'inotify'、'poll' 或 'auto'（可用時使用 inotify，否則輪詢）
+
+ready_files = queue.Queue()  # 寫入完成、等待傳送的檔案路徑
+queued = set()  # 已排入或傳送中的檔案，避免同一個檔案重複排入
+queued_lock = threading.Lock()
+
+# 把區塊清單切成不超過 MTU 的清單封包
+def manifest_packets(transfer_id, leaves):
+    return [pack_manifest(transfer_id, first, leaves[first:first + MAX_MANIFEST_DIGESTS])
+            for first in range(0, len(leaves), MAX_MANIFEST_DIGESTS)]
+
+# 送出背景執行緒新算好的區塊雜湊
+def send_manifest(sock, transfer_id, manifest, dest):
+    while True:
+        batch = manifest.next_batch(MAX_MANIFEST_DIGESTS)
+        if batch is None:
+            return
+        sock.sendto(pack_manifest(transfer_id, *batch), dest)
+
+# 依序送出指定的 chunk，送出時機由速率控制決定；指定 manifest 時穿插送出區塊清單，並略過接收端已經有的區塊。
+# 回傳實際送出的 chunk 數
+def send_chunks(sock, view, transfer_id, seqs, dest, controller, manifest=None):
+    sent = 0
+    for seq in seqs:
+        if manifest is not None and manifest.have[seq // MANIFEST_BLOCK_CHUNKS]:
+            continue
+        start = seq * CHUNK_SIZE
+        chunk = view[start:start + CHUNK_SIZE]
+        number = controller.pace(CHUNK_HEADER.size + len(chunk))
+        # 標頭與資料分成兩段交給 sendmsg，不需要先串接成新的 bytes
+        header = CHUNK_HEADER.pack(PACKET_CHUNK, transfer_id, seq, number)
+        sock.sendmsg([header, chunk], [], 0, dest)
+        sent += 1
+        if sent % FEEDBACK_POLL == 0:
+            if manifest is not None:
+                send_manifest(sock, transfer_id, manifest, dest)
+            receive_report(sock, transfer_id, controller, manifest=manifest)  # 傳送途中只用接收統計調整速率
+    return sent
+
+# 最多等待 timeout 秒，取出佇列中所有回報：接收統計交給速率控制，已有區塊的回報記入 manifest，
+# 完成確認優先回傳，否則回傳最新的遺失回報
+def receive_report(sock, transfer_id, controller, timeout=0.0, manifest=None):
+    if not select.select([sock], [], [], timeout)[0]:
+        return None
+    latest = None
+    while True:
+        try:
+            packet, _ = sock.recvfrom(2048, socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            return latest
+        if not packet:
+            continue
+        if packet[0] == PACKET_PROGRESS and len(packet) >= PROGRESS_HEADER.size:
+            report_id, highest, received = unpack_progress(packet)
+            if report_id == transfer_id:
+                controller.on_progress(highest, received)
+                latest = latest or ('progress',)
+        elif packet[0] == PACKET_DONE and len(packet) >= DONE_HEADER.size:
+            report_id, verified = unpack_done(packet)
+            if report_id == transfer_id:
+                return 'done', verified
+        elif packet[0] == PACKET_NACK and len(packet) >= NACK_HEADER.size:
+            report_id, flags, ranges = unpack_nack(packet)
+            if report_id != transfer_id:
+                continue
+            if flags & NACK_HAVE:
+                if manifest is not None:
+                    manifest.mark_have(ranges)
+            else:
+                latest = 'nack', flags, ranges
+
+# 依接收端的遺失回報只重送缺少的範圍，直到接收端確認收齊並通過驗證；回傳重送的 chunk 數
+def wait_for_completion(sock, view, transfer_id, total_chunks, metadata, manifest, hash_packet, dest, controller):
+    retransmitted = 0
+    deadline = time.monotonic() + FEEDBACK_TIMEOUT
+    while True:
+        report = receive_report(sock, transfer_id, controller, REPORT_WAIT, manifest)
+        now = time.monotonic()
+        if report is None:
+            if now >= deadline:
+                raise TimeoutError(f"❌ 接收端超過 {FEEDBACK_TIMEOUT} 秒沒有回應")
+            sock.sendto(hash_packet, dest)  # 雜湊封包可能遺失，重送也會促使接收端回報完整的缺漏範圍
+            continue
+        deadline = now + FEEDBACK_TIMEOUT
+
+        if report[0] == 'done':
+            if not report[1]:
+                raise ValueError("❌ 接收端的雜湊驗證失敗")
+            return retransmitted
+        if report[0] == 'progress':
+            continue
+        _, flags, ranges = report
+        if flags & NACK_NEED_METADATA:
+            sock.sendto(metadata, dest)
+            sock.sendto(hash_packet, dest)
+        if flags & (NACK_NEED_METADATA | NACK_NEED_MANIFEST):
+            for packet in manifest_packets(transfer_id, manifest.leaves):
+                sock.sendto(packet, dest)
+        if flags & NACK_NEED_HASH:
+            sock.sendto(hash_packet, dest)
+        seqs = [seq for start, count in ranges for seq in range(start, min(start + count, total_chunks))]
+        send_chunks(sock, view, transfer_id, seqs, dest, controller)
+        retransmitted += len(seqs)
 
 # 傳送單一檔案
 def send_file(filepath, sock):
     filename = os.path.basename(filepath).encode()
-    filename_len = len(filename)
+    dest = (DEST_IP, DEST_PORT)
+    transfer_id = random.randrange(TRANSFER_ID_MODULO)  # 每次傳送各自的編號，接收端據此分辨同時進行的傳送
+    controller = RateController(TARGET_RATE_MBPS, RATE_FEEDBACK, LOSS_TOLERANCE)
 
     with open(filepath, "rb") as f:
-        data = f.read()
-
-    total_chunks = (len(data) + CHUNK_SIZE - 1) // CHUNK_SIZE
-    if total_chunks >= 2**32:
-        raise ValueError("❌ 檔案太大，無法處理（超過 4GB / 4 billion chunks）")
-
-    sha256 = hashlib.sha256(data).hexdigest().encode()
-
-    # metadata 封包：type=0x00 | total_chunks (4 bytes) | filename_len (1 byte) | filename | sha256
-    metadata = (
-        b"\x00" +
-        total_chunks.to_bytes(4, 'big') +
-        bytes([filename_len]) +
-        filename +
-        sha256
-    )
-    sock.sendto(metadata, (DEST_IP, DEST_PORT))
-    print(f"📤 傳送 metadata：{filepath} ({total_chunks} chunks)")
-    time.sleep(0.1)
-
-    for seq in range(total_chunks):
-        start = seq * CHUNK_SIZE
-        end = start + CHUNK_SIZE
-        chunk = data[start:end]
-        packet = b"\x01" + seq.to_bytes(4, 'big') + chunk
-        sock.sendto(packet, (DEST_IP, DEST_PORT))
-        time.sleep(PACKET_INTERVAL)
+        size = os.fstat(f.fileno()).st_size
+        total_chunks = (size + CHUNK_SIZE - 1) // CHUNK_SIZE
+        if total_chunks >= 2**32:
+            raise ValueError("❌ 檔案太大，無法處理（超過 4GB / 4 billion chunks）")
+
+        # 以 mmap 對應檔案，chunk 直接從 memoryview 切片送出，不把整個檔案讀進記憶體
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        if mapped is not None and hasattr(mapped, 'madvise'):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        view = memoryview(mapped) if mapped is not None else memoryview(b"")
+
+        # 區塊清單與整個檔案的雜湊在背景計算（讀一次檔案），與傳送同時進行；算好的清單穿插在資料中送出，
+        # 接收端回報已經有的區塊（續傳、本機已有相同內容）在傳送到時略過
+        manifest = ManifestStream(view, MANIFEST_BLOCK_CHUNKS * CHUNK_SIZE)
+        manifest.start()
+        try:
+            metadata = pack_metadata(transfer_id, total_chunks, MANIFEST_BLOCK_CHUNKS, filename)
+            print(f"📤 傳送 metadata：{filepath} ({total_chunks} chunks, {manifest.count} 個區塊, transfer {transfer_id:08x})")
+            sock.sendto(metadata, dest)
+            sent = send_chunks(sock, view, transfer_id, range(total_chunks), dest, controller, manifest)
+
+            manifest.join()
+            send_manifest(sock, transfer_id, manifest, dest)
+            hash_packet = pack_hash(transfer_id, manifest.root(), manifest.sha256.hexdigest().encode())
+            sock.sendto(hash_packet, dest)
+            retransmitted = wait_for_completion(sock, view, transfer_id, total_chunks, metadata, manifest, hash_packet,
+                                                dest, controller)
+        finally:
+            manifest.stop()
+            view.release()
+            if mapped is not None:
+                mapped.close()
+
+    print(f"✅ 傳送完成：{filepath} ({total_chunks} chunks，傳送 {sent} 個，重送 {retransmitted} 個，"
+          f"最終速率 {controller.describe()})")
 
-    print(f"✅ 傳送完成：{filepath} ({total_chunks} chunks)")
+# 排入待傳送佇列；已在佇列中或傳送中的檔案略過
+def enqueue(path):
+    with queued_lock:
+        if path in queued:
+            return
+        queued.add(path)
+    ready_files.put(path)
 
-# 監控 upload 資料夾，並傳送新檔案
+# 傳送工作執行緒：各自使用一個 socket，多個檔案同時傳送
+def send_worker():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    while True:
+        src = ready_files.get()
+        fname = os.path.basename(src)
+        try:
+            if not os.path.exists(src):
+                print(f"⚠️  檔案不存在，跳過：{fname}")
+                continue
+            send_file(src, sock)
+            dst = os.path.join(SENT_DIR, fname)
+            os.rename(src, dst)
+            print(f"📦 檔案已移動到 sent：{dst}")
+        except Exception as e:
+            print(f"❌ 傳送失敗：{src}\n   錯誤：{e}")
+            retry = threading.Timer(RETRY_DELAY, enqueue, args=(src,))
+            retry.daemon = True
+            retry.start()
+        finally:
+            with queued_lock:
+                queued.discard(src)
+
+# 監控 upload 資料夾，寫入完成的檔案立刻排入傳送
 def watch_folder():
     os.makedirs(SENT_DIR, exist_ok=True)
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    for _ in range(SEND_WORKERS):
+        threading.Thread(target=send_worker, daemon=True).start()
 
-    print(f"📡 正在監控資料夾：'{UPLOAD_DIR}'")
+    watcher = open_watcher(UPLOAD_DIR, WATCH_BACKEND)
+    print(f"📡 正在監控資料夾：'{UPLOAD_DIR}'（{watcher.name}，最多 {SEND_WORKERS} 個檔案同時傳送）")
     while True:
         try:
-            files = [f for f in os.listdir(UPLOAD_DIR) if os.path.isfile(os.path.join(UPLOAD_DIR, f))]
-            for fname in files:
-                src = os.path.join(UPLOAD_DIR, fname)
-                print(f"\n🔍 檢查檔案：{fname}")
-
-                if not os.path.exists(src):
-                    print(f"⚠️  檔案不存在，跳過：{fname}")
-                    continue
-
-                if not wait_until_stable(src):
-                    print(f"🕒 檔案未穩定，跳過：{fname}")
-                    continue
-
-                try:
-                    send_file(src, sock)
-                    dst = os.path.join(SENT_DIR, fname)
-                    os.rename(src, dst)
-                    print(f"📦 檔案已移動到 sent：{dst}")
-                except Exception as e:
-                    print(f"❌ 傳送失敗：{src}\n   錯誤：{e}")
+            for src in watcher.wait():
+                print(f"\n🔍 檔案就緒：{os.path.basename(src)}")
+                enqueue(src)
         except Exception as main_loop_error:
             print(f"💥 主循環錯誤：{main_loop_error}")
-        time.sleep(1)
+            time.sleep(1)
+            watcher.close()
+            watcher = open_watcher(UPLOAD_DIR, WATCH_BACKEND)
 
 if __name__ == "__main__":
     watch_folder()
@@ -0,0 +1,117 @@
+import struct
+
+# === 檔案傳輸的封包格式 ===
+#
+# 每個封包的第一個 byte 是封包類型，接著是 transfer_id（發送端為每次傳送隨機產生的 4 bytes 編號），
+# 接收端以 transfer_id 直接查表，多個檔案同時傳送時不會把 chunk 放進錯誤的檔案。
+#   metadata：type=0x00 | transfer_id (4) | total_chunks (4) | block_chunks (2) | filename_len (1) | filename
+#             | [sha256]
+#   chunk：   type=0x01 | transfer_id (4) | seq (4) | packet_number (4) | 資料
+#   雜湊：    type=0x02 | transfer_id (4) | merkle_root (32) | sha256（hex）
+#   清單：    type=0x07 | transfer_id (4) | first (4) | count (1) | count × 區塊雜湊 (32)
+#
+# 發送端送出 metadata 後立刻開始傳送資料，區塊清單（每 block_chunks 個 chunk 一個 SHA-256，第 first 個起共 count 個）
+# 在背景算好一段就穿插送出一段（common.manifest）。接收端每收到一段清單，就以 NACK_HAVE 回報其中已經有的區塊
+# （已驗證過、中斷的傳送留下的或本機已有相同內容），發送端傳送到這些區塊時略過。
+# 第一輪傳送完之後以 0x02 封包送出 Merkle 根雜湊與整個檔案的雜湊，接收端以根雜湊確認收到的清單完整無誤。
+# metadata 的 sha256 欄位通常是空的。
+#
+# 接收端回傳給發送端（送往發送端的來源地址）：
+#   遺失回報：type=0x03 | transfer_id (4) | flags (1) | range_count (2) | range_count × [start (4) | count (4)]
+#     flags：NACK_NEED_METADATA（沒收到 metadata）、NACK_NEED_HASH（chunk 已收齊但還沒收到雜湊）、
+#            NACK_NEED_MANIFEST（區塊清單不完整或與根雜湊不符，發送端重送整個清單）、
+#            NACK_HAVE（回應一段清單，ranges 是接收端已經有的「區塊」範圍，不是遺失的 chunk）
+#     ranges：尚未收到的連續 chunk 範圍，由小到大，最多 MAX_NACK_RANGES 個；發送端只重送這些範圍
+#   完成確認：type=0x04 | transfer_id (4) | verified (1)
+#   接收統計：type=0x06 | transfer_id (4) | highest_packet (4) | packets_received (4)
+#     發送端依送出順序為每個資料封包編號（packet_number，重送的封包也有新的編號），接收端定期回報
+#     收到的最大編號與累計封包數，發送端據此估計遺失率並調整速率（common.pacing）
+
+PACKET_METADATA = 0x00
+PACKET_CHUNK = 0x01
+PACKET_HASH = 0x02
+PACKET_NACK = 0x03
+PACKET_DONE = 0x04
+PACKET_PROGRESS = 0x06
+PACKET_MANIFEST = 0x07
+
+PACKET_PREFIX = struct.Struct("!B I")  # 所有封包共同的開頭（type、transfer_id），接收端據此分派
+METADATA_HEADER = struct.Struct("!B I I H B")
+CHUNK_HEADER = struct.Struct("!B I I I")
+HASH_HEADER = struct.Struct("!B I 32s")
+NACK_HEADER = struct.Struct("!B I B H")
+NACK_RANGE = struct.Struct("!I I")
+DONE_HEADER = struct.Struct("!B I B")
+PROGRESS_HEADER = struct.Struct("!B I I I")
+MANIFEST_HEADER = struct.Struct("!B I I B")
+DIGEST_SIZE = 32
+
+NACK_NEED_METADATA = 0x01
+NACK_NEED_HASH = 0x02
+NACK_NEED_MANIFEST = 0x04
+NACK_HAVE = 0x08
+MAX_PACKET_SIZE = 1472  # 1500 MTU - IP 20 - UDP 8；接收緩衝區至少要這麼大，否則較長的封包會被核心截斷
+MAX_NACK_RANGES = (MAX_PACKET_SIZE - NACK_HEADER.size) // NACK_RANGE.size  # 單一封包不超過 1500 MTU
+MAX_MANIFEST_DIGESTS = (MAX_PACKET_SIZE - MANIFEST_HEADER.size) // DIGEST_SIZE
+
+TRANSFER_ID_MODULO = 1 << 32
+
+def pack_metadata(transfer_id, total_chunks, block_chunks, filename, sha256=b""):
+    header = METADATA_HEADER.pack(PACKET_METADATA, transfer_id, total_chunks, block_chunks, len(filename))
+    return header + filename + sha256
+
+def unpack_metadata(packet):
+    """ 回傳 (transfer_id, total_chunks, block_chunks, filename, sha256)；沒有附帶雜湊時 sha256 為 None """
+    _, transfer_id, total_chunks, block_chunks, name_len = METADATA_HEADER.unpack_from(packet)
+    start = METADATA_HEADER.size
+    filename = bytes(packet[start:start + name_len]).decode()
+    sha256 = bytes(packet[start + name_len:]).decode() or None
+    return transfer_id, total_chunks, block_chunks, filename, sha256
+
+def pack_hash(transfer_id, root, sha256):
+    return HASH_HEADER.pack(PACKET_HASH, transfer_id, root) + sha256
+
+def unpack_hash(packet):
+    """ 回傳 (transfer_id, root, sha256) """
+    _, transfer_id, root = HASH_HEADER.unpack_from(packet)
+    return transfer_id, root, bytes(packet[HASH_HEADER.size:]).decode()
+
+def pack_nack(transfer_id, flags, ranges):
+    packet = bytearray(NACK_HEADER.pack(PACKET_NACK, transfer_id, flags, len(ranges)))
+    for start, count in ranges:
+        packet += NACK_RANGE.pack(start, count)
+    return bytes(packet)
+
+def unpack_nack(packet):
+    """ 回傳 (transfer_id, flags, [(start, count), ...]) """
+    _, transfer_id, flags, range_count = NACK_HEADER.unpack_from(packet)
+    ranges = [NACK_RANGE.unpack_from(packet, NACK_HEADER.size + i * NACK_RANGE.size) for i in range(range_count)]
+    return transfer_id, flags, ranges
+
+def pack_done(transfer_id, verified):
+    return DONE_HEADER.pack(PACKET_DONE, transfer_id, 1 if verified else 0)
+
+def unpack_done(packet):
+    """ 回傳 (transfer_id, verified) """
+    _, transfer_id, verified = DONE_HEADER.unpack_from(packet)
+    return transfer_id, bool(verified)
+
+def pack_progress(transfer_id, highest_packet, packets_received):
+    return PROGRESS_HEADER.pack(PACKET_PROGRESS, transfer_id, highest_packet, packets_received)
+
+def unpack_progress(packet):
+    """ 回傳 (transfer_id, highest_packet, packets_received) """
+    _, transfer_id, highest_packet, packets_received = PROGRESS_HEADER.unpack_from(packet)
+    return transfer_id, highest_packet, packets_received
+
+def pack_manifest(transfer_id, first, digests):
+    return MANIFEST_HEADER.pack(PACKET_MANIFEST, transfer_id, first, len(digests)) + b"".join(digests)
+
+def unpack_manifest(packet):
+    """ 回傳 (transfer_id, first, [digest, ...])；長度不足 count 個雜湊（被截斷）時丟出 ValueError """
+    _, transfer_id, first, count = MANIFEST_HEADER.unpack_from(packet)
+    start = MANIFEST_HEADER.size
+    if len(packet) < start + count * DIGEST_SIZE:
+        raise ValueError(f"Truncated manifest packet ({len(packet)} bytes for {count} digests)")
+    digests = [bytes(packet[start + i * DIGEST_SIZE:start + (i + 1) * DIGEST_SIZE]) for i in range(count)]
+    return transfer_id, first, digests
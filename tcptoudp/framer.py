@@ -0,0 +1,89 @@
+import struct
+
+# === TCP 位元組流的訊息切割 ===
+#
+# FRAMING_NEWLINE：以 \n 分隔的文字訊息（原本的行為，\n 不會被傳送）
+# FRAMING_LENGTH ：4 bytes 大端序長度 + 內容，可傳送含 \n 的二進位資料
+
+FRAMING_NEWLINE = 'newline'
+FRAMING_LENGTH = 'length'
+
+LENGTH_PREFIX = struct.Struct("!I")
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024  # 單一訊息上限，避免惡意或錯誤的資料流讓緩衝無限成長
+
+class FramingError(ValueError):
+    """ 資料流不符合切割格式（例如訊息超過 MAX_MESSAGE_SIZE） """
+
+class StreamFramer:
+    """ 以 bytearray 累積資料並從上次掃描的位置繼續找邊界，訊息以 memoryview 交出不複製
+
+    每個位元組只會被掃描一次；已處理的前段在每次 feed 結束時一次移除，
+    剩下的只有最後一個不完整的訊息，因此總成本與資料量成線性。
+    """
+
+    def __init__(self, mode=FRAMING_NEWLINE, max_message_size=MAX_MESSAGE_SIZE):
+        if mode not in (FRAMING_NEWLINE, FRAMING_LENGTH):
+            raise ValueError(f"Unknown framing mode: {mode}")
+        self.mode = mode
+        self.max_message_size = max_message_size
+        self.buffer = bytearray()
+        self.start = 0     # 目前未處理訊息的起點
+        self.scan_pos = 0  # 換行模式下已掃描過的位置
+
+    def feed(self, data, on_message):
+        """ 加入新資料，對每個完整訊息呼叫 on_message(memoryview)
+
+        傳入的 memoryview 只在回呼期間有效，需要保留內容時請自行複製。
+        """
+        buffer = self.buffer
+        buffer += data
+        view = memoryview(buffer)
+        try:
+            if self.mode == FRAMING_NEWLINE:
+                self._split_lines(view, on_message)
+            else:
+                self._split_length_prefixed(view, on_message)
+        finally:
+            view.release()
+
+        if self.start:
+            del buffer[:self.start]
+            self.scan_pos -= self.start
+            self.start = 0
+        if len(buffer) > self.max_message_size + LENGTH_PREFIX.size:
+            raise FramingError(f"Message exceeds {self.max_message_size} bytes")
+
+    def _split_lines(self, view, on_message):
+        buffer = self.buffer
+        while True:
+            end = buffer.find(b"\n", self.scan_pos)
+            if end < 0:
+                self.scan_pos = len(buffer)
+                return
+            self._emit(view[self.start:end], on_message)
+            self.start = self.scan_pos = end + 1
+
+    def _split_length_prefixed(self, view, on_message):
+        buffer = self.buffer
+        while len(buffer) - self.start >= LENGTH_PREFIX.size:
+            length, = LENGTH_PREFIX.unpack_from(buffer, self.start)
+            if length > self.max_message_size:
+                raise FramingError(f"Message length {length} exceeds {self.max_message_size} bytes")
+            body = self.start + LENGTH_PREFIX.size
+            if len(buffer) - body < length:
+                return
+            self._emit(view[body:body + length], on_message)
+            self.start = body + length
+
+    @staticmethod
+    def _emit(message, on_message):
+        try:
+            on_message(message)
+        finally:
+            message.release()
+
+def frame_message(message, mode=FRAMING_NEWLINE):
+    """ StreamFramer 的反向操作：把訊息還原成資料流中的位元組 """
+    if mode == FRAMING_NEWLINE:
+        return bytes(message) + b"\n"
+    return LENGTH_PREFIX.pack(len(message)) + bytes(message)
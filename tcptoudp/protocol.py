@@ -0,0 +1,35 @@
+import struct
+
+# === TCP→UDP 通道的封包格式 ===
+#
+# 每個 UDP 封包 = flow 標頭 + 內容
+#   flow 標頭：epoch (4) | flow_id (2) | block_id (4) | index (1) | k (1) | m (1) | symbol_size (2)
+#   epoch：proxy 每次啟動時隨機產生，重新啟動後沿用相同 flow_id 的連線不會被當成先前已關閉的 flow
+#   index <  k：原始封包，內容 = TCP 標頭 (20) + 資料片段
+#   index >= k：冗餘封包，內容 = 第 index - k 個 (k, m) 抹除碼冗餘封包（長度 = symbol_size）
+#
+# 同一個 flow（= 一條 TCP 連線）的封包各自組成 FEC 區塊，區塊之間不會混到其他連線的資料。
+
+FLOW_HEADER = struct.Struct("!I H I B B B H")
+TCP_HEADER = struct.Struct("!I I H H H H H H")
+
+UDP_MAX_PAYLOAD = 1472  # 1500 MTU - IP 20 - UDP 8
+MAX_SEGMENT_SIZE = UDP_MAX_PAYLOAD - FLOW_HEADER.size - TCP_HEADER.size  # 單一片段的最大資料長度
+
+# TCP 標頭 flags 欄位
+TCP_FLAG_FIN = 0b000001  # flow 結束（TCP 連線已關閉）
+TCP_FLAG_PSH = 0b001000  # 訊息的最後一個片段，接收端在此補回分隔符號
+TCP_FLAG_URG = 0b100000
+
+FLOW_ID_MODULO = 1 << 16
+EPOCH_MODULO = 1 << 32
+SEQ_MODULO = 1 << 32
+
+def pack_tcp_header(seq_num, flags, length):
+    """ 建立 20 bytes 的 TCP 標頭（沿用原本的欄位配置） """
+    return TCP_HEADER.pack(seq_num, 0, 5 << 12, flags, 1024, 0, 0, length)
+
+def unpack_tcp_header(data):
+    """ 回傳 (seq_num, flags, length) """
+    seq_num, _, _, flags, _, _, _, length = TCP_HEADER.unpack_from(data)
+    return seq_num, flags, length
@@ -1,12 +1,24 @@
+import os
+import random
+import sys
 import socket
+import selectors
 import threading
-import struct
-import reedsolo  # Reed-Solomon FEC
+import heapq
+import itertools
 import time
 import logging
+import resource
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.erasure import get_codec  # 封包層級 (k, m) 抹除碼
+from common.udpio import open_batch_io, UDP_IO_AUTO
+from common.metrics import REGISTRY, start_metrics_server
+from framer import StreamFramer, FramingError, FRAMING_NEWLINE
+from protocol import (FLOW_HEADER, MAX_SEGMENT_SIZE, TCP_FLAG_FIN, TCP_FLAG_PSH, TCP_FLAG_URG,
+                      EPOCH_MODULO, FLOW_ID_MODULO, SEQ_MODULO, pack_tcp_header)
 
 # 設定日誌記錄
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 # 設定參數
 TCP_HOST = '0.0.0.0'  # 監聽所有網路介面
@@ -15,113 +27,276 @@ UDP_HOST = '172.16.1.92'  # 目標 UDP 伺服器的 IP 地址
 UDP_PORT = 6000        # 目標 UDP 伺服器的埠號
 LOCAL_UDP_IP = '172.16.1.91'  # 指定使用 ens192（本機 IP）
 
+# 執行模式
+PROXY_MODE = 'eventloop'  # 'eventloop'：單一事件迴圈處理所有連線；'thread'：每個連線一條執行緒
+TCP_BACKLOG = 4096     # accept 佇列長度（實際上限受 net.core.somaxconn 限制）
+TCP_RECV_SIZE = 4096   # 每次 recv 的最大位元組數
+FRAMING_MODE = FRAMING_NEWLINE  # FRAMING_NEWLINE：以 \n 分隔；FRAMING_LENGTH：4 bytes 長度前綴（可傳二進位資料）
+UDP_IO_BACKEND = UDP_IO_AUTO  # UDP_IO_AUTO：Linux 上以 sendmmsg 一次送出整個區塊；UDP_IO_SOCKET：逐一 sendto
+METRICS_PORT = 9102    # 本機統計端點 /metrics、/metrics.json；None 表示不啟動
+
 # FEC 參數（可調整）
 FEC_ORIGINAL_PACKETS = 10  # 原始封包數量
-FEC_REDUNDANT_PACKETS = 5  # 冗餘封包數量
+FEC_REDUNDANT_PACKETS = 5  # 冗餘封包數量（每個區塊最多可承受遺失的封包數）
 FEC_BATCH_SIZE = FEC_ORIGINAL_PACKETS  # FEC 需要多少個封包才觸發
 FEC_TIMEOUT = 0.1  # 最多等待 100ms，如果沒湊齊 FEC_BATCH_SIZE 個封包就直接發送
 
-# 初始化 Reed-Solomon FEC
-fec = reedsolo.RSCodec(FEC_REDUNDANT_PACKETS)
+PROXY_EPOCH = random.randrange(EPOCH_MODULO)  # 每次啟動不同，接收端以 (來源, flow_id, epoch) 區分 flow
+
+# 統計
+connections_accepted = REGISTRY.counter('proxy_connections_accepted_total', 'TCP connections accepted')
+active_connections = REGISTRY.gauge('proxy_active_connections', 'TCP connections currently open')
+tcp_bytes_in = REGISTRY.counter('proxy_tcp_bytes_in_total', 'Bytes read from TCP clients')
+messages_in = REGISTRY.counter('proxy_messages_in_total', 'Framed messages read from TCP clients')
+packets_out = REGISTRY.counter('proxy_udp_packets_out_total', 'UDP packets sent (data + parity)')
+blocks_encoded = REGISTRY.counter('proxy_blocks_encoded_total', 'FEC blocks encoded and sent')
+block_flushes = REGISTRY.counter('proxy_block_flushes_total', 'FEC blocks closed, by reason', label='reason')
+errors = REGISTRY.counter('proxy_errors_total', 'Connection and framing errors')
+encode_seconds = REGISTRY.histogram('proxy_encode_seconds', 'Time spent computing parity for one block')
+
+class FlowEncoder:
+    """ 單一 flow（TCP 連線）的 FEC 區塊組裝狀態，各連線互不共用緩存 """
+    __slots__ = ('flow_id', 'block_id', 'seq_num', 'packets', 'deadline', 'lock')
+
+    def __init__(self, flow_id):
+        self.flow_id = flow_id
+        self.block_id = 0
+        self.seq_num = 0      # 每個 flow 各自的序號
+        self.packets = []     # 目前區塊尚未發送的封包
+        self.deadline = 0.0   # 目前區塊最晚的發送時間
+        self.lock = threading.Lock()  # 只有執行緒模式下會與計時器執行緒競爭
+
+    def add_segment(self, segment, flags, udp_io, clock):
+        """ 為片段加上 TCP 標頭並放入目前區塊，湊滿批次時立即發送 """
+        if not self.packets:
+            self.deadline = clock() + FEC_TIMEOUT
+        self.packets.append(pack_tcp_header(self.seq_num, flags, len(segment)) + segment)
+        self.seq_num = (self.seq_num + 1) % SEQ_MODULO
+
+        # 當達到批次大小時，立即發送
+        if len(self.packets) >= FEC_BATCH_SIZE:
+            self.flush(udp_io, 'full')
+
+    def add_message(self, message, udp_io, clock):
+        """ 將一個完整訊息切成不超過 MAX_SEGMENT_SIZE 的片段，最後一片帶 PSH """
+        messages_in.inc()
+        for start in range(0, max(len(message), 1), MAX_SEGMENT_SIZE):
+            segment = message[start:start + MAX_SEGMENT_SIZE]
+            last = start + MAX_SEGMENT_SIZE >= len(message)
+            self.add_segment(segment, TCP_FLAG_URG | TCP_FLAG_PSH if last else TCP_FLAG_URG, udp_io, clock)
+
+    def close(self, udp_io, clock):
+        """ 連線關閉：送出 FIN 片段並立即發送剩餘區塊 """
+        self.add_segment(b"", TCP_FLAG_URG | TCP_FLAG_FIN, udp_io, clock)
+        self.flush(udp_io, 'close')
 
-def fec_timer_trigger(packets, last_send_time, udp_socket):
-    """ 獨立執行緒定期檢查 FEC 是否超時 """
+    def flush(self, udp_io, reason):
+        if self.packets:
+            block_flushes.inc(label_value=reason)
+            packets, self.packets = self.packets, []
+            block_id, self.block_id = self.block_id, (self.block_id + 1) % SEQ_MODULO  # 發送失敗時也不重用區塊編號
+            fec_encode_and_send(self.flow_id, block_id, packets, udp_io)
+
+def fec_timer_trigger(flows, flows_lock, udp_io):
+    """ 獨立執行緒定期檢查各 flow 的 FEC 是否超時 """
     while True:
         time.sleep(0.01)  # 每 10ms 檢查一次
-        elapsed_time = time.time() - last_send_time[0]
-        if packets and elapsed_time > FEC_TIMEOUT:
-            logging.debug("FEC Timeout reached, sending packets")
-            fec_encode_and_send(packets, udp_socket)
-            packets.clear()
-            last_send_time[0] = time.time()
-
-def fec_encode_and_send(packets, udp_socket):
-    """ 執行 FEC 編碼並發送 UDP 封包，若封包不足則補零 """
-    missing_packets = FEC_BATCH_SIZE - len(packets)
-    if missing_packets > 0:
-        logging.debug(f"Padding {missing_packets} empty packets to meet FEC requirement")
-        for _ in range(missing_packets):
-            packets.append(b'\x00' * len(packets[0]))  # 補零
-
-    fec_encoded_packets = fec.encode(b"".join(packets))  # 產生冗餘數據
-    udp_packets = packets + [fec_encoded_packets[i:i+len(packets[0])] for i in range(0, len(fec_encoded_packets), len(packets[0]))]
-    for udp_packet in udp_packets:
-        if len(udp_packet) > 1472:
-            for i in range(0, len(udp_packet), 1472):
-                udp_socket.sendto(udp_packet[i:i+1472], (UDP_HOST, UDP_PORT))
-        else:
-            udp_socket.sendto(udp_packet, (UDP_HOST, UDP_PORT))
-    logging.debug("Sent FEC protected packets")
+        now = time.monotonic()
+        with flows_lock:
+            active_flows = list(flows.values())
+        for flow in active_flows:
+            with flow.lock:
+                if flow.packets and now >= flow.deadline:
+                    try:
+                        flow.flush(udp_io, 'timeout')
+                    except OSError as e:
+                        errors.inc()
+                        logging.error(f"Flow {flow.flow_id}: {e}")  # 這個區塊遺失，計時器繼續巡查其他 flow
+
+def fec_encode_and_send(flow_id, block_id, packets, udp_io):
+    """ 執行 FEC 編碼並發送 UDP 封包；編碼時補零到區塊內最大封包長度，原始封包則原樣送出 """
+    k, m = len(packets), FEC_REDUNDANT_PACKETS
+    symbol_size = max(len(packet) for packet in packets)
+    with encode_seconds.time():
+        parity_packets = get_codec(k, m).encode(packets)  # 產生 m 個冗餘封包
+    datagrams = [FLOW_HEADER.pack(PROXY_EPOCH, flow_id, block_id, index, k, m, symbol_size) + udp_packet
+                 for index, udp_packet in enumerate(packets + parity_packets)]
+    packets_out.inc(udp_io.send_batch(datagrams, (UDP_HOST, UDP_PORT)))  # 整個區塊一次送出
+    blocks_encoded.inc()
 
 # 處理 TCP 連線並將資料轉發至 UDP
-def handle_tcp_client(client_socket, udp_socket, packets, last_send_time):
+def handle_tcp_client(client_socket, udp_io, flow, flows, flows_lock):
     try:
-        buffer = b""  # 用來處理分批 TCP 數據
-        seq_num = 0  # 初始化序號
+        framer = StreamFramer(FRAMING_MODE)  # 用來處理分批 TCP 數據
         
-        logging.debug("Started handling new TCP connection")
         while True:
-            data = client_socket.recv(4096)  # 增加接收緩衝區大小
+            data = client_socket.recv(TCP_RECV_SIZE)
             if not data:
-                logging.debug("TCP connection closed by client")
                 break  # 連線關閉
+            tcp_bytes_in.inc(len(data))
 
-            buffer += data  # 將接收的 TCP 數據追加到緩衝區
-            logging.debug(f"Received data: {data}")
-
-            while b"\n" in buffer:
-                packet, buffer = buffer.split(b"\n", 1)  # 擷取完整封包
-                logging.debug(f"Processing packet: {packet}")
-
-                # 建立 TCP 標頭
-                tcp_header = struct.pack("!I I H H H H H H", 
-                                         seq_num,  
-                                         0,  
-                                         5 << 12,  
-                                         0b101000,  
-                                         1024,  
-                                         0,  
-                                         0,  
-                                         len(packet))  
-
-                full_packet = tcp_header + packet
-                packets.append(full_packet)  # 儲存封包
-                seq_num += 1
-                logging.debug(f"Buffered {len(packets)} packets")
-
-                # 當達到批次大小時，立即發送
-                if len(packets) >= FEC_BATCH_SIZE:
-                    logging.debug(f"FEC triggered by batch size: {len(packets)} packets")
-                    fec_encode_and_send(packets, udp_socket)
-                    packets.clear()
-                    last_send_time[0] = time.time()
+            with flow.lock:
+                framer.feed(data, lambda message: flow.add_message(message, udp_io, time.monotonic))
     except Exception as e:
-        logging.error(f"Error: {e}")
+        errors.inc()
+        logging.error(f"Flow {flow.flow_id}: {e}")
     finally:
         client_socket.close()  # 關閉 TCP 連線
+        active_connections.inc(-1)
+        try:
+            with flow.lock:
+                flow.close(udp_io, time.monotonic)
+        except OSError as e:
+            errors.inc()
+            logging.error(f"Flow {flow.flow_id}: {e}")
+        with flows_lock:
+            flows.pop(flow.flow_id, None)
+
+class TcpConnection:
+    """ 事件迴圈模式下單一 TCP 連線的狀態（取代每連線一條執行緒） """
+    __slots__ = ('sock', 'addr', 'framer', 'flow', 'scheduled_block')
+
+    def __init__(self, sock, addr, flow):
+        self.sock = sock
+        self.addr = addr
+        self.framer = StreamFramer(FRAMING_MODE)  # 用來處理分批 TCP 數據
+        self.flow = flow   # 此連線專屬的 FEC 區塊組裝
+        self.scheduled_block = None  # 已排程超時發送的區塊編號
+
+def raise_nofile_limit():
+    """ 將可開啟的檔案描述符上限提高到硬上限，讓事件迴圈能同時持有數千個連線 """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError) as e:
+            logging.warning(f"Unable to raise RLIMIT_NOFILE from {soft}: {e}")
+
+def accept_clients(tcp_server, selector, flow_ids):
+    """ 一次接受所有已排隊的連線 """
+    while True:
+        try:
+            client_socket, addr = tcp_server.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            logging.error(f"Accept failed: {e}")  # 例如 EMFILE，留待下次就緒時再試
+            return
+        flow = FlowEncoder(next(flow_ids) % FLOW_ID_MODULO)
+        connections_accepted.inc()
+        active_connections.inc()
+        logging.debug(f"Accepted connection from {addr} (flow {flow.flow_id})")
+        client_socket.setblocking(False)
+        selector.register(client_socket, selectors.EVENT_READ, TcpConnection(client_socket, addr, flow))
+
+def close_tcp_client(conn, selector, udp_io):
+    """ 取消註冊並關閉連線，送出 FIN 與剩餘區塊；UDP 發送失敗只影響這個連線 """
+    selector.unregister(conn.sock)
+    conn.sock.close()  # 關閉 TCP 連線
+    active_connections.inc(-1)
+    try:
+        conn.flow.close(udp_io, time.monotonic)
+    except OSError as e:
+        errors.inc()
+        logging.error(f"Flow {conn.flow.flow_id}: {e}")
+
+def read_tcp_client(conn, selector, udp_io):
+    """ 讀取一次就緒連線的資料並切出完整封包；連線關閉或出錯時取消註冊 """
+    try:
+        data = conn.sock.recv(TCP_RECV_SIZE)
+    except (BlockingIOError, InterruptedError):
+        return
+    except OSError as e:
+        errors.inc()
+        logging.error(f"Flow {conn.flow.flow_id}: {e}")
+        data = b""
+
+    if not data:
+        close_tcp_client(conn, selector, udp_io)
+        return
+    tcp_bytes_in.inc(len(data))
+
+    try:
+        conn.framer.feed(data, lambda message: conn.flow.add_message(message, udp_io, time.monotonic))
+    except (FramingError, OSError) as e:  # OSError：UDP 發送失敗（例如 ENOBUFS、EPERM），只關閉這個連線
+        errors.inc()
+        logging.error(f"Flow {conn.flow.flow_id}: {e}")
+        close_tcp_client(conn, selector, udp_io)
+
+def run_event_loop(tcp_server, udp_io):
+    """ 單一執行緒事件迴圈：accept、TCP 讀取、FEC 超時發送與 UDP 發送都在同一個迴圈完成 """
+    selector = selectors.DefaultSelector()
+    tcp_server.setblocking(False)
+    selector.register(tcp_server, selectors.EVENT_READ)
+
+    flow_ids = itertools.count()
+    deadlines = []  # (發送期限, 序號, flow, block_id) 的最小堆積
+    tie_breaker = itertools.count()
+
+    while True:
+        # 有待發送的區塊時，只睡到最早的 FEC 超時時間點
+        timeout = None
+        if deadlines:
+            timeout = max(0.0, deadlines[0][0] - time.monotonic())
+
+        for key, _ in selector.select(timeout):
+            if key.data is None:
+                accept_clients(tcp_server, selector, flow_ids)
+                continue
+            conn = key.data
+            read_tcp_client(conn, selector, udp_io)
+            flow = conn.flow
+            if flow.packets and conn.scheduled_block != flow.block_id:
+                conn.scheduled_block = flow.block_id
+                heapq.heappush(deadlines, (flow.deadline, next(tie_breaker), flow, flow.block_id))
+
+        now = time.monotonic()
+        while deadlines and deadlines[0][0] <= now:
+            _, _, flow, block_id = heapq.heappop(deadlines)
+            if flow.packets and flow.block_id == block_id:  # 區塊可能已因湊滿批次而發送
+                try:
+                    flow.flush(udp_io, 'timeout')
+                except OSError as e:
+                    errors.inc()
+                    logging.error(f"Flow {flow.flow_id}: {e}")  # 這個區塊遺失，連線繼續
 
 # 啟動 TCP 轉 UDP 代理伺服器
 def start_proxy():
     # 建立 UDP Socket，並綁定到特定網卡（ens192）
     udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     udp_socket.bind((LOCAL_UDP_IP, 0))  # 指定 UDP 來源 IP
+    udp_io = open_batch_io(udp_socket, UDP_IO_BACKEND, max_batch=FEC_ORIGINAL_PACKETS + FEC_REDUNDANT_PACKETS)
     
     # 建立 TCP 伺服器 Socket
     tcp_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    tcp_server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     tcp_server.bind((TCP_HOST, TCP_PORT))  # 綁定 TCP 地址與埠號
-    tcp_server.listen(5)  # 設定最大佇列長度
-    logging.info(f"TCP to UDP proxy running on {TCP_HOST}:{TCP_PORT}, forwarding to {UDP_HOST}:{UDP_PORT} via {LOCAL_UDP_IP}")
+    tcp_server.listen(TCP_BACKLOG)  # 設定最大佇列長度
+    logging.info(f"TCP to UDP proxy running on {TCP_HOST}:{TCP_PORT}, forwarding to {UDP_HOST}:{UDP_PORT} via {LOCAL_UDP_IP} ({PROXY_MODE} mode, {udp_io.name} UDP I/O)")
+
+    start_metrics_server(METRICS_PORT)
+
+    if PROXY_MODE == 'eventloop':
+        raise_nofile_limit()
+        run_event_loop(tcp_server, udp_io)
+        return
     
-    packets = []  # 全域 FEC 封包緩存
-    last_send_time = [time.time()]  # 使用可變數確保多執行緒可更新
+    flows = {}  # flow_id -> FlowEncoder，僅供計時器執行緒巡查
+    flows_lock = threading.Lock()
+    flow_ids = itertools.count()
 
     # 啟動獨立執行緒來監控 FEC 超時
-    threading.Thread(target=fec_timer_trigger, args=(packets, last_send_time, udp_socket), daemon=True).start()
+    threading.Thread(target=fec_timer_trigger, args=(flows, flows_lock, udp_io), daemon=True).start()
     
     while True:
         client_socket, addr = tcp_server.accept()  # 接受新的 TCP 連線
-        logging.info(f"Accepted connection from {addr}")
-        client_handler = threading.Thread(target=handle_tcp_client, args=(client_socket, udp_socket, packets, last_send_time))
+        flow = FlowEncoder(next(flow_ids) % FLOW_ID_MODULO)
+        connections_accepted.inc()
+        active_connections.inc()
+        logging.debug(f"Accepted connection from {addr} (flow {flow.flow_id})")
+        with flows_lock:
+            flows[flow.flow_id] = flow
+        client_handler = threading.Thread(target=handle_tcp_client, args=(client_socket, udp_io, flow, flows, flows_lock))
         client_handler.start()  # 啟動新執行緒來處理 TCP 連線
 
 if __name__ == "__main__":
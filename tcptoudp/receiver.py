@@ -0,0 +1,414 @@
+import os
+import sys
+import socket
+import selectors
+import errno
+import time
+import logging
+from collections import OrderedDict
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.erasure import get_codec, ErasureDecodeError  # 封包層級 (k, m) 抹除碼
+from common.udpio import open_batch_io, UDP_IO_AUTO
+from common.metrics import REGISTRY, LogRateLimiter, start_metrics_server
+from framer import FRAMING_NEWLINE, LENGTH_PREFIX, MAX_MESSAGE_SIZE
+from protocol import (FLOW_HEADER, TCP_HEADER, TCP_FLAG_FIN, TCP_FLAG_PSH, SEQ_MODULO,
+                      unpack_tcp_header)
+
+# 設定日誌記錄
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# 設定參數
+UDP_LISTEN_IP = '0.0.0.0'   # 接收 proxy.py 送出的 UDP 封包
+UDP_LISTEN_PORT = 6000
+TCP_DEST_HOST = '127.0.0.1'  # 重組後的資料流轉送目標
+TCP_DEST_PORT = 7000
+FRAMING_MODE = FRAMING_NEWLINE  # 須與 proxy.py 相同；訊息結束（PSH）時依此補回分隔符號或長度前綴
+
+# 緩衝上限（確保記憶體有界）
+REORDER_WINDOW = 1024          # 每個 flow 重排緩衝最多容納的片段數
+REORDER_TIMEOUT = 0.05         # 序號缺口最多等待 50ms，之後視為遺失並跳過
+BLOCK_TIMEOUT = 0.5            # 未完成的 FEC 區塊最多保留時間
+MAX_OPEN_BLOCKS = 64           # 每個 flow 同時保留的未完成區塊數
+FINISHED_BLOCK_HISTORY = 256   # 記住最近完成的區塊，丟棄之後才到的冗餘封包
+MAX_PENDING_OUTPUT = 4 * 1024 * 1024  # 每條 TCP 連線尚未寫出的資料上限
+FLOW_IDLE_TIMEOUT = 30.0       # flow 閒置多久後釋放
+CLOSED_FLOW_LINGER = 2.0       # 已關閉的 flow 保留多久以丟棄遲到的封包（遲到的封包不延長）
+HOUSEKEEPING_INTERVAL = 0.1    # 區塊逾時與閒置 flow 的巡查間隔
+UDP_RECV_BATCH = 256           # 每次 UDP 就緒時最多讀取的封包數
+UDP_RECV_CALL_BATCH = 64       # 每次系統呼叫最多讀取的封包數（recvmmsg）
+UDP_IO_BACKEND = UDP_IO_AUTO   # UDP_IO_AUTO：Linux 上以 recvmmsg 批次接收；UDP_IO_SOCKET：逐一 recvfrom
+METRICS_PORT = 9103            # 本機統計端點 /metrics、/metrics.json；None 表示不啟動
+LOG_INTERVAL = 1.0             # 逐封包／逐區塊的日誌每秒最多一筆
+
+# 統計
+packets_in = REGISTRY.counter('receiver_udp_packets_in_total', 'UDP packets received from the proxy')
+packets_dropped = REGISTRY.counter('receiver_udp_packets_dropped_total', 'UDP packets dropped, by reason', label='reason')
+blocks_decoded = REGISTRY.counter('receiver_blocks_decoded_total', 'FEC blocks whose data packets all arrived')
+blocks_recovered = REGISTRY.counter('receiver_blocks_recovered_total', 'FEC blocks rebuilt with parity')
+packets_recovered = REGISTRY.counter('receiver_packets_recovered_total', 'Data packets rebuilt from parity')
+blocks_failed = REGISTRY.counter('receiver_blocks_failed_total', 'FEC blocks given up with data still missing')
+segments_lost = REGISTRY.counter('receiver_segments_lost_total', 'Segments skipped after the reorder timeout')
+tcp_bytes_out = REGISTRY.counter('receiver_tcp_bytes_out_total', 'Bytes written to TCP destinations')
+decode_seconds = REGISTRY.histogram('receiver_decode_seconds', 'Time spent rebuilding one block')
+log_limiter = LogRateLimiter(LOG_INTERVAL)
+
+class FecBlock:
+    """ 單一 FEC 區塊的接收狀態 """
+    __slots__ = ('k', 'm', 'symbol_size', 'data', 'parity', 'created')
+
+    def __init__(self, k, m, symbol_size, now):
+        self.k = k
+        self.m = m
+        self.symbol_size = symbol_size
+        self.data = {}    # index -> TCP 標頭 + 片段（未補零）
+        self.parity = {}  # index -> 冗餘封包
+        self.created = now
+
+class Flow:
+    """ 單一 flow（對應 proxy 端的一條 TCP 連線）的重組狀態 """
+    __slots__ = ('key', 'sock', 'connected', 'closed', 'fin', 'pending', 'next_seq', 'reorder',
+                 'gap_since', 'message', 'discarding', 'blocks', 'finished_blocks', 'last_activity', 'closed_at')
+
+    def __init__(self, key, now):
+        self.key = key
+        self.sock = None
+        self.connected = False
+        self.closed = False   # 已關閉的 flow 保留一段時間，丟棄遲到的封包
+        self.fin = False      # 已收到 FIN，資料寫完後關閉連線
+        self.pending = bytearray()  # 尚未寫入 TCP 的資料
+        self.next_seq = 0
+        self.reorder = {}     # seq -> (flags, payload)
+        self.gap_since = None # 序號缺口開始等待的時間
+        self.message = bytearray()  # 長度前綴模式下尚未結束的訊息
+        self.discarding = False     # 長度前綴模式下遺失片段後，丟棄直到下一個訊息邊界
+        self.blocks = OrderedDict()           # block_id -> FecBlock
+        self.finished_blocks = OrderedDict()  # block_id -> None
+        self.last_activity = now
+        self.closed_at = None
+
+def recover_block(block):
+    """ 用已收到的原始封包與冗餘封包重建遺失的原始封包，回傳 {index: 封包}；無法重建則回傳 None """
+    received = dict(block.data)
+    received.update(block.parity)
+    try:
+        with decode_seconds.time():
+            padded = get_codec(block.k, block.m).recover(received, block.symbol_size)
+    except ErasureDecodeError as e:
+        logging.error(f"FEC decode failed: {e}")
+        return None
+
+    recovered = {}
+    for index, packet in padded.items():
+        _, _, length = unpack_tcp_header(packet)
+        if TCP_HEADER.size + length > block.symbol_size:
+            return None
+        recovered[index] = packet[:TCP_HEADER.size + length]
+    return recovered
+
+class Receiver:
+    """ 單一事件迴圈：接收 UDP、FEC 還原、依序號重排，並寫入各 flow 的 TCP 連線 """
+
+    def __init__(self, udp_socket):
+        self.udp_socket = udp_socket
+        self.udp_io = open_batch_io(udp_socket, UDP_IO_BACKEND, max_batch=UDP_RECV_CALL_BATCH)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(udp_socket, selectors.EVENT_READ)
+        self.flows = {}         # (來源位址, flow_id, epoch) -> Flow
+        self.stalled = set()    # 目前有序號缺口的 flow
+        self.next_housekeeping = time.monotonic() + HOUSEKEEPING_INTERVAL
+        REGISTRY.gauge('receiver_active_flows', 'Flows currently tracked', lambda: len(self.flows))
+        REGISTRY.gauge('receiver_stalled_flows', 'Flows waiting on a sequence gap', lambda: len(self.stalled))
+
+    def run(self):
+        while True:
+            now = time.monotonic()
+            deadline = self.next_housekeeping
+            for flow in self.stalled:
+                deadline = min(deadline, flow.gap_since + REORDER_TIMEOUT)
+
+            for key, mask in self.selector.select(max(0.0, deadline - now)):
+                if key.data is None:
+                    self.read_udp()
+                else:
+                    self.handle_tcp_event(key.data, mask)
+
+            now = time.monotonic()
+            for flow in list(self.stalled):
+                if now - flow.gap_since >= REORDER_TIMEOUT:
+                    self.skip_gap(flow, now)
+            if now >= self.next_housekeeping:
+                self.housekeeping(now)
+                self.next_housekeeping = now + HOUSEKEEPING_INTERVAL
+
+    # === UDP 接收與 FEC 區塊 ===
+    def read_udp(self):
+        received = 0
+        while received < UDP_RECV_BATCH:
+            try:
+                batch = self.udp_io.recv_batch()
+            except (BlockingIOError, InterruptedError):
+                return
+            now = time.monotonic()
+            for data, addr in batch:
+                self.handle_datagram(data, addr, now)
+            received += len(batch)
+            packets_in.inc(len(batch))
+
+    def handle_datagram(self, data, addr, now):
+        if len(data) < FLOW_HEADER.size:
+            packets_dropped.inc(label_value='short')
+            return
+        epoch, flow_id, block_id, index, k, m, symbol_size = FLOW_HEADER.unpack_from(data)
+        payload = data[FLOW_HEADER.size:]
+        if index >= k + m or len(payload) > symbol_size:
+            packets_dropped.inc(label_value='malformed')
+            suppressed = log_limiter.allow('malformed')
+            if suppressed is not None:
+                logging.warning(f"Malformed datagram from {addr} (flow {flow_id}, block {block_id}), dropped"
+                                f" ({suppressed} similar messages suppressed)")
+            return
+
+        key = (addr, flow_id, epoch)  # proxy 重新啟動後 epoch 不同，沿用同一個 flow_id 也是新的 flow
+        flow = self.flows.get(key)
+        if flow is None:
+            flow = self.open_flow(key, now)
+        if flow.closed or block_id in flow.finished_blocks:
+            packets_dropped.inc(label_value='late')
+            return
+        flow.last_activity = now
+
+        block = flow.blocks.get(block_id)
+        if block is None:
+            block = FecBlock(k, m, symbol_size, now)
+            flow.blocks[block_id] = block
+            if len(flow.blocks) > MAX_OPEN_BLOCKS:
+                old_id, _ = flow.blocks.popitem(last=False)
+                blocks_failed.inc()
+                suppressed = log_limiter.allow('open_blocks')
+                if suppressed is not None:
+                    logging.warning(f"Flow {flow_id}: too many open blocks, dropped block {old_id}"
+                                    f" ({suppressed} similar messages suppressed)")
+
+        if index < k:
+            if index in block.data or len(payload) < TCP_HEADER.size:
+                packets_dropped.inc(label_value='duplicate')
+                return
+            block.data[index] = payload
+            self.deliver_packet(flow, payload, now)  # 原始封包直接進入重排，不等整個區塊
+        else:
+            block.parity[index] = payload
+
+        if len(block.data) == block.k:
+            blocks_decoded.inc()
+            self.finish_block(flow, block_id)
+        elif len(block.data) + len(block.parity) >= block.k:  # 任意 k 個封包即可還原
+            recovered = recover_block(block)
+            if recovered is not None:
+                blocks_recovered.inc()
+                packets_recovered.inc(len(recovered))
+                suppressed = log_limiter.allow('recovered')
+                if suppressed is not None:
+                    logging.info(f"Flow {flow_id}: recovered {len(recovered)} packets in block {block_id}"
+                                 f" ({suppressed} similar messages suppressed)")
+                for packet in recovered.values():
+                    self.deliver_packet(flow, packet, now)
+                self.finish_block(flow, block_id)
+
+    def finish_block(self, flow, block_id):
+        flow.blocks.pop(block_id, None)
+        flow.finished_blocks[block_id] = None
+        if len(flow.finished_blocks) > FINISHED_BLOCK_HISTORY:
+            flow.finished_blocks.popitem(last=False)
+
+    # === 依序號重排 ===
+    def deliver_packet(self, flow, packet, now):
+        seq_num, flags, length = unpack_tcp_header(packet)
+        segment = packet[TCP_HEADER.size:TCP_HEADER.size + length]
+
+        distance = (seq_num - flow.next_seq) % SEQ_MODULO
+        if distance >= SEQ_MODULO // 2 or seq_num in flow.reorder:
+            return  # 重複或已跳過的片段
+        if distance >= REORDER_WINDOW:
+            # 超出重排窗口：放棄窗口前緣的缺口，保持緩衝有界
+            self.advance(flow, (seq_num - REORDER_WINDOW + 1) % SEQ_MODULO)
+        flow.reorder[seq_num] = (flags, segment)
+        self.drain(flow, now)
+
+    def drain(self, flow, now):
+        progressed = False
+        while flow.next_seq in flow.reorder:
+            flags, segment = flow.reorder.pop(flow.next_seq)
+            flow.next_seq = (flow.next_seq + 1) % SEQ_MODULO
+            progressed = True
+            self.emit_segment(flow, flags, segment)
+        if flow.closed:
+            return
+        if flow.fin:
+            self.flush(flow)
+        if not flow.reorder:
+            flow.gap_since = None
+            self.stalled.discard(flow)
+        elif progressed or flow.gap_since is None:
+            flow.gap_since = now
+            self.stalled.add(flow)
+
+    def advance(self, flow, new_next_seq):
+        """ 將 next_seq 往前移到 new_next_seq，期間缺少的片段視為遺失 """
+        lost = 0
+        while flow.next_seq != new_next_seq:
+            item = flow.reorder.pop(flow.next_seq, None)
+            if item is None:
+                lost += 1
+                if FRAMING_MODE != FRAMING_NEWLINE:
+                    flow.message.clear()
+                    flow.discarding = True
+            else:
+                self.emit_segment(flow, *item)
+            flow.next_seq = (flow.next_seq + 1) % SEQ_MODULO
+        if lost:
+            segments_lost.inc(lost)
+            suppressed = log_limiter.allow('lost')
+            if suppressed is not None:
+                logging.warning(f"Flow {flow.key[1]}: {lost} segments lost, skipped ({suppressed} similar messages suppressed)")
+
+    def emit_segment(self, flow, flags, segment):
+        """ 依序輸出一個片段，並在訊息結束處還原切割格式 """
+        if flags & TCP_FLAG_FIN:
+            flow.fin = True
+        if FRAMING_MODE == FRAMING_NEWLINE:
+            self.write(flow, segment)
+            if flags & TCP_FLAG_PSH:
+                self.write(flow, b"\n")
+            return
+
+        # 長度前綴模式：整個訊息到齊後才能寫出長度，不完整的訊息整個丟棄以保持邊界正確
+        if not flow.discarding:
+            flow.message += segment
+            if len(flow.message) > MAX_MESSAGE_SIZE:
+                logging.error(f"Flow {flow.key[1]}: message exceeds {MAX_MESSAGE_SIZE} bytes, discarded")
+                flow.message.clear()
+                flow.discarding = True
+        if flags & TCP_FLAG_PSH:
+            if not flow.discarding:
+                self.write(flow, LENGTH_PREFIX.pack(len(flow.message)) + flow.message)
+            flow.message.clear()
+            flow.discarding = False
+
+    def skip_gap(self, flow, now):
+        """ 缺口等待逾時：跳到重排緩衝中最小的序號 """
+        first = min(flow.reorder, key=lambda seq: (seq - flow.next_seq) % SEQ_MODULO)
+        self.advance(flow, first)
+        self.drain(flow, now)
+
+    # === TCP 輸出 ===
+    def open_flow(self, key, now):
+        flow = Flow(key, now)
+        self.flows[key] = flow
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        err = sock.connect_ex((TCP_DEST_HOST, TCP_DEST_PORT))
+        if err not in (0, errno.EINPROGRESS):
+            logging.error(f"Flow {key[1]}: connect to {TCP_DEST_HOST}:{TCP_DEST_PORT} failed: {errno.errorcode.get(err, err)}")
+            sock.close()
+            self.close_flow(flow)  # 與其他關閉的 flow 一樣保留一段時間後釋放
+            return flow
+        flow.sock = sock
+        flow.connected = err == 0
+        self.selector.register(sock, selectors.EVENT_READ | selectors.EVENT_WRITE, flow)
+        logging.info(f"New flow {key[1]} from {key[0]}, forwarding to {TCP_DEST_HOST}:{TCP_DEST_PORT}")
+        return flow
+
+    def write(self, flow, data):
+        if flow.closed or not data:
+            return
+        flow.pending += data
+        if len(flow.pending) > MAX_PENDING_OUTPUT:
+            logging.error(f"Flow {flow.key[1]}: TCP destination too slow ({len(flow.pending)} bytes pending), closing flow")
+            self.close_flow(flow)
+            return
+        if flow.connected:
+            self.flush(flow)
+
+    def flush(self, flow):
+        if not flow.connected or flow.closed:
+            return
+        try:
+            while flow.pending:
+                sent = flow.sock.send(flow.pending)
+                del flow.pending[:sent]
+                tcp_bytes_out.inc(sent)
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError as e:
+            logging.error(f"Flow {flow.key[1]}: send failed: {e}")
+            self.close_flow(flow)
+            return
+        if not flow.pending and flow.fin:
+            logging.info(f"Flow {flow.key[1]} finished")
+            self.close_flow(flow)
+            return
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if flow.pending else 0)
+        self.selector.modify(flow.sock, events, flow)
+
+    def handle_tcp_event(self, flow, mask):
+        if mask & selectors.EVENT_WRITE and not flow.connected:
+            err = flow.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                logging.error(f"Flow {flow.key[1]}: connect to {TCP_DEST_HOST}:{TCP_DEST_PORT} failed: {errno.errorcode.get(err, err)}")
+                self.close_flow(flow)
+                return
+            flow.connected = True
+        if mask & selectors.EVENT_READ:
+            try:
+                data = flow.sock.recv(4096)  # 單向通道，目標端回傳的資料直接丟棄
+            except (BlockingIOError, InterruptedError):
+                data = None
+            except OSError:
+                data = b""
+            if data == b"":
+                logging.info(f"Flow {flow.key[1]}: TCP destination closed the connection")
+                self.close_flow(flow)
+                return
+        self.flush(flow)
+
+    def close_flow(self, flow):
+        if flow.sock is not None:
+            self.selector.unregister(flow.sock)
+            flow.sock.close()
+            flow.sock = None
+        flow.closed = True
+        flow.closed_at = time.monotonic()
+        flow.connected = False
+        flow.pending = bytearray()
+        flow.reorder.clear()
+        flow.blocks.clear()
+        self.stalled.discard(flow)
+
+    def housekeeping(self, now):
+        for key, flow in list(self.flows.items()):
+            while flow.blocks:
+                _, block = next(iter(flow.blocks.items()))
+                if now - block.created < BLOCK_TIMEOUT:
+                    break
+                blocks_failed.inc()
+                flow.blocks.popitem(last=False)
+            if flow.closed and now - flow.closed_at >= CLOSED_FLOW_LINGER:
+                del self.flows[key]  # 之後同一個 flow_id 的封包視為新的連線
+            elif now - flow.last_activity >= FLOW_IDLE_TIMEOUT:
+                if not flow.closed:
+                    logging.info(f"Flow {key[1]} idle, closing")
+                    self.close_flow(flow)
+                del self.flows[key]
+
+# 啟動 UDP 轉 TCP 接收端
+def start_receiver():
+    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    udp_socket.bind((UDP_LISTEN_IP, UDP_LISTEN_PORT))
+    udp_socket.setblocking(False)
+    logging.info(f"UDP to TCP receiver running on {UDP_LISTEN_IP}:{UDP_LISTEN_PORT}, forwarding to {TCP_DEST_HOST}:{TCP_DEST_PORT}")
+    start_metrics_server(METRICS_PORT)
+    Receiver(udp_socket).run()
+
+if __name__ == "__main__":
+    start_receiver()  # 啟動接收端
@@ -0,0 +1,12 @@
+import struct
+
+# === udptest 測試封包格式 ===
+#
+# 每個 UDP 封包 = 測試標頭 + 補齊到指定大小的內容
+#   測試標頭：stream (2) | seq (8) | send_time_ns (8)
+#   stream：發送端的串流編號；seq：每個串流從 0 開始連續遞增
+#   send_time_ns：送出時的 time.time_ns()，跨主機量測單向延遲時兩端的時鐘需要同步（例如 PTP / chrony）
+#
+# 接收端依 (來源地址, stream) 分開統計遺失、亂序、重複、抖動與延遲。
+
+PROBE_HEADER = struct.Struct("!H Q Q")
@@ -1,63 +1,287 @@
+import os
 import socket
+import sys
 import time
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.metrics import Histogram
+from common.udpio import UDP_IO_AUTO, open_batch_io
+from protocol import PROBE_HEADER
+
 # ========== 設定區 ==========
 LISTEN_IP = '0.0.0.0'     # 綁定所有網卡
 LISTEN_PORT = 5000
-EXPECTED_PACKETS = 10000   # 預期封包總數（需與發送端對應）
+EXPECTED_PACKETS = None   # 每個串流預期的封包數（需與發送端對應）；用來計算結尾的遺失，None 表示只統計到最後收到的序號
+IDLE_TIMEOUT = 2.0        # 超過此時間沒有收到封包就結束這一輪測試並顯示結果
+REORDER_WINDOW = 1024     # 比目前最大序號落後超過此數量的缺口視為遺失（之後才到的封包另計為「遲到」）
+LATE_HISTORY = 8 * REORDER_WINDOW  # 判定為遺失後 bitmap 再保留多少個序號，用來分辨遲到與重複的封包；更舊的封包另計，不列入統計
+MAX_SEQ_JUMP = 64 * REORDER_WINDOW  # 序號一次往前跳超過此數量時視為新的一輪（例如接收端中途才啟動），從該序號重新起算，中間不計為遺失
+REPORT_INTERVAL = 1.0     # 每隔幾秒顯示一次即時統計；None 表示不顯示
+UDP_IO_BACKEND = UDP_IO_AUTO  # UDP_IO_AUTO：Linux 上以 recvmmsg 批次接收；UDP_IO_SOCKET：逐一 recvfrom
+RECV_BATCH = 64           # 每次系統呼叫最多讀取的封包數
+RECV_BUFFER = 8 * 1024 * 1024
 # ===========================
 
-def receive_packets():
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.bind((LISTEN_IP, LISTEN_PORT))
+LATENCY_BUCKETS = (0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)  # 秒
+JITTER_GAIN = 1 / 16  # RFC 3550 §6.4.1
+
+class FlowStats:
+    """ 單一 (來源地址, 串流) 的統計；序號以 bitmap 記錄，每個序號 1 bit """
+
+    def __init__(self, key, now):
+        self.key = key
+        self.bitmap = bytearray(4096)
+        self.base = 0             # bitmap 第 0 bit 對應的序號
+        self.trim_at = LATE_HISTORY + len(self.bitmap) * 4  # settled 到達此序號時丟掉舊的 bitmap
+        self.highest = -1
+        self.settled = 0          # 小於此序號的缺口已判定為遺失並計入連續遺失統計
+        self.received = 0
+        self.bytes = 0
+        self.duplicates = 0
+        self.reordered = 0        # 序號小於先前最大序號的封包
+        self.max_reorder = 0
+        self.reorder_distances = {}  # 以 2 的次方分組的亂序距離 -> 次數
+        self.late = 0             # 已判定遺失後才到達的封包
+        self.lost = 0
+        self.restarts = 0         # 序號大幅跳躍而重新起算的次數
+        self.stale = 0            # 比保留的 bitmap 更舊（或屬於重新起算前）的封包，無法分辨是否重複，不列入統計
+        self.burst = 0            # 目前正在累計的連續遺失長度
+        self.bursts = {}          # 連續遺失長度 -> 次數
+        self.jitter = 0.0         # 秒
+        self.last_transit = None
+        self.latency = Histogram('latency', 'One-way latency', LATENCY_BUCKETS)
+        self.min_latency = None
+        self.max_latency = None
+        self.first_seen = now
+        self.last_seen = now
+
+    def record(self, seq, sent_ns, size, now_ns, now):
+        if seq > self.highest + MAX_SEQ_JUMP:
+            self.restart(seq)
+        elif seq < self.base:
+            self.stale += 1
+            return
+        index = (seq - self.base) >> 3
+        if index >= len(self.bitmap):
+            self.bitmap.extend(bytes(max(index + 1, 2 * len(self.bitmap)) - len(self.bitmap)))
+        mask = 1 << ((seq - self.base) & 7)
+        if self.bitmap[index] & mask:
+            self.duplicates += 1
+            return
+        self.bitmap[index] |= mask
+        self.received += 1
+        self.bytes += size
+        self.last_seen = now
+
+        if seq > self.highest:
+            self.highest = seq
+        else:
+            distance = self.highest - seq
+            self.reordered += 1
+            self.max_reorder = max(self.max_reorder, distance)
+            bucket = 1 << (distance - 1).bit_length()
+            self.reorder_distances[bucket] = self.reorder_distances.get(bucket, 0) + 1
+            if seq < self.settled:
+                self.late += 1
+                self.lost -= 1
+
+        # RFC 3550：以相鄰兩個封包的傳輸時間差估計抖動，J += (|D| - J) / 16
+        transit = (now_ns - sent_ns) / 1e9
+        if self.last_transit is not None:
+            self.jitter += (abs(transit - self.last_transit) - self.jitter) * JITTER_GAIN
+        self.last_transit = transit
+        self.latency.observe(transit)
+        if self.min_latency is None or transit < self.min_latency:
+            self.min_latency = transit
+        if self.max_latency is None or transit > self.max_latency:
+            self.max_latency = transit
+
+        self.settle(self.highest - REORDER_WINDOW)
+
+    def restart(self, seq):
+        """ 序號大幅往前跳：先判定前一輪剩下的缺口，再以 seq 為起點重新記錄，bitmap 與判定迴圈不隨跳躍距離成長 """
+        if self.highest >= 0:
+            self.restarts += 1
+            self.settle(self.highest)
+            if self.burst:
+                self.bursts[self.burst] = self.bursts.get(self.burst, 0) + 1
+                self.burst = 0
+        self.bitmap = bytearray(4096)
+        self.base = self.settled = seq
+        self.trim_at = seq + LATE_HISTORY + len(self.bitmap) * 4
+        self.highest = seq - 1
+
+    def received_bit(self, seq):
+        index = (seq - self.base) >> 3
+        return index < len(self.bitmap) and self.bitmap[index] & (1 << ((seq - self.base) & 7))
+
+    def settle(self, limit):
+        """ 依序檢查 limit（含）以前尚未判定的序號，累計遺失與連續遺失長度 """
+        while self.settled <= limit:
+            if self.received_bit(self.settled):
+                if self.burst:
+                    self.bursts[self.burst] = self.bursts.get(self.burst, 0) + 1
+                    self.burst = 0
+            else:
+                self.lost += 1
+                self.burst += 1
+            self.settled += 1
+        if self.settled >= self.trim_at:
+            self.trim()
+
+    def trim(self):
+        """ 丟掉比 settled - LATE_HISTORY 更舊的 bitmap，記憶體只隨視窗大小而非整輪的封包數成長；
+            累積到一半長度才搬移一次，攤提成本為常數 """
+        drop = (self.settled - LATE_HISTORY - self.base) >> 3
+        if drop >= len(self.bitmap) // 2:
+            del self.bitmap[:drop]
+            self.base += drop * 8
+        self.trim_at = self.base + LATE_HISTORY + len(self.bitmap) * 4
+
+    def finish(self):
+        """ 一輪結束：判定所有剩下的缺口（含 EXPECTED_PACKETS 之前的結尾遺失） """
+        last = self.highest if EXPECTED_PACKETS is None else max(self.highest, EXPECTED_PACKETS - 1)
+        self.settle(last)
+        if self.burst:
+            self.bursts[self.burst] = self.bursts.get(self.burst, 0) + 1
+            self.burst = 0
+
+    def complete(self):
+        return EXPECTED_PACKETS is not None and self.received >= EXPECTED_PACKETS
+
+def latency_percentile(histogram, fraction):
+    """ 由 bucket 估計百分位數，回傳該 bucket 的上限（秒）；超過最大 bucket 時回傳 None """
+    target = histogram.count * fraction
+    cumulative = 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        if cumulative >= target:
+            return bound
+    return None
+
+def burst_percentile(bursts, fraction):
+    total = sum(bursts.values())
+    cumulative = 0
+    for length in sorted(bursts):
+        cumulative += bursts[length]
+        if cumulative >= total * fraction:
+            return length
+    return 0
+
+def format_ms(value):
+    return '>1000' if value is None else f"{value * 1000:.3f}"
 
-    received_count = 0
+def print_report(flows, elapsed):
+    print("\n=== Result ===")
+    for flow in flows.values():
+        flow.finish()
+        addr, stream = flow.key
+        expected = flow.received + flow.lost
+        duration = max(flow.last_seen - flow.first_seen, 1e-9)
+        print(f"Flow {addr[0]}:{addr[1]} stream {stream}")
+        print(f"  Expected packets: {expected}")
+        print(f"  Received packets: {flow.received}  ({flow.received / duration:.2f} packets/sec, "
+              f"~{flow.bytes * 8 / duration / 1_000_000:.2f} Mbps)")
+        print(f"  Lost packets: {flow.lost}")
+        print(f"  Loss rate: {flow.lost / expected * 100 if expected else 0.0:.2f}%")
+        print(f"  Duplicates: {flow.duplicates}  Reordered: {flow.reordered} (max distance {flow.max_reorder})  "
+              f"Late: {flow.late}")
+        if flow.restarts:
+            print(f"  Sequence restarts: {flow.restarts} (jumps over {MAX_SEQ_JUMP})")
+        if flow.stale:
+            print(f"  Stale packets: {flow.stale} (older than the last {LATE_HISTORY} settled sequence numbers "
+                  f"or from before a restart, ignored)")
+        if flow.reorder_distances:
+            print("  Reorder distance: " + ", ".join(f"<={bucket}: {count}"
+                                                    for bucket, count in sorted(flow.reorder_distances.items())))
+        if flow.bursts:
+            print(f"  Loss bursts: {sum(flow.bursts.values())} (max length {max(flow.bursts)}, "
+                  f"p99 length {burst_percentile(flow.bursts, 0.99)})")
+            print("  Burst length: " + ", ".join(f"{length}: {count}" for length, count in sorted(flow.bursts.items())))
+        if flow.received:
+            print(f"  Jitter (RFC 3550): {flow.jitter * 1000:.3f} ms")
+            print(f"  One-way latency: min {flow.min_latency * 1000:.3f} ms, "
+                  f"avg {flow.latency.sum / flow.latency.count * 1000:.3f} ms, max {flow.max_latency * 1000:.3f} ms, "
+                  f"p50 <= {format_ms(latency_percentile(flow.latency, 0.5))} ms, "
+                  f"p99 <= {format_ms(latency_percentile(flow.latency, 0.99))} ms "
+                  f"(requires synchronized clocks)")
+    print(f"Duration: {elapsed:.2f} seconds")
+    print("----------------------------\n")
+
+def print_progress(flows, elapsed, interval, last_counts):
+    received = sum(flow.received for flow in flows.values())
+    received_bytes = sum(flow.bytes for flow in flows.values())
+    lost = sum(flow.lost for flow in flows.values())
+    jitter = max((flow.jitter for flow in flows.values()), default=0.0)
+    print(f"[{elapsed:7.1f}s] {(received - last_counts[0]) / interval:10.0f} packets/sec "
+          f"{(received_bytes - last_counts[1]) * 8 / interval / 1_000_000:8.2f} Mbps, "
+          f"lost {lost}, duplicates {sum(flow.duplicates for flow in flows.values())}, "
+          f"reordered {sum(flow.reordered for flow in flows.values())}, jitter {jitter * 1000:.3f} ms")
+    return received, received_bytes
+
+def receive_packets(udp_io):
+    """ 接收一輪測試：第一個封包開始計時，閒置超過 IDLE_TIMEOUT 或所有串流收齊時結束 """
+    flows = {}  # (來源地址, 串流) -> FlowStats
+    malformed = 0
     start_time = None
+    last_packet = None
+    last_report = None
+    last_counts = (0, 0)
 
     try:
         while True:
-            # 直接阻塞等待封包進來（無限等待）
-            data, addr = sock.recvfrom(1400)
-
-            if start_time is None:
-                # 第一次收到封包時才開始計時
-                start_time = time.time()
-
-            received_count += 1
+            try:
+                batch = udp_io.recv_batch()
+            except socket.timeout:
+                batch = []
+            now = time.monotonic()
+            now_ns = time.time_ns()
 
-            # 可選：列印封包內容（測試用）
-            # print(f"Received: {data.decode()} from {addr}")
+            for data, addr in batch:
+                if len(data) < PROBE_HEADER.size:
+                    malformed += 1
+                    continue
+                stream, seq, sent_ns = PROBE_HEADER.unpack_from(data)
+                flow = flows.get((addr, stream))
+                if flow is None:
+                    flow = flows[(addr, stream)] = FlowStats((addr, stream), now)
+                flow.record(seq, sent_ns, len(data), now_ns, now)
+            if batch:
+                last_packet = now
+                if start_time is None:
+                    # 第一次收到封包時才開始計時
+                    start_time = last_report = now
 
-            # 當收到指定數量的封包後，停止接收
-            if received_count >= EXPECTED_PACKETS:
+            if start_time is None:
+                continue
+            if REPORT_INTERVAL is not None and now - last_report >= REPORT_INTERVAL:
+                last_counts = print_progress(flows, now - start_time, now - last_report, last_counts)
+                last_report = now
+            if now - last_packet >= IDLE_TIMEOUT or (flows and all(flow.complete() for flow in flows.values())):
                 break
+    finally:
+        # Ctrl+C 中斷時也顯示已收到的部分
+        if start_time is not None:
+            print_report(flows, last_packet - start_time)
+        if malformed:
+            print(f"Ignored {malformed} packets without a test header\n")
 
-    except KeyboardInterrupt:
-        print("\nStopped by user")
-        sock.close()
-        exit()
-
+def main():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER)
+    sock.bind((LISTEN_IP, LISTEN_PORT))
+    # 以較短的逾時輪詢，才能即時顯示統計並判斷閒置
+    sock.settimeout(min(IDLE_TIMEOUT, REPORT_INTERVAL or IDLE_TIMEOUT) / 4)
+    udp_io = open_batch_io(sock, UDP_IO_BACKEND, max_batch=RECV_BATCH)
+    print(f"Listening on {LISTEN_IP}:{LISTEN_PORT} ({udp_io.name} I/O)")
+    try:
+        while True:
+            receive_packets(udp_io)  # 持續等待和處理封包
     finally:
         sock.close()
 
-        if start_time is not None:
-            end_time = time.time()
-            duration = end_time - start_time
-            loss_count = EXPECTED_PACKETS - received_count
-            loss_rate = (loss_count / EXPECTED_PACKETS) * 100
-
-            # === 顯示結果 ===
-            print("\n=== Result ===")
-            print(f"Expected packets: {EXPECTED_PACKETS}")
-            print(f"Received packets: {received_count}")
-            print(f"Lost packets: {loss_count}")
-            print(f"Loss rate: {loss_rate:.2f}%")
-            print(f"Duration: {duration:.2f} seconds")
-            print("----------------------------\n")
-
 if __name__ == "__main__":
     try:
-        while True:
-            receive_packets()  # 持續等待和處理封包
+        main()
     except KeyboardInterrupt:
         print("\nReceiver stopped by user. Exiting...")
@@ -1,36 +1,195 @@
+import os
+import random
 import socket
+import sys
 import time
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.udpio import UDP_IO_AUTO, open_batch_io
+from protocol import PROBE_HEADER
+
 # ========== 設定區 ==========
 TARGET_IP = '192.168.1.91'
 TARGET_PORT = 5000
-PACKET_SIZE = 1400       # 封包大小（byte）
-PACKET_COUNT = 10000     # 發送封包總數
-INTERVAL = 0.00044       # 發送間隔時間（秒） -> 2200 封包/秒 (約26 Mbps)
+PACKET_SIZE = 1400       # 'fixed' 分佈的封包大小（byte）
+RATE_MBPS = 26.0         # 每個串流的目標速率（UDP 酬載，Mbps）
+PACKET_COUNT = 10000     # 每個串流的發送封包總數；None 表示不限
+DURATION = None          # 發送時間上限（秒）；None 表示不限（兩者皆為 None 時持續發送到 Ctrl+C）
+
+# 每個串流使用自己的 socket（不同來源埠），未指定的欄位使用上方的預設值：
+#   target：(IP, 埠號)、rate_mbps、count、sizes：'fixed' / 'imix' / 'trace'、packet_size、trace_file
+STREAMS = [
+    {'target': (TARGET_IP, TARGET_PORT), 'rate_mbps': RATE_MBPS, 'sizes': 'fixed'},
+]
+
+# Simple IMIX（以 IP 封包大小計 40 / 576 / 1500 bytes，比例 7:4:1），扣除 IP + UDP 標頭 28 bytes 後為 UDP 酬載大小；
+# 小於測試標頭（PROBE_HEADER.size）的大小會補到標頭長度
+IMIX_SIZES = [(12, 7), (548, 4), (1472, 1)]
+TRACE_FILE = 'sizes.txt' # 'trace' 分佈：每行一個封包大小（# 開頭為註解），依序循環使用
+SIZE_SEED = 1            # 'imix' 分佈的亂數種子，讓每次測試的封包大小序列相同
+
+SEND_BATCH = 32          # 每次系統呼叫最多送出的封包數（Linux 上為 sendmmsg）
+BURST_TIME = 0.001       # token bucket 深度（秒）：累積的額度上限，也就是單次批次與微突發的上限
+SPIN_THRESHOLD = 0.0002  # 距離下次發送小於此時間時改為忙等，避免 sleep 的計時誤差拉低速率
+UDP_IO_BACKEND = UDP_IO_AUTO  # UDP_IO_AUTO：Linux 上以 sendmmsg 批次送出；UDP_IO_SOCKET：逐一 sendto
+REPORT_INTERVAL = 1.0    # 每隔幾秒顯示一次目前速率；None 表示不顯示
 # ===========================
 
-sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+MAX_UDP_PAYLOAD = 65507
+SIZE_SEQUENCE_LENGTH = 4096  # 'imix' 預先抽樣的長度，之後循環使用
 
-success_count = 0
-packet_data = b'X' * PACKET_SIZE  # 模擬 1400 bytes 封包
+def size_sequence(spec):
+    """ 依分佈產生封包大小序列，發送時依序循環取用 """
+    kind = spec.get('sizes', 'fixed')
+    if kind == 'fixed':
+        sizes = [spec.get('packet_size', PACKET_SIZE)]
+    elif kind == 'imix':
+        rng = random.Random(SIZE_SEED)
+        values, weights = zip(*spec.get('imix', IMIX_SIZES))
+        sizes = rng.choices(values, weights, k=SIZE_SEQUENCE_LENGTH)
+    elif kind == 'trace':
+        with open(spec.get('trace_file', TRACE_FILE)) as f:
+            sizes = [int(line.split()[0]) for line in f if line.strip() and not line.lstrip().startswith('#')]
+    else:
+        raise ValueError(f"Unknown packet size distribution: {kind}")
+    if not sizes or min(sizes) < 1 or max(sizes) > MAX_UDP_PAYLOAD:
+        raise ValueError(f"Packet sizes must be between 1 and {MAX_UDP_PAYLOAD} bytes")
+    return [max(size, PROBE_HEADER.size) for size in sizes]  # 每個封包至少要放得下序號與時間戳記
 
-print(f"Sending {PACKET_COUNT} UDP packets to {TARGET_IP}:{TARGET_PORT} at ~26 Mbps")
+class Stream:
+    """ 單一串流：以 token bucket（單位 byte）控制速率，額度足夠時一次送出一批 """
 
-start_time = time.time()
+    def __init__(self, index, spec, now):
+        self.index = index
+        self.target = spec.get('target', (TARGET_IP, TARGET_PORT))
+        self.rate = spec.get('rate_mbps', RATE_MBPS) * 1_000_000 / 8  # bytes/s
+        if self.rate <= 0:
+            raise ValueError(f"Stream {index}: rate must be positive")
+        self.limit = spec.get('count', PACKET_COUNT)
+        self.sizes = size_sequence(spec)
+        self.padding = {size: b'X' * (size - PROBE_HEADER.size) for size in set(self.sizes)}
+        largest = max(self.sizes)
+        self.capacity = max(self.rate * BURST_TIME, largest)  # 至少能放行最大的封包
+        self.tokens = largest
+        self.updated = now
+        self.position = 0  # 已排入發送的封包數（也是下一個封包在大小序列中的位置）
 
-for i in range(PACKET_COUNT):
-    try:
-        sock.sendto(packet_data, (TARGET_IP, TARGET_PORT))
-        success_count += 1
-        time.sleep(INTERVAL)
-    except Exception as e:
-        print(f"Failed to send packet {i + 1}: {e}")
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.io = open_batch_io(self.sock, UDP_IO_BACKEND, max_batch=SEND_BATCH)
+        self.sent = 0
+        self.sent_bytes = 0
+        self.errors = 0
+
+    def finished(self):
+        return self.limit is not None and self.position >= self.limit
+
+    def next_size(self):
+        return self.sizes[self.position % len(self.sizes)]
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        """ 距離額度足以送出下一個封包的秒數 """
+        deficit = self.next_size() - self.tokens
+        return deficit / self.rate if deficit > 0 else 0.0
 
-sock.close()
+    def send_ready(self):
+        """ 送出目前額度允許的封包（最多 SEND_BATCH 個）；同一批共用一個送出時間 """
+        batch = []
+        send_time = time.time_ns()
+        while len(batch) < SEND_BATCH and not self.finished():
+            size = self.next_size()
+            if size > self.tokens:
+                break
+            self.tokens -= size
+            batch.append(PROBE_HEADER.pack(self.index, self.position, send_time) + self.padding[size])
+            self.position += 1
+        if not batch:
+            return
+        try:
+            sent = self.io.send_batch(batch, self.target)
+        except OSError as e:
+            # 例如 ENOBUFS：本機送出佇列已滿，整批視為失敗，不重送
+            self.errors += len(batch)
+            if self.errors == len(batch):
+                print(f"Stream {self.index}: send failed: {e}")
+            return
+        self.sent += sent
+        self.sent_bytes += sum(len(packet) for packet in batch[:sent])
+
+    def close(self):
+        self.sock.close()
+
+def pace_wait(deadline):
+    """ 先 sleep 到接近期限，剩下的時間忙等 """
+    remaining = deadline - time.perf_counter()
+    if remaining > SPIN_THRESHOLD:
+        time.sleep(remaining - SPIN_THRESHOLD)
+    while time.perf_counter() < deadline:
+        pass
+
+def run(streams, stop_at):
+    """ 單一迴圈輪流服務所有串流，直到全部送完或到達時間上限 """
+    start = last_report = time.perf_counter()
+    last_sent, last_bytes = 0, 0
+    active = list(streams)
+    while active:
+        now = time.perf_counter()
+        if stop_at is not None and now >= stop_at:
+            break
+        next_due = None
+        for stream in active:
+            stream.refill(now)
+            stream.send_ready()
+            if not stream.finished():
+                due = now + stream.wait_time()
+                next_due = due if next_due is None else min(next_due, due)
+        active = [stream for stream in active if not stream.finished()]
+
+        if REPORT_INTERVAL is not None and now - last_report >= REPORT_INTERVAL:
+            sent = sum(stream.sent for stream in streams)
+            sent_bytes = sum(stream.sent_bytes for stream in streams)
+            interval = now - last_report
+            print(f"[{now - start:7.1f}s] {(sent - last_sent) / interval:10.0f} packets/sec "
+                  f"{(sent_bytes - last_bytes) * 8 / interval / 1_000_000:8.2f} Mbps")
+            last_report, last_sent, last_bytes = now, sent, sent_bytes
+
+        if next_due is not None:
+            if stop_at is not None:
+                next_due = min(next_due, stop_at)
+            if next_due > time.perf_counter():
+                pace_wait(next_due)
+
+def main():
+    now = time.perf_counter()
+    streams = [Stream(index, spec, now) for index, spec in enumerate(STREAMS)]
+    for stream in streams:
+        sizes = 'fixed' if len(set(stream.sizes)) == 1 else f"{len(set(stream.sizes))} sizes"
+        print(f"Stream {stream.index}: sending to {stream.target[0]}:{stream.target[1]} at "
+              f"{stream.rate * 8 / 1_000_000:.2f} Mbps ({sizes}, {stream.io.name} I/O, "
+              f"{'unlimited' if stream.limit is None else stream.limit} packets)")
+
+    start_time = time.perf_counter()
+    stop_at = start_time + DURATION if DURATION is not None else None
+    try:
+        run(streams, stop_at)
+    except KeyboardInterrupt:
+        print("\nStopped by user")
+    finally:
+        duration = time.perf_counter() - start_time
+        for stream in streams:
+            stream.close()
 
-end_time = time.time()
-duration = end_time - start_time
+    print("\n=== Result ===")
+    for stream in streams:
+        print(f"Stream {stream.index}: sent {stream.sent}/{stream.position} packets, {stream.errors} errors, "
+              f"{stream.sent / duration:.2f} packets/sec (~{stream.sent_bytes * 8 / duration / 1_000_000:.2f} Mbps)")
+    total_sent = sum(stream.sent for stream in streams)
+    total_bytes = sum(stream.sent_bytes for stream in streams)
+    print(f"Total duration: {duration:.2f} seconds")
+    print(f"Average rate: {total_sent / duration:.2f} packets/sec (~{total_bytes * 8 / duration / 1_000_000:.2f} Mbps)")
 
-print(f"Sent {success_count}/{PACKET_COUNT} packets successfully")
-print(f"Total duration: {duration:.2f} seconds")
-print(f"Average rate: {success_count / duration:.2f} packets/sec (~{(success_count * PACKET_SIZE * 8) / (duration * 1_000_000):.2f} Mbps)")
+if __name__ == '__main__':
+    main()